@@ -19,6 +19,29 @@ def parse_args(argv):
     main_parser.add_argument(
         "--trace", "--debug", action="store_true", help=argparse.SUPPRESS
     )
+    main_parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print the time spent in API calls and commands at exit",
+    )
+    cassette_group = main_parser.add_mutually_exclusive_group()
+    cassette_group.add_argument(
+        "--record-conduit",
+        metavar="FILE",
+        help="Record the Conduit API calls to a file",
+    )
+    cassette_group.add_argument(
+        "--replay-conduit",
+        metavar="FILE",
+        help="Answer the Conduit API calls from a recorded file",
+    )
+    main_parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="Divide the recorded latency of the replayed calls, 0 for no delay "
+        "(default: 1)",
+    )
     parser = argparse.ArgumentParser(parents=[main_parser])
 
     commands_parser = parser.add_subparsers(
@@ -39,17 +62,18 @@ def parse_args(argv):
     help_parser.add_argument("command", nargs=argparse.OPTIONAL)
     help_parser.set_defaults(print_help=True)
 
+    # The global options might precede the command.
+    main_args, unknown = main_parser.parse_known_args(argv)
+
     # if we're called without a command and from within a repository,
     # default to submit.
-    if not argv or (
-        not (set(argv) & {"-h", "--help"})
-        and argv[0] not in [choice for choice in commands_parser.choices]
+    if not unknown or (
+        not (set(unknown) & {"-h", "--help"})
+        and unknown[0] not in [choice for choice in commands_parser.choices]
         and find_repo_root(os.getcwd())
     ):
         logger.debug("defaulting to `submit`")
-        argv.insert(0, "submit")
-
-    main_args, unknown = main_parser.parse_known_args(argv)
+        unknown.insert(0, "submit")
 
     # map --version to the 'version' command
     if main_args.version:
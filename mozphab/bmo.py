@@ -2,14 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import json
+import time
 import urllib.parse
 
-from http.client import HTTPException, HTTPConnection, HTTPSConnection
+from http.client import HTTPException
 
-from mozphab import environment
 from .conduit import conduit
-from .exceptions import CommandError, Error
+from .connectionpool import connection_pool
+from .exceptions import Error
 from .logger import logger
+from .timings import timings
 
 DEFAULT_BMO_HOST = "https://bugzilla.mozilla.org"
 
@@ -29,30 +31,28 @@ class BMOAPI:
             urllib.parse.urljoin(bmo_url, "rest/{}".format(method))
         )
         logger.debug("BMO API call: %s", url.geturl())
-        if url.scheme == "https":
-            conn = HTTPSConnection(url.netloc, timeout=5)
-        elif environment.HTTP_ALLOWED:
-            # Allow for an HTTP connection in suite.
-            conn = HTTPConnection(url.netloc, timeout=5)
-        else:
-            raise CommandError("Only https connections are allowed.")
-
         sanitized_headers = headers.copy()
         if "X-PHABRICATOR-TOKEN" in headers:
             sanitized_headers["X-PHABRICATOR-TOKEN"] = "cli-XXXXXXXXXXXXXXXXXXXXXXXXXX"
 
         logger.debug("%s %s %s", conn_method, url.geturl(), sanitized_headers)
-        conn.request(conn_method, url.geturl(), headers=headers)
+        received = 0
+        start = time.monotonic()
         try:
-            response = conn.getresponse()
+            with connection_pool.request(
+                conn_method, url, headers=headers, timeout=5
+            ) as response:
+                data = response.read().decode("utf-8")
+                received = response.compressed_bytes
         except HTTPException as err:
-            logger.debug("BMO API HTTPException - %", err.strerror)
+            logger.debug("BMO API HTTPException - %s", err)
             raise BMOAPIError(str(err))
         except OSError as err:
-            logger.debug("BMO API OSError - %", err.strerror)
+            logger.debug("BMO API OSError - %s", err.strerror)
             raise BMOAPIError(str(err))
+        finally:
+            timings.record("bmo", method, time.monotonic() - start, received=received)
 
-        data = response.read().decode("utf-8")
         try:
             response = json.loads(data)
         except json.JSONDecodeError:
@@ -0,0 +1,140 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import json
+import threading
+import time
+
+from collections import deque
+
+from .exceptions import Error
+from .jsonstream import Base64Data, LazyList
+from .logger import logger
+
+CASSETTE_VERSION = 1
+
+# Arguments never stored in a cassette.
+SECRET_KEYS = {"token", "__conduit__"}
+
+
+def plain(value):
+    """Return the API call arguments as plain JSON values.
+
+    Secrets are scrubbed, binary data is replaced by its hash and length.
+    """
+    if isinstance(value, dict):
+        return {
+            key: "<scrubbed>" if key in SECRET_KEYS else plain(item)
+            for key, item in value.items()
+        }
+
+    if isinstance(value, (list, tuple, LazyList)):
+        return [plain(item) for item in value]
+
+    if isinstance(value, Base64Data):
+        return {
+            "sha256": hashlib.sha256(value.data).hexdigest(),
+            "length": len(value),
+        }
+
+    return value
+
+
+def _key(api_method, params):
+    return api_method, json.dumps(params, sort_keys=True)
+
+
+class Cassette:
+    """Conduit API calls recorded to, or replayed from a JSON file.
+
+    A recorded interaction holds the method, the arguments, the whole
+    response and the latency of the call. When replayed, a call is answered
+    by the first unused interaction with the same method and arguments, or
+    by the next unused one of the method if the arguments differ (i.e. a
+    timestamp). The recorded latency is waited for, divided by `speed`.
+    No delay is made if `speed` is 0.
+    """
+
+    def __init__(self, path, replay=False, speed=1.0):
+        self.path = path
+        self.replaying = replay
+        self.speed = speed
+        self.interactions = []
+        self._lock = threading.Lock()
+        self._by_key = {}
+        self._by_method = {}
+        self._used = set()
+        if replay:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise Error("Failed to read the cassette %s: %s" % (self.path, e))
+
+        if data.get("version") != CASSETTE_VERSION:
+            raise Error("Unsupported cassette version in %s" % self.path)
+
+        self.interactions = data["interactions"]
+        for index, interaction in enumerate(self.interactions):
+            method = interaction["method"]
+            self._by_key.setdefault(
+                _key(method, interaction["params"]), deque()
+            ).append(index)
+            self._by_method.setdefault(method, deque()).append(index)
+
+    def record(self, api_method, api_call_args, response, latency):
+        with self._lock:
+            self.interactions.append(
+                dict(
+                    method=api_method,
+                    params=plain(api_call_args),
+                    response=response,
+                    latency=latency,
+                )
+            )
+
+    def _next(self, queue):
+        while queue and queue[0] in self._used:
+            queue.popleft()
+
+        return queue.popleft() if queue else None
+
+    def play(self, api_method, api_call_args):
+        """Return the recorded response of the API call."""
+        key = _key(api_method, plain(api_call_args))
+        with self._lock:
+            index = self._next(self._by_key.get(key, deque()))
+            if index is None:
+                index = self._next(self._by_method.get(api_method, deque()))
+                if index is None:
+                    raise Error("No recorded response of %s left" % api_method)
+
+                logger.debug("%s replayed with different arguments", api_method)
+
+            self._used.add(index)
+
+        interaction = self.interactions[index]
+        if self.speed:
+            time.sleep(interaction["latency"] / self.speed)
+
+        return interaction["response"]
+
+    def save(self):
+        """Write the recorded interactions to the file."""
+        if self.replaying:
+            return
+
+        with self._lock:
+            data = dict(version=CASSETTE_VERSION, interactions=self.interactions)
+
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+
+        logger.debug(
+            "%s Conduit calls saved to %s", len(data["interactions"]), self.path
+        )
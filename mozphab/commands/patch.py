@@ -9,7 +9,12 @@ import subprocess
 from mozphab.conduit import conduit
 from mozphab.config import config
 from mozphab.exceptions import Error, NonLinearException, NotFoundError
-from mozphab.helpers import prepare_body, prompt, short_node
+from mozphab.helpers import (
+    prepare_body,
+    prompt,
+    short_node,
+    temporary_binary_file,
+)
 from mozphab.logger import logger
 from mozphab.mercurial import Mercurial
 from mozphab.patch import apply_patch
@@ -74,16 +79,47 @@ def patch(repo, args):
     revision = revs[0]
 
     if not args.skip_dependencies:
-        with wait_message("Fetching D%s children.." % args.revision_id):
+        with wait_message("Fetching D%s stack.." % args.revision_id):
+            graph = conduit.get_stack_graph([revision["phid"]])
+
+        non_linear = False
+        if graph.is_linear:
+            stack = graph.ordered(revision["phid"])
+            index = stack.index(revision["phid"])
+            phids = stack[:index]
+            children = stack[index + 1 :]
+        else:
             try:
-                children = conduit.get_successor_phids(
-                    revision["phid"], include_abandoned=args.include_abandoned
+                phids = list(reversed(graph.ancestors(revision["phid"])))
+            except NonLinearException:
+                raise Error(
+                    "Non linear dependency detected. Unable to patch the stack."
                 )
-                non_linear = False
+
+            try:
+                children = graph.successors(revision["phid"])
             except NonLinearException:
                 children = []
                 non_linear = True
 
+        # Pull revisions data
+        related = {}
+        if phids or children:
+            with wait_message("Fetching related revisions.."):
+                related = {
+                    r["phid"]: r for r in conduit.get_revisions(phids=phids + children)
+                }
+
+        def is_active(phid):
+            return related[phid]["fields"]["status"]["value"] != "abandoned"
+
+        ancestors = [related[p] for p in phids if p in related and is_active(p)]
+        children = [
+            related[p]
+            for p in children
+            if p in related and (args.include_abandoned or is_active(p))
+        ]
+
         patch_children = True
         if children:
             if args.yes or config.always_full_stack:
@@ -115,22 +151,9 @@ def patch(repo, args):
                     if res == "No":
                         return
 
-        # Get list of PHIDs in the stack
-        try:
-            with wait_message("Fetching D%s parents.." % args.revision_id):
-                phids = conduit.get_ancestor_phids(revision["phid"])
-        except NonLinearException:
-            raise Error("Non linear dependency detected. Unable to patch the stack.")
-
-        # Pull revisions data
-        if phids:
-            with wait_message("Fetching related revisions.."):
-                revs.extend(conduit.get_revisions(phids=phids))
-            revs.reverse()
-
-        if children and patch_children:
-            with wait_message("Fetching related revisions.."):
-                revs.extend(conduit.get_revisions(phids=children))
+        revs = ancestors + revs
+        if patch_children:
+            revs.extend(children)
 
     # Set the target id
     rev_id = revs[-1]["id"]
@@ -199,28 +222,35 @@ def patch(repo, args):
         )
         parent = rev["id"]
         diff = diffs[rev["fields"]["diffPHID"]]
-        with wait_message("Downloading D%s.." % rev["id"]):
-            raw = conduit.call("differential.getrawdiff", {"diffID": diff["id"]})
-
-        if args.no_commit:
-            with wait_message("Applying D%s.." % rev["id"]):
-                apply_patch(raw, repo.path)
+        # The diff is stored as a binary file to ensure the correct line endings
+        # are used.
+        with temporary_binary_file(b"") as diff_file:
+            with wait_message("Downloading D%s.." % rev["id"]):
+                with open(diff_file, "wb") as f:
+                    conduit.get_raw_diff(diff["id"], f)
+
+            if args.no_commit:
+                with wait_message("Applying D%s.." % rev["id"]):
+                    apply_patch(diff_file, repo.path)
 
-        elif args.raw:
-            logger.info(raw)
+            elif args.raw:
+                with open(diff_file, encoding="utf-8", newline="") as f:
+                    logger.info(f.read())
 
-        else:
-            diff_commits = diff["attachments"]["commits"]["commits"]
-            author = "%s <%s>" % (
-                diff_commits[0]["author"]["name"],
-                diff_commits[0]["author"]["email"],
-            )
+            else:
+                diff_commits = diff["attachments"]["commits"]["commits"]
+                author = "%s <%s>" % (
+                    diff_commits[0]["author"]["name"],
+                    diff_commits[0]["author"]["email"],
+                )
 
-            try:
-                with wait_message("Applying D%s.." % rev["id"]):
-                    repo.apply_patch(raw, body, author, diff["fields"]["dateCreated"])
-            except subprocess.CalledProcessError:
-                raise Error("Patch failed to apply")
+                try:
+                    with wait_message("Applying D%s.." % rev["id"]):
+                        repo.apply_patch(
+                            diff_file, body, author, diff["fields"]["dateCreated"]
+                        )
+                except subprocess.CalledProcessError:
+                    raise Error("Patch failed to apply")
 
         if not args.raw and rev["id"] != revs[-1]["id"]:
             logger.info("D%s applied", rev["id"])
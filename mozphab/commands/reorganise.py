@@ -245,8 +245,28 @@ def reorganise(repo, args):
     telemetry.metrics.mozphab.submission.process_time.start()
 
     with wait_message("Applying transactions..."):
+        # Edits which don't change the parents or the children of revisions
+        # (i.e. abandoning) are sent concurrently, each revision is edited
+        # once. Edits of the stack's edges depend on each other and are
+        # applied afterwards, in order.
+        def is_linking(rev_transactions):
+            return any(
+                t["type"].startswith(("parents.", "children."))
+                for t in rev_transactions
+            )
+
+        conduit.gather(
+            [
+                conduit.submit(
+                    conduit.edit_revision, rev_id=phid, transactions=rev_transactions
+                )
+                for phid, rev_transactions in transactions.items()
+                if not is_linking(rev_transactions)
+            ]
+        )
         for phid, rev_transactions in transactions.items():
-            conduit.edit_revision(rev_id=phid, transactions=rev_transactions)
+            if is_linking(rev_transactions):
+                conduit.edit_revision(rev_id=phid, transactions=rev_transactions)
 
     telemetry.metrics.mozphab.submission.process_time.stop()
     logger.info("Stack has been reorganised.")
@@ -6,7 +6,7 @@ import re
 
 from mozphab import arcanist, environment
 
-from mozphab.conduit import conduit
+from mozphab.conduit import RevisionEdit, conduit
 from mozphab.config import config
 from mozphab.exceptions import Error
 from mozphab.helpers import (
@@ -123,7 +123,7 @@ def show_commit_stack(
         ids = [int(c["rev-id"]) for c in commits if c.get("rev-id")]
         if ids:
             with wait_message("Loading existing revisions..."):
-                conduit.get_revisions(ids=ids)
+                conduit.get_revisions(ids=ids, attachments=["reviewers"])
 
     for commit in reversed(commits):
         closed = False
@@ -371,6 +371,16 @@ def submit(repo, args):
         augment_commits_from_body(commits)
         update_commits_from_args(commits, args)
 
+    # Load the revisions and reviewers while looking for untracked files.
+    # The revision IDs and the reviewers are known only after the commits are
+    # parsed, and looking for untracked files is the remaining local work,
+    # which takes seconds in large repositories.
+    prefetching = conduit.prefetch(commits, reviewers=not args.wip)
+    untracked = repo.untracked() if config.warn_untracked else []
+    if prefetching:
+        with wait_message("Loading revisions and reviewers.."):
+            prefetching.result()
+
     # Validate commit stack is suitable for review.
     show_commit_stack(commits, validate=True, ignore_reviewers=args.wip)
     try:
@@ -384,17 +394,15 @@ def submit(repo, args):
         logger.error("Ignoring issues found with commits:\n\n%s", e)
 
     # Show a warning if there are untracked files.
-    if config.warn_untracked:
-        untracked = repo.untracked()
-        if untracked:
-            logger.warning(
-                "Warning: found %s untracked file%s (will not be submitted):",
-                len(untracked),
-                "" if len(untracked) == 1 else "s",
-            )
-            if len(untracked) <= 5:
-                for filename in untracked:
-                    logger.info("  %s", filename)
+    if untracked:
+        logger.warning(
+            "Warning: found %s untracked file%s (will not be submitted):",
+            len(untracked),
+            "" if len(untracked) == 1 else "s",
+        )
+        if len(untracked) <= 5:
+            for filename in untracked:
+                logger.info("  %s", filename)
 
     # Show a warning if -m is used and there are new commits.
     if args.message and any([c for c in commits if not c["rev-id"]]):
@@ -432,10 +440,16 @@ def submit(repo, args):
     revisions_to_update = None
     if rev_ids_to_update:
         with wait_message("Loading revision data..."):
-            list_to_update = conduit.get_revisions(ids=rev_ids_to_update)
+            # The revisions are edited, a cached state could be outdated.
+            list_to_update = conduit.get_revisions(
+                ids=rev_ids_to_update, attachments=["reviewers"], fresh=True
+            )
 
         revisions_to_update = {str(r["id"]): r for r in list_to_update}
 
+    if args.no_arc:
+        repo.prepare_diffs(commits)
+
     for commit in commits:
         # Only revisions being updated have an ID.  Newly created ones don't.
         is_update = bool(commit["rev-id"])
@@ -458,6 +472,7 @@ def submit(repo, args):
             logger.info("\nCreating new revision:")
 
         logger.info("%s %s", commit["name"], commit["title-preview"])
+        repo.prepare_commit(commit, commits)
         repo.checkout(commit["node"])
 
         # WIP submissions shouldn't set reviewers on phabricator.
@@ -499,14 +514,16 @@ def submit(repo, args):
 
             if is_update:
                 with wait_message("Updating revision..."):
-                    rev = conduit.update_revision(
+                    conduit.update_revision(
                         commit,
                         has_commit_reviewers,
                         existing_reviewers,
                         diff_phid=diff_phid,
                         wip=args.wip,
                         comment=args.message,
+                        revision=revision_to_update,
                     )
+                rev_id = commit["rev-id"]
             else:
                 with wait_message("Creating a new revision..."):
                     rev = conduit.create_revision(
@@ -517,8 +534,9 @@ def submit(repo, args):
                         has_commit_reviewers,
                         wip=args.wip,
                     )
+                rev_id = rev["object"]["id"]
 
-            revision_url = "%s/D%s" % (repo.phab_url, rev["object"]["id"])
+            revision_url = "%s/D%s" % (repo.phab_url, rev_id)
 
         else:
             # Run arc.
@@ -553,27 +571,38 @@ def submit(repo, args):
             if not revision_url:
                 raise Error("Failed to find 'Revision URL' in arc output")
 
+            # The revision has been changed by arc, cached data is outdated.
+            if is_update:
+                conduit.invalidate_revision(revision_to_update["phid"])
+            else:
+                conduit.invalidate_revision_id(revision_url.rsplit("/D", 1)[-1])
+                if previous_commit:
+                    # A child has been added to the previous revision.
+                    conduit.invalidate_revision_id(previous_commit["rev-id"])
+
             if is_update:
                 current_status = revision_to_update["fields"]["status"]["value"]
                 with wait_message("Updating D%s.." % commit["rev-id"]):
-                    transactions = []
-                    revision = conduit.get_revisions(ids=[int(commit["rev-id"])])[0]
+                    # The revision loaded before running arc is reused.
+                    edit = RevisionEdit(revision_to_update, rev_id=commit["rev-id"])
 
-                    update_revision_description(transactions, commit, revision)
-                    update_revision_bug_id(transactions, commit, revision)
+                    update_revision_description(edit, commit, revision_to_update)
+                    update_revision_bug_id(edit, commit, revision_to_update)
 
                     # Add reviewers only if revision lacks them
                     if not args.wip and has_commit_reviewers and not existing_reviewers:
-                        conduit.update_revision_reviewers(transactions, commit)
+                        conduit.update_revision_reviewers(edit, commit)
                         if current_status != "needs-review":
-                            transactions.append(dict(type="request-review"))
+                            edit.add("request-review")
 
-                    if transactions:
+                    if edit and conduit.has_api_token():
+                        conduit.apply_edit(edit)
+                    elif edit:
                         arcanist.call_conduit(
                             "differential.revision.edit",
                             {
                                 "objectIdentifier": "D%s" % commit["rev-id"],
-                                "transactions": transactions,
+                                "transactions": edit.transactions,
                             },
                             repo.path,
                         )
@@ -2,21 +2,29 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import base64
 import datetime
 import hashlib
+import io
 import json
 import os
+import random
+import re
+import threading
+import time
 import urllib.parse
 
-from http.client import HTTPConnection, HTTPSConnection
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from http.client import HTTPException
 
 from mozphab import environment
 
+from .config import config
+from .connectionpool import connection_pool
 from .exceptions import (
     CommandError,
     Error,
-    NonLinearException,
     NotFoundError,
 )
 from .helpers import (
@@ -24,8 +32,11 @@ from .helpers import (
     read_json_field,
     strip_differential_revision,
 )
+from .jsonstream import Base64Data, LazyList, multipart_body, stream_result
 from .logger import logger
-from .simplecache import cache
+from .simplecache import cache, persistent_cache
+from .stackgraph import StackGraph
+from .timings import timings
 
 
 def normalise_reviewer(reviewer, strip_group=True):
@@ -36,21 +47,173 @@ def normalise_reviewer(reviewer, strip_group=True):
     return reviewer
 
 
+# Number of seconds revisions stored in the persistent cache are used without
+# checking if they were modified in Phabricator.
+REVISION_REFRESH_INTERVAL = 5 * 60
+
+# Number of seconds subtracted from the last sync time to cover a difference
+# between the local and the Phabricator clocks.
+REVISION_REFRESH_MARGIN = 60
+
+# Maximum number of ids or PHIDs in a single `*.search` query. Longer
+# constraint lists are split and queried concurrently.
+SEARCH_CHUNK_SIZE = 100
+
+# Number of seconds file PHIDs stored in the persistent cache are used without
+# checking if the files still exist in Phabricator.
+FILE_REFRESH_INTERVAL = 24 * 60 * 60
+
+# Read-only API methods which are safe to be sent more than once.
+IDEMPOTENT_METHODS = re.compile(
+    r"(\.search|^user\.query|^user\.whoami|^conduit\.ping|^differential\.getrawdiff)$"
+)
+
+# Errors after which an idempotent API call is retried. `ValueError` is raised
+# if the response is not a valid JSON (i.e. an error page of a proxy).
+RETRY_ERRORS = (OSError, HTTPException, ValueError)
+
+# Number of seconds the back-off before a retry is based on. The actual
+# back-off is random between 0 and `RETRY_BACKOFF * 2 ** attempt`.
+RETRY_BACKOFF = 0.5
+
+# Latencies of an API method needed before its calls are hedged.
+HEDGE_MIN_SAMPLES = 10
+
+# Number of latencies kept for each API method.
+LATENCY_SAMPLES = 100
+
+
 class ConduitAPIError(Error):
     """Raised when the Phabricator Conduit API returns an error response."""
 
 
+class RevisionEdit:
+    """Transactions of a revision collected to be sent at once.
+
+    Behaves like the list of transactions, so it might be extended by the
+    helpers building them. Appended transactions are kept as given, a field
+    set with `add` replaces its previous transaction. Fields set to the value
+    the loaded `revision` already has are skipped. Sent by
+    `ConduitAPI.apply_edit`.
+    """
+
+    def __init__(self, revision=None, rev_id=None):
+        self.revision = revision
+        self.rev_id = rev_id if rev_id is not None or not revision else revision["id"]
+        self.transactions = []
+
+    def __iter__(self):
+        return iter(self.transactions)
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def has(self, kind):
+        return any(t["type"] == kind for t in self.transactions)
+
+    def add(self, kind, value=None):
+        """Set the field, replacing the previous transaction of the type."""
+        self.transactions = [t for t in self.transactions if t["type"] != kind]
+        self.transactions.append(
+            dict(type=kind) if value is None else dict(type=kind, value=value)
+        )
+
+    def append(self, transaction):
+        self.transactions.append(transaction)
+
+    def extend(self, transactions):
+        self.transactions.extend(transactions)
+
+    def set_field(self, kind, value):
+        """Add the transaction unless the revision field has the value already."""
+        fields = self.revision["fields"] if self.revision else {}
+        if kind not in fields or fields[kind] != value:
+            self.add(kind, value)
+
+
 class ConduitAPI:
-    def __init__(self):
+    def __init__(self, max_in_flight=None):
         self.repo = None
+        self.max_in_flight = (
+            config.max_in_flight if max_in_flight is None else max_in_flight
+        )
+        self._executor = None
+        self._hedge_executor = None
+        self._upload_executor = None
+        self._local = threading.local()
+        self.timeout = config.network_timeout or None
+        self.retries = config.read_retries
+        self.hedge_percentile = config.hedge_percentile
+        self.deadline = None
+        self._latencies = {}
+        self._latencies_lock = threading.Lock()
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self.cassette = None
 
     def set_repo(self, repo):
         self.repo = repo
 
+    def set_cassette(self, cassette):
+        """Record the API calls to, or replay them from the `Cassette`."""
+        self.cassette = cassette
+
+    def set_deadline(self, seconds):
+        """Stop sending API calls after `seconds` from now.
+
+        No deadline is set if `seconds` is 0 or None.
+        """
+        self.deadline = time.monotonic() + seconds if seconds else None
+
+    def _get_timeout(self):
+        """Return the socket timeout for the next API call.
+
+        Raises:
+            ConduitAPIError if the deadline has passed.
+        """
+        if self.deadline is None:
+            return self.timeout
+
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise ConduitAPIError("The deadline of the command has passed.")
+
+        return remaining if self.timeout is None else min(self.timeout, remaining)
+
     @property
     def repo_phid(self):
         return self.repo.phid
 
+    def get_cached(self, namespace, key):
+        """Return a cached value or None.
+
+        Values are looked up in the process cache first and then in the
+        persistent cache of the repository's Phabricator instance.
+        """
+        if key in cache:
+            return cache.get(key)
+
+        if self.repo is None:
+            return None
+
+        value = persistent_cache.get(self.repo.api_url, namespace, key)
+        if value is not None:
+            cache.set(key, value)
+
+        return value
+
+    def set_cached(self, namespace, key, value):
+        """Store the value in the process and the persistent cache."""
+        cache.set(key, value)
+        if self.repo is not None:
+            persistent_cache.set(self.repo.api_url, namespace, key, value)
+
+    def delete_cached(self, namespace, key):
+        """Remove the value from the process and the persistent cache."""
+        cache.delete(key)
+        if self.repo is not None:
+            persistent_cache.delete(self.repo.api_url, namespace, key)
+
     def load_api_token(self):
         """Return an API Token for the given repository.
 
@@ -64,6 +227,14 @@ class ConduitAPI:
             raise ConduitAPIError(environment.INSTALL_CERT_MSG)
         return token
 
+    def has_api_token(self):
+        """Return True if an API Token is stored for the repository."""
+        try:
+            self.load_api_token()
+        except ConduitAPIError:
+            return False
+        return True
+
     def save_api_token(self, token):
         filename = get_arcrc_path()
         created = False
@@ -84,24 +255,29 @@ class ConduitAPI:
         if created:
             os.chmod(filename, 0o600)
 
-    def call(self, api_method, api_call_args):
-        """Call Conduit API and return the JSON API call result.
+    def _request_body(self, api_method, api_call_args):
+        """Return the URL, the body and the headers of an API call.
 
-        Args:
-            api_method: The API method name to call, like 'differential.revision.edit'.
-            api_call_args: JSON dict of call args to send.
-
-        Returns:
-            JSON API call result object
-
-        Raises:
-            ConduitAPIError if the API threw an error back at us.
+        Calls with a `LazyList` or `Base64Data` argument (like
+        `differential.creatediff` or `file.uploadchunk`) are sent as
+        a multipart/form-data body serialized in chunks to a spooled temporary
+        file. Other calls are form encoded.
         """
         url = urllib.parse.urlparse(urllib.parse.urljoin(self.repo.api_url, api_method))
         logger.debug("%s %s", url.geturl(), api_call_args)
 
         api_call_args = api_call_args.copy()
         api_call_args["__conduit__"] = {"token": self.load_api_token()}
+        if any(
+            isinstance(value, (LazyList, Base64Data))
+            for value in api_call_args.values()
+        ):
+            body, length, content_type = multipart_body(
+                {"params": api_call_args, "output": "json", "__conduit__": "True"}
+            )
+            headers = {"Content-Type": content_type, "Content-Length": str(length)}
+            return url, body, headers
+
         body = urllib.parse.urlencode(
             {
                 "params": json.dumps(api_call_args),
@@ -109,26 +285,437 @@ class ConduitAPI:
                 "__conduit__": True,
             }
         )
-        # Send the POST request
-        if url.scheme == "https":
-            conn = HTTPSConnection(url.netloc)
-        elif environment.HTTP_ALLOWED:
-            # Allow for an HTTP connection in suite.
-            conn = HTTPConnection(url.netloc)
-        else:
-            raise CommandError("Only https connections are allowed.")
+        return url, body, {}
 
-        conn.request("POST", url.geturl(), body=body)
+    @contextmanager
+    def _post(self, api_method, api_call_args):
+        """Send the API call and yield the HTTP response.
 
-        # Read the response as JSON
-        response = json.loads(conn.getresponse().read().decode("utf-8"))
+        The time spent and the bytes transferred are recorded in `timings`.
+        """
+        url, body, headers = self._request_body(api_method, api_call_args)
+        sent = len(body) if isinstance(body, str) else int(headers["Content-Length"])
+        received = 0
+        start = time.monotonic()
+        try:
+            with connection_pool.request(
+                "POST",
+                url,
+                body=body,
+                headers=headers,
+                timeout=self._get_timeout(),
+                idempotent=bool(IDEMPOTENT_METHODS.search(api_method)),
+            ) as response:
+                try:
+                    yield response
+                finally:
+                    received = response.compressed_bytes
+        finally:
+            timings.record(
+                "conduit",
+                api_method,
+                time.monotonic() - start,
+                sent=sent,
+                received=received,
+            )
+            if not isinstance(body, str):
+                body.close()
+
+    @staticmethod
+    def _check_response(response):
         if response["error_code"]:
             raise ConduitAPIError(
                 response.get("error_info", "Error %s" % response["error_code"])
             )
 
+    def call(self, api_method, api_call_args):
+        """Call Conduit API and return the JSON API call result.
+
+        Args:
+            api_method: The API method name to call, like 'differential.revision.edit'.
+            api_call_args: JSON dict of call args to send.
+
+        Read-only methods (see `IDEMPOTENT_METHODS`) are retried after network
+        errors and might be hedged (see `_hedged_call`). Concurrent identical
+        read-only calls share a single request (see `_single_flight`).
+
+        Returns:
+            JSON API call result object
+
+        Raises:
+            ConduitAPIError if the API threw an error back at us.
+        """
+        if IDEMPOTENT_METHODS.search(api_method):
+            key = (
+                "call",
+                api_method,
+                json.dumps(api_call_args, sort_keys=True, default=str),
+            )
+            return self._single_flight(
+                [key],
+                lambda _keys: {
+                    key: self._retry(
+                        api_method, self._hedged_call, api_method, api_call_args
+                    )
+                },
+            )[key]
+
+        return self._call(api_method, api_call_args)
+
+    def _single_flight(self, keys, fetch):
+        """Fetch values of the keys, sharing pending requests between threads.
+
+        Keys which are already being fetched by another thread are not fetched
+        again, their pending results are waited for instead. The remaining keys
+        are passed to a single `fetch(keys)` call.
+
+        Args:
+            keys: a list of hashable keys
+            fetch: a function returning a dict of the found values keyed by key
+
+        Returns a dict of values keyed by key, None if a value was not found.
+        """
+        owned = []
+        pending = {}
+        with self._in_flight_lock:
+            for key in keys:
+                if key in pending or key in owned:
+                    continue
+
+                if key in self._in_flight:
+                    pending[key] = self._in_flight[key]
+                else:
+                    self._in_flight[key] = Future()
+                    owned.append(key)
+
+        results = {}
+        try:
+            if owned:
+                results = fetch(owned)
+        except BaseException as e:
+            for key in owned:
+                self._in_flight[key].set_exception(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                futures = [self._in_flight.pop(key) for key in owned]
+
+            for key, future in zip(owned, futures):
+                if not future.done():
+                    future.set_result(results.get(key))
+
+        for key, future in pending.items():
+            results[key] = future.result()
+
+        return {key: results.get(key) for key in keys}
+
+    def _play(self, api_method, api_call_args):
+        """Return the response replayed by the cassette."""
+        start = time.monotonic()
+        try:
+            return self.cassette.play(api_method, api_call_args)
+        finally:
+            timings.record("conduit", api_method, time.monotonic() - start)
+
+    def _call(self, api_method, api_call_args):
+        if self.cassette is not None and self.cassette.replaying:
+            response = self._play(api_method, api_call_args)
+            self._check_response(response)
+            return response["result"]
+
+        start = time.monotonic()
+        # Send the POST request
+        with self._post(api_method, api_call_args) as response:
+            response = json.load(response)
+
+        latency = time.monotonic() - start
+        self._record_latency(api_method, latency)
+        if self.cassette is not None:
+            self.cassette.record(api_method, api_call_args, response, latency)
+        self._check_response(response)
         return response["result"]
 
+    def call_to_file(self, api_method, api_call_args, fileobj):
+        """Call Conduit API and write the string result to a binary file.
+
+        The result is streamed from the socket to the file, it's never kept
+        in memory as a whole.
+
+        Raises:
+            ConduitAPIError if the API threw an error back at us.
+        """
+
+        def call():
+            if self.cassette is not None and self.cassette.replaying:
+                result = self._play(api_method, api_call_args)
+                self._check_response(result)
+                fileobj.write(result["result"].encode("utf-8"))
+                return
+
+            start = time.monotonic()
+            # The result is kept in memory only to be recorded.
+            target = fileobj if self.cassette is None else io.BytesIO()
+            with self._post(api_method, api_call_args) as response:
+                result = stream_result(response, target)
+
+            if self.cassette is not None:
+                data = target.getvalue()
+                fileobj.write(data)
+                self.cassette.record(
+                    api_method,
+                    api_call_args,
+                    dict(result, result=data.decode("utf-8")),
+                    time.monotonic() - start,
+                )
+            self._check_response(result)
+
+        def rewind():
+            fileobj.seek(0)
+            fileobj.truncate()
+
+        if IDEMPOTENT_METHODS.search(api_method):
+            self._retry(api_method, call, before_retry=rewind)
+        else:
+            call()
+
+    def _retry(self, api_method, func, *args, before_retry=None):
+        """Call `func(*args)`, retry with a random back-off if it fails.
+
+        Only network errors and invalid responses are retried. No retry is
+        made if the back-off would exceed the deadline.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except RETRY_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+
+                attempt += 1
+                backoff = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+                if (
+                    self.deadline is not None
+                    and time.monotonic() + backoff >= self.deadline
+                ):
+                    raise
+
+                logger.debug(
+                    "%s failed (%s), retry %s in %.2fs", api_method, e, attempt, backoff
+                )
+                time.sleep(backoff)
+                if before_retry is not None:
+                    before_retry()
+
+    def _record_latency(self, api_method, latency):
+        with self._latencies_lock:
+            self._latencies.setdefault(
+                api_method, deque(maxlen=LATENCY_SAMPLES)
+            ).append(latency)
+
+    def _hedge_delay(self, api_method):
+        """Return the latency after which the call is sent again or None."""
+        if not self.hedge_percentile:
+            return None
+
+        with self._latencies_lock:
+            latencies = sorted(self._latencies.get(api_method, []))
+
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+
+        index = int(len(latencies) * self.hedge_percentile / 100)
+        return latencies[min(index, len(latencies) - 1)]
+
+    @property
+    def hedge_executor(self):
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(
+                max_workers=2 * max(self.max_in_flight, 1),
+                thread_name_prefix="conduit-hedge",
+            )
+        return self._hedge_executor
+
+    @property
+    def upload_executor(self):
+        if self._upload_executor is None:
+            self._upload_executor = ThreadPoolExecutor(
+                max_workers=max(self.max_in_flight, 1),
+                thread_name_prefix="conduit-upload",
+            )
+        return self._upload_executor
+
+    def _hedged_call(self, api_method, api_call_args):
+        """Call the API, send it again if the response is slow.
+
+        The second request is sent once the call takes longer than
+        `hedge_percentile` of the method's previous latencies. The first
+        successful response is returned.
+        """
+        delay = self._hedge_delay(api_method)
+        if delay is None:
+            return self._call(api_method, api_call_args)
+
+        first = self.hedge_executor.submit(self._call, api_method, api_call_args)
+        done, _pending = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        logger.debug("%s is slower than %.2fs, hedging", api_method, delay)
+        pending = {
+            first,
+            self.hedge_executor.submit(self._call, api_method, api_call_args),
+        }
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    return future.result()
+
+    def get_raw_diff(self, diff_id, fileobj):
+        """Write the raw diff to a binary file."""
+        self.call_to_file("differential.getrawdiff", {"diffID": diff_id}, fileobj)
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_in_flight, thread_name_prefix="conduit"
+            )
+        return self._executor
+
+    def _run_in_worker(self, func, *args, **kwargs):
+        self._local.in_worker = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._local.in_worker = False
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule `func(*args, **kwargs)` to run in the thread pool.
+
+        The function is called immediately if concurrency is switched off or
+        if it's called from within the thread pool (to avoid a deadlock).
+
+        Returns:
+            A `concurrent.futures.Future` of the result.
+        """
+        if self.max_in_flight > 1 and not getattr(self._local, "in_worker", False):
+            return self.executor.submit(self._run_in_worker, func, *args, **kwargs)
+
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def call_async(self, api_method, api_call_args):
+        """Schedule a Conduit API call and return its Future."""
+        return self.submit(self.call, api_method, api_call_args)
+
+    @staticmethod
+    def gather(futures):
+        """Wait for all the futures to finish.
+
+        Returns:
+            A list of results in the order of provided futures.
+
+        Raises:
+            The error if only one of the futures failed, or a ConduitAPIError
+            with all messages if multiple API calls failed.
+        """
+        results = []
+        errors = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(e)
+
+        if len(errors) == 1 or (
+            errors and not all(isinstance(e, ConduitAPIError) for e in errors)
+        ):
+            raise errors[0]
+
+        if errors:
+            raise ConduitAPIError("\n".join(str(e) for e in errors))
+
+        return results
+
+    def call_many(self, calls):
+        """Call Conduit API concurrently.
+
+        Args:
+            calls: A list of `(api_method, api_call_args)` tuples.
+
+        Returns:
+            A list of JSON API call results in the order of `calls`.
+        """
+        return self.gather(
+            [self.call_async(api_method, args) for api_method, args in calls]
+        )
+
+    def search(self, api_method, api_call_args, prefetch=False):
+        """Yield all results of a `*.search` API method.
+
+        See `search_pages` for the arguments.
+        """
+        for response in self.search_pages(api_method, api_call_args, prefetch):
+            yield from response.get("data", [])
+
+    def search_pages(self, api_method, api_call_args, prefetch=False):
+        """Yield all response pages of a `*.search` API method.
+
+        Pages are requested following the `cursor.after` value. If `prefetch`
+        is true the next page is requested while the current one is processed.
+        Constraint lists of `ids` or `phids` longer than `SEARCH_CHUNK_SIZE`
+        are split into chunks queried concurrently. Pages are yielded in the
+        order of the chunks.
+        """
+        constraints = api_call_args.get("constraints") or {}
+        for field in ("ids", "phids"):
+            values = list(constraints.get(field) or [])
+            if len(values) > SEARCH_CHUNK_SIZE:
+                break
+        else:
+            yield from self._search_pages(api_method, api_call_args, prefetch)
+            return
+
+        futures = []
+        for start in range(0, len(values), SEARCH_CHUNK_SIZE):
+            chunk_args = dict(
+                api_call_args,
+                constraints=dict(
+                    constraints, **{field: values[start : start + SEARCH_CHUNK_SIZE]}
+                ),
+            )
+            futures.append(
+                self.submit(
+                    lambda args: list(self._search_pages(api_method, args)), chunk_args,
+                )
+            )
+
+        for pages in self.gather(futures):
+            yield from pages
+
+    def _search_pages(self, api_method, api_call_args, prefetch=False):
+        response = self.call(api_method, api_call_args)
+        while True:
+            after = (response.get("cursor") or {}).get("after")
+            if not after:
+                yield response
+                return
+
+            next_args = dict(api_call_args, after=after)
+            if prefetch:
+                future = self.call_async(api_method, next_args)
+                yield response
+                response = future.result()
+            else:
+                yield response
+                response = self.call(api_method, next_args)
+
     def ping(self):
         """Sends a ping to the Phabricator server using `conduit.ping` API.
 
@@ -144,6 +731,75 @@ class ConduitAPI:
             return False
         return True
 
+    def preconnect(self):
+        """Open a connection to Phabricator in the background.
+
+        The connection is opened in a daemon thread, a pending one doesn't
+        keep the process running at exit.
+
+        Returns a Future, or None if concurrency is switched off.
+        """
+        if self.max_in_flight <= 1:
+            return None
+
+        future = Future()
+
+        def preconnect():
+            try:
+                connection_pool.preconnect(self.repo.api_url, timeout=self.timeout)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+
+        threading.Thread(
+            target=preconnect, name="conduit-preconnect", daemon=True
+        ).start()
+        return future
+
+    def prefetch(self, commits, reviewers=True):
+        """Load the data needed to validate the commits in the background.
+
+        Revisions, the current user and the reviewers named in the commits are
+        loaded in a single background task in the order they are looked up by
+        the validation, which then finds them in the cache or waits for the
+        pending requests. Errors are only logged, the actual lookups raise them.
+
+        Returns a Future, or None if concurrency is switched off.
+        """
+        if self.max_in_flight <= 1:
+            return None
+
+        ids = [int(c["rev-id"]) for c in commits if c.get("rev-id")]
+        names = set()
+        if reviewers:
+            for commit in commits:
+                for group in commit["reviewers"].values():
+                    for reviewer in group:
+                        names.add(normalise_reviewer(reviewer, strip_group=False))
+
+        users = sorted(name for name in names if not name.startswith("#"))
+        groups = sorted(name for name in names if name.startswith("#"))
+
+        def prefetch():
+            try:
+                if ids:
+                    revisions = self.get_revisions(ids=ids, attachments=["reviewers"])
+                    # `whoami` is needed only to check the authors of the
+                    # existing revisions.
+                    if revisions:
+                        self.whoami()
+
+                if users:
+                    self.get_users(users)
+
+                if groups:
+                    self.get_groups(groups)
+            except Exception as e:
+                logger.debug("Prefetching failed: %s", e)
+
+        return self.submit(prefetch)
+
     def check(self):
         """Check if raw Conduit API can be used."""
         # Check if the cache file exists
@@ -197,63 +853,145 @@ class ConduitAPI:
 
         raise NotFoundError("revision {} not found".format(phid))
 
-    def get_revisions(self, ids=None, phids=None):
+    def get_revisions(self, ids=None, phids=None, attachments=None, fresh=False):
         """Get revisions info from Phabricator.
 
+        Revisions stored in the persistent cache for longer than
+        `REVISION_REFRESH_INTERVAL` are refreshed with a single query for the
+        revisions modified since they were stored. Revisions not found are
+        not queried again by the process.
+
+        Revisions about to be edited are requested `fresh`, cached ones which
+        were not received from Phabricator by the process are refreshed then,
+        so the edit is not based on a stale state.
+
+        Attachments are requested only if needed. Cached revisions lacking
+        some of the requested attachments are queried for the missing ones.
+
         Args:
             ids - list of revision ids
             phids - list of revision phids
+            attachments - list of attachment names (i.e. "reviewers")
+            fresh - refresh revisions cached by previous runs if True
 
         Returns a list of revisions ordered by ids or phids
         """
         if (ids and phids) or (ids is None and phids is None):
             raise ValueError("Internal Error: Invalid args to get_revisions")
 
+        attachments = set(attachments or [])
+
         # Initialise depending on if we're passed revision IDs or PHIDs.
         if ids:
             ids = [str(rev_id) for rev_id in ids]
-            phids_by_id = dict(
-                [
-                    (rev_id, cache.get("rev-id-%s" % rev_id))
-                    for rev_id in ids
-                    if "rev-id-%s" % rev_id in cache
-                ]
-            )
-            found_phids = list(phids_by_id.values())
-            query_field = "ids"
-            query_values = [
-                int(rev_id) for rev_id in set(ids) - set(phids_by_id.keys())
-            ]
+            phids_by_id = {}
+            for rev_id in ids:
+                phid = self.get_cached("revisions", "rev-id-%s" % rev_id)
+                if phid is not None:
+                    phids_by_id[rev_id] = phid
 
+            query_field = "ids"
         else:
             phids_by_id = {}
-            found_phids = phids.copy()
             query_field = "phids"
-            query_values = set([phid for phid in phids if "rev-%s" % phid not in cache])
 
         # Revisions metadata keyed by PHID.
-        revisions = dict(
-            [
-                (phid, cache.get("rev-%s" % phid))
-                for phid in found_phids
-                if "rev-%s" % phid in cache
+        revisions = {}
+        # Revisions which need to be refreshed keyed by PHID.
+        stale = {}
+        for phid in phids_by_id.values() if ids else phids:
+            key = "rev-%s" % phid
+            if key in cache and (not fresh or "rev-synced-%s" % phid in cache):
+                revisions[phid] = cache.get(key)
+                continue
+
+            entry = (
+                persistent_cache.get_entry(self.repo.api_url, "revisions", key)
+                if self.repo is not None
+                else None
+            )
+            if entry is None:
+                continue
+
+            if not fresh and time.time() - entry[0] < REVISION_REFRESH_INTERVAL:
+                revisions[phid] = entry[1]
+                cache.set(key, entry[1])
+            else:
+                stale[phid] = entry
+
+        if stale:
+            revisions.update(self.refresh_revisions(stale))
+
+        # Attachments missing in the cached revisions.
+        missing = {}
+        for phid, revision in list(revisions.items()):
+            missing[phid] = attachments - self.revision_attachments(revision)
+            if missing[phid]:
+                del revisions[phid]
+
+        # Revisions not returned by Phabricator are not queried again.
+        if ids:
+            query_values = [
+                int(rev_id)
+                for rev_id in set(ids)
+                if phids_by_id.get(rev_id) not in revisions
+                and "rev-missing-%s" % rev_id not in cache
             ]
-        )
+            query_phids = [phids_by_id.get(str(rev_id)) for rev_id in query_values]
+        else:
+            query_values = set(
+                [
+                    phid
+                    for phid in phids
+                    if phid not in revisions and "rev-missing-%s" % phid not in cache
+                ]
+            )
+            query_phids = query_values
+
+        # Only the missing attachments are queried if all revisions are cached.
+        query_attachments = set()
+        for phid in query_phids:
+            query_attachments.update(missing.get(phid, attachments))
+        query_attachments = tuple(sorted(query_attachments))
 
         # Query Phabricator if we don't have cached values for revisions.
-        if query_values:
+        # Revisions already being queried by another thread are not queried
+        # again.
+        def fetch(keys):
             api_call_args = {
-                "constraints": {query_field: sorted(query_values)},
-                "attachments": {"reviewers": True},
+                "constraints": {query_field: sorted(key[2] for key in keys)},
             }
-            response = self.call("differential.revision.search", api_call_args)
-            rev_list = response.get("data")
+            if query_attachments:
+                api_call_args["attachments"] = {
+                    name: True for name in query_attachments
+                }
+
+            found = {}
+            for r in self.search("differential.revision.search", api_call_args):
+                self.store_revision(r, query_attachments)
+                value = r["id"] if query_field == "ids" else r["phid"]
+                found[("revisions", query_field, value, query_attachments)] = r
+
+            for key in keys:
+                if key not in found:
+                    cache.set("rev-missing-%s" % key[2], True)
 
-            for r in rev_list:
-                phids_by_id[str(r["id"])] = r["phid"]
-                revisions[r["phid"]] = r
-                cache.set("rev-id-%s" % r["id"], r["phid"])
-                cache.set("rev-%s" % r["phid"], r)
+            return found
+
+        if query_values:
+            fetched = self._single_flight(
+                [
+                    ("revisions", query_field, value, query_attachments)
+                    for value in query_values
+                ],
+                fetch,
+            )
+            for r in fetched.values():
+                if r is not None:
+                    phids_by_id[str(r["id"])] = r["phid"]
+                    revisions[r["phid"]] = self.get_cached(
+                        "revisions", "rev-%s" % r["phid"]
+                    )
 
         # Return revisions in the same order requested.
         if ids:
@@ -261,11 +999,86 @@ class ConduitAPI:
             return [
                 revisions[phids_by_id[rev_id]]
                 for rev_id in ids
-                if rev_id in phids_by_id
+                if phids_by_id.get(rev_id) in revisions
             ]
         else:
             return [revisions[phid] for phid in phids]
 
+    def revision_attachments(self, revision):
+        """Return a set of attachment names the cached revision has."""
+        names = self.get_cached("revisions", "rev-attachments-%s" % revision["phid"])
+        return set(names or []) | set(revision.get("attachments") or {})
+
+    def store_revision(self, revision, attachments):
+        """Cache the revision received with the attachments.
+
+        Attachments of the previously cached revision are kept.
+        """
+        phid = revision["phid"]
+        cached = self.get_cached("revisions", "rev-%s" % phid)
+        if cached is not None:
+            held = self.revision_attachments(cached) - set(attachments)
+            if held:
+                revision["attachments"] = dict(
+                    {
+                        name: value
+                        for name, value in (cached.get("attachments") or {}).items()
+                        if name in held
+                    },
+                    **(revision.get("attachments") or {})
+                )
+            attachments = held | set(attachments)
+
+        self.set_cached("revisions", "rev-id-%s" % revision["id"], phid)
+        self.set_cached("revisions", "rev-%s" % phid, revision)
+        self.set_cached("revisions", "rev-attachments-%s" % phid, sorted(attachments))
+        # The revision is current within the process.
+        cache.set("rev-synced-%s" % phid, True)
+
+    def refresh_revisions(self, stale):
+        """Refresh revisions stored in the persistent cache.
+
+        Only revisions modified since the oldest of them was stored are
+        returned by Phabricator. The other ones are stored again as current.
+        Modified revisions are received with the attachments the stored ones
+        have.
+
+        Args:
+            stale - dict of `(timestamp, revision)` pairs keyed by revision PHID
+
+        Returns a dict of refreshed revisions keyed by PHID.
+        """
+        since = int(min(synced for synced, _revision in stale.values()))
+        attachments = set()
+        for _synced, revision in stale.values():
+            attachments.update(self.revision_attachments(revision))
+
+        api_call_args = {
+            "constraints": {
+                "phids": sorted(stale.keys()),
+                "modifiedStart": since - REVISION_REFRESH_MARGIN,
+            },
+        }
+        if attachments:
+            api_call_args["attachments"] = {name: True for name in sorted(attachments)}
+
+        modified = {
+            r["phid"]: r
+            for r in self.search("differential.revision.search", api_call_args)
+        }
+        logger.debug("%s of %s cached revisions modified", len(modified), len(stale))
+
+        revisions = {}
+        for phid, (_synced, revision) in stale.items():
+            if phid in modified:
+                self.store_revision(modified[phid], attachments)
+            else:
+                self.store_revision(revision, self.revision_attachments(revision))
+
+            revisions[phid] = self.get_cached("revisions", "rev-%s" % phid)
+
+        return revisions
+
     def get_diffs(self, phids):
         """Get diffs from Phabricator.
 
@@ -278,11 +1091,8 @@ class ConduitAPI:
             "constraints": {"phids": phids},
             "attachments": {"commits": True},
         }
-        response = self.call("differential.diff.search", api_call_args)
-        diff_list = response.get("data", [])
-
         diff_dict = {}
-        for d in diff_list:
+        for d in self.search("differential.diff.search", api_call_args):
             diff_dict[d["phid"]] = d
 
         return diff_dict
@@ -299,19 +1109,11 @@ class ConduitAPI:
 
     def get_related_phids(self, base_phid, relation="parent", include_abandoned=False):
         """Returns the list of PHIDs with direct dependency"""
-        result = []
-
-        def _get_related(phid):
-            api_call_args = {"sourcePHIDs": [phid], "types": ["revision.%s" % relation]}
-            edge = self.call("edge.search", api_call_args)
-            if edge.get("data"):
-                if len(edge["data"]) > 1:
-                    raise NonLinearException()
-
-                result.append(edge["data"][0]["destinationPHID"])
-                _get_related(result[-1])
-
-        _get_related(base_phid)
+        graph = self.get_stack_graph([base_phid])
+        if relation == "parent":
+            result = graph.ancestors(base_phid)
+        else:
+            result = graph.successors(base_phid)
 
         if not result or include_abandoned:
             return result
@@ -323,44 +1125,72 @@ class ConduitAPI:
             if r["fields"]["status"]["value"] != "abandoned"
         ]
 
-    def get_stack(self, rev_ids):
-        """Returns a dict of PHIDs."""
-        phids = set()
-        if not rev_ids:
-            return {}
-        revisions = self.get_revisions(ids=rev_ids)
-        new_phids = set([rev["phid"] for rev in revisions])
-        stack = {}
+    def get_stack_graph(self, phids):
+        """Return a StackGraph of all revisions connected to the given ones.
+
+        Parent and child edges of all revisions found in the previous step are
+        searched at once, so resolving a stack takes a round trip per level.
+        Edges are memoized in the process cache.
+        """
+        graph = StackGraph()
+        searched = set()
+        new_phids = set(phids)
 
         while new_phids:
-            phids.update(new_phids)
-
-            edges = self.call(
-                "edge.search",
-                dict(
-                    sourcePHIDs=list(new_phids),
-                    types=["revision.parent", "revision.child"],
-                    limit=10000,
-                ),
-            )["data"]
+            searched.update(new_phids)
+
+            edges = []
+            to_search = []
+            for phid in new_phids:
+                key = "edges-%s" % phid
+                if key in cache:
+                    edges.extend(cache.get(key))
+                else:
+                    to_search.append(phid)
+
+            if to_search:
+                found = list(
+                    self.search(
+                        "edge.search",
+                        dict(
+                            sourcePHIDs=to_search,
+                            types=["revision.parent", "revision.child"],
+                            limit=10000,
+                        ),
+                    )
+                )
+                edges_by_source = {phid: [] for phid in to_search}
+                for edge in found:
+                    edges_by_source.setdefault(edge["sourcePHID"], []).append(edge)
+                for phid, source_edges in edges_by_source.items():
+                    cache.set("edges-%s" % phid, source_edges)
+
+                edges.extend(found)
 
             new_phids = set()
             for edge in edges:
+                graph.add_edge(edge)
                 new_phids.add(edge["sourcePHID"])
                 new_phids.add(edge["destinationPHID"])
 
-                if edge["edgeType"] == "revision.child":
-                    if edge["sourcePHID"] in stack:
-                        source_id = next(
-                            r["id"]
-                            for r in revisions
-                            if r["phid"] == edge["sourcePHID"]
-                        )
-                        raise Error("Revision D%s has multiple children." % source_id)
+            new_phids = new_phids - searched
 
-                    stack[edge["sourcePHID"]] = edge["destinationPHID"]
+        return graph
 
-            new_phids = new_phids - phids
+    def get_stack(self, rev_ids):
+        """Returns a dict of PHIDs."""
+        if not rev_ids:
+            return {}
+        revisions = self.get_revisions(ids=rev_ids)
+        graph = self.get_stack_graph([rev["phid"] for rev in revisions])
+
+        stack = {}
+        for phid, children in graph.children.items():
+            if len(children) > 1:
+                source_id = next(r["id"] for r in revisions if r["phid"] == phid)
+                raise Error("Revision D%s has multiple children." % source_id)
+
+            stack[phid] = children[0]
 
         for child in list(stack.values()):
             # set the last child (not a parent)
@@ -378,26 +1208,35 @@ class ConduitAPI:
         users = []
         for user in usernames:
             u = user.rstrip("!")
-            key = "user-%s" % u
-            if key in cache:
-                users.append(cache.get(key))
+            user_data = self.get_cached("users", "user-%s" % u)
+            if user_data is not None:
+                users.append(user_data)
             else:
                 to_collect.append(u)
 
         if not to_collect:
             return users
 
-        api_call_args = {"usernames": to_collect}
-        # We're using the deprecated user.query API as the user.search does not
-        # provide the user availability information.
-        # See https://phabricator.services.mozilla.com/conduit/method/user.query/
-        response = self.call("user.query", api_call_args)
-        for user in response:
-            users.append(user)
-            key = "user-%s" % user["userName"]
-            cache.set(key, user)
-            cache.set(user["phid"], key)
-
+        # Users already being queried by another thread are not queried again.
+        names = {u.lower(): u for u in to_collect}
+
+        def fetch(keys):
+            api_call_args = {"usernames": [names[name] for _n, name in keys]}
+            # We're using the deprecated user.query API as the user.search does
+            # not provide the user availability information.
+            # See https://phabricator.services.mozilla.com/conduit/method/user.query/
+            response = self.call("user.query", api_call_args)
+            found = {}
+            for user in response:
+                key = "user-%s" % user["userName"]
+                self.set_cached("users", key, user)
+                cache.set(user["phid"], key)
+                found[("users", user["userName"].lower())] = user
+
+            return found
+
+        fetched = self._single_flight([("users", name) for name in names], fetch)
+        users.extend(user for user in fetched.values() if user is not None)
         return users
 
     def get_groups(self, slugs):
@@ -405,52 +1244,64 @@ class ConduitAPI:
         groups = []
         for slug in slugs:
             s = slug.rstrip("!")
-            key = "group-%s" % s
-            if key in cache:
-                groups.append(cache.get(key))
+            group = self.get_cached("groups", "group-%s" % s)
+            if group is not None:
+                groups.append(group)
             else:
                 to_collect.append(s)
 
         if not to_collect:
             return groups
 
-        # See https://phabricator.services.mozilla.com/conduit/method/project.search/
-        api_call_args = {"queryKey": "active", "constraints": {"slugs": to_collect}}
-        response = self.call("project.search", api_call_args)
-        for data in response.get("data"):
-            group = dict(name=data["fields"]["slug"], phid=data["phid"])
-            groups.append(group)
-            key = "group-%s" % group["name"]
-            cache.set(key, group)
-
-        # projects might be received by an alias.
-        maps = response["maps"]["slugMap"]
-        for alias in maps.keys():
-            name = normalise_reviewer(alias)
-            group = dict(name=name, phid=maps[alias]["projectPHID"])
-            key = "group-%s" % alias
-            if key not in cache:
-                groups.append(group)
-                cache.set(key, group)
+        # Groups already being queried by another thread are not queried again.
+        slugs = {normalise_reviewer(s): s for s in to_collect}
 
+        # See https://phabricator.services.mozilla.com/conduit/method/project.search/
+        def fetch(keys):
+            api_call_args = {
+                "queryKey": "active",
+                "constraints": {"slugs": [slugs[slug] for _n, slug in keys]},
+            }
+            found = {}
+            maps = {}
+            for response in self.search_pages("project.search", api_call_args):
+                for data in response.get("data"):
+                    group = dict(name=data["fields"]["slug"], phid=data["phid"])
+                    self.set_cached("groups", "group-%s" % group["name"], group)
+                    found[("groups", normalise_reviewer(group["name"]))] = group
+
+                maps.update(response["maps"]["slugMap"])
+
+            # projects might be received by an alias.
+            for alias in maps.keys():
+                name = normalise_reviewer(alias)
+                group = dict(name=name, phid=maps[alias]["projectPHID"])
+                key = "group-%s" % alias
+                if self.get_cached("groups", key) is None:
+                    self.set_cached("groups", key, group)
+                found.setdefault(("groups", name), group)
+
+            return found
+
+        fetched = self._single_flight([("groups", slug) for slug in slugs], fetch)
+        groups.extend(group for group in fetched.values() if group is not None)
         return groups
 
     def create_revision(
         self, commit, title, summary, diff_phid, has_commit_reviewers, wip=False
     ):
         """Create a new revision in Phabricator."""
-        transactions = [
-            dict(type="title", value=title),
-            dict(type="summary", value=summary),
-        ]
+        edit = RevisionEdit()
+        edit.add("title", title)
+        edit.add("summary", summary)
         if has_commit_reviewers and not wip:
-            self.update_revision_reviewers(transactions, commit)
+            self.update_revision_reviewers(edit, commit)
 
         if commit["bug-id"]:
-            transactions.append(dict(type="bugzilla.bug-id", value=commit["bug-id"]))
-        return self.edit_revision(
-            transactions=transactions, diff_phid=diff_phid, wip=wip
-        )
+            edit.add("bugzilla.bug-id", commit["bug-id"])
+        if diff_phid:
+            edit.add("update", diff_phid)
+        return self.apply_edit(edit, wip=wip)
 
     def update_revision(
         self,
@@ -460,80 +1311,122 @@ class ConduitAPI:
         diff_phid=None,
         wip=False,
         comment=None,
+        revision=None,
     ):
-        """Update an existing revision in Phabricator."""
+        """Update an existing revision in Phabricator.
+
+        `revision` is the already loaded revision, it's looked up if not
+        provided. Returns None if there was nothing to change.
+        """
+        if revision is None:
+            revision = self.get_revisions(ids=[int(commit["rev-id"])], fresh=True)[0]
+
+        edit = RevisionEdit(revision, rev_id=commit["rev-id"])
         # Update the title and summary
-        transactions = [
-            dict(type="title", value=commit["title"]),
-            dict(type="summary", value=strip_differential_revision(commit["body"])),
-        ]
+        edit.set_field("title", commit["title"])
+        edit.set_field("summary", strip_differential_revision(commit["body"]))
 
         # Add update comment
         if comment:
-            transactions.append(dict(type="comment", value=comment))
+            edit.add("comment", comment)
 
         # Add reviewers only if revision lacks them
         if has_commit_reviewers and not wip:
             if not existing_reviewers:
-                self.update_revision_reviewers(transactions, commit)
+                self.update_revision_reviewers(edit, commit)
 
         # Update bug id if different
         if commit["bug-id"]:
-            revision = conduit.get_revisions(ids=[int(commit["rev-id"])])[0]
-            if revision["fields"]["bugzilla.bug-id"] != commit["bug-id"]:
-                transactions.append(
-                    dict(type="bugzilla.bug-id", value=commit["bug-id"])
-                )
+            edit.set_field("bugzilla.bug-id", commit["bug-id"])
 
-        return self.edit_revision(
-            transactions=transactions,
-            diff_phid=diff_phid,
-            rev_id=commit["rev-id"],
-            wip=wip,
-        )
+        if diff_phid:
+            edit.add("update", diff_phid)
+
+        return self.apply_edit(edit, wip=wip)
 
     def edit_revision(
-        self, transactions=None, diff_phid=None, rev_id=None, wip=False, force_wip=False
+        self, transactions=None, diff_phid=None, rev_id=None, wip=False, revision=None
     ):
         """Edit (create or update) a revision."""
-        trans = list(transactions or [])
+        # The status is needed to set "changes planned".
+        if wip and rev_id and revision is None:
+            revision = self.get_revisions(ids=[int(rev_id)], fresh=True)[0]
+
+        edit = RevisionEdit(revision, rev_id=rev_id)
+        edit.extend(transactions or [])
         # diff_phid is not present for changes in revision settings (like WIP)
         if diff_phid:
-            trans.append(dict(type="update", value=diff_phid))
+            edit.add("update", diff_phid)
+
+        return self.apply_edit(edit, wip=wip, always=True)
+
+    def apply_edit(self, edit, wip=False, always=False):
+        """Send the collected transactions of the revision.
 
+        A single `differential.revision.edit` call is made, unless a diff of
+        a revision with "changes planned" is updated as WIP. Phab API
+        validation would return with an error if "changes planned" would be
+        set in the same call, it's set in a next call after the diff update
+        moves the revision back to review.
+
+        Nothing is sent if there is no change of an existing revision, unless
+        `always` is set. Returns the API call result or None.
+        """
         set_wip_later = False
         if wip:
-            if rev_id and not force_wip:
-                # Set "changes planned" in a new request called after the update one.
-                # Phab API validation would return with an error if "changes planned
-                # would be set in the first API call.
-                existing_revision = conduit.get_revisions(ids=[int(rev_id)])[0]
-                set_wip_later = (
-                    existing_revision["fields"]["status"]["value"] == "changes-planned"
-                )
-
-        if force_wip or wip and not set_wip_later:
-            trans.append(dict(type="plan-changes", value=True))
+            status = (
+                edit.revision["fields"]["status"]["value"]
+                if edit.revision and edit.rev_id
+                else None
+            )
+            if status != "changes-planned":
+                edit.add("plan-changes", True)
+            elif edit.has("update"):
+                set_wip_later = True
 
-        api_call_args = dict(transactions=trans)
+        if edit.rev_id and not edit.transactions and not always:
+            return None
 
-        if rev_id:
-            api_call_args["objectIdentifier"] = rev_id
+        api_call_args = dict(transactions=list(edit))
+        if edit.rev_id:
+            api_call_args["objectIdentifier"] = edit.rev_id
 
         revision = self.call("differential.revision.edit", api_call_args)
         if not revision:
             raise ConduitAPIError("Can't edit the revision.")
 
-        if wip and set_wip_later:
-            return self.edit_revision(rev_id=rev_id, force_wip=True)
+        self.invalidate_revision(revision.get("object", {}).get("phid"))
+
+        if set_wip_later:
+            wip_edit = RevisionEdit(rev_id=edit.rev_id)
+            wip_edit.add("plan-changes", True)
+            return self.apply_edit(wip_edit)
 
         return revision
 
+    def invalidate_revision(self, phid):
+        """Remove the revision data from the caches after it has been edited."""
+        if phid:
+            self.delete_cached("revisions", "rev-%s" % phid)
+            self.delete_cached("revisions", "rev-attachments-%s" % phid)
+            cache.delete("rev-synced-%s" % phid)
+            # Dependencies of the revision and its neighbours might have changed.
+            for edge in cache.get("edges-%s" % phid) or []:
+                cache.delete("edges-%s" % edge["destinationPHID"])
+            cache.delete("edges-%s" % phid)
+
+    def invalidate_revision_id(self, rev_id):
+        """Remove the revision data from the caches by the revision ID."""
+        if rev_id:
+            cache.delete("rev-missing-%s" % rev_id)
+            self.invalidate_revision(self.get_cached("revisions", "rev-id-%s" % rev_id))
+
     def get_repository(self, call_sign):
         """Get the repository info from Phabricator."""
         key = "repo-%s" % call_sign
-        if key in cache:
-            return cache.get(key)
+        repo = self.get_cached("repositories", key)
+        if repo is not None:
+            return repo
 
         api_call_args = dict(constraints=dict(callsigns=[call_sign]), limit=1)
         data = self.call("diffusion.repository.search", api_call_args)
@@ -541,7 +1434,7 @@ class ConduitAPI:
             raise NotFoundError("Repository %s not found" % call_sign)
 
         repo = data["data"][0]
-        cache.set(key, repo)
+        self.set_cached("repositories", key, repo)
         return repo
 
     def create_diff(self, changes, base_revision):
@@ -588,50 +1481,110 @@ class ConduitAPI:
         self.call("differential.setdiffproperty", api_call_args)
 
     def file_upload(self, path, data):
+        """Upload the file and return its PHID.
+
+        PHIDs of uploaded files are stored in the persistent cache by the
+        content hash and length. A file with the same content is not uploaded
+        again, concurrent uploads of the same content share the request.
+        """
         if not data:
             return
+        content_hash = hashlib.sha256(data).hexdigest()
+        key = "file-%s-%s" % (content_hash, len(data))
+        return self._single_flight(
+            [key],
+            lambda _keys: {key: self._file_upload(key, path, data, content_hash)},
+        )[key]
+
+    def _file_upload(self, key, path, data, content_hash):
+        if key in cache:
+            return cache.get(key)
+
+        entry = (
+            persistent_cache.get_entry(self.repo.api_url, "files", key)
+            if self.repo is not None
+            else None
+        )
+        if entry is not None:
+            synced, file_phid = entry
+            if time.time() - synced < FILE_REFRESH_INTERVAL:
+                cache.set(key, file_phid)
+                return file_phid
+
+            # The file might have been deleted in the meantime.
+            response = self.call(
+                "file.search", dict(constraints=dict(phids=[file_phid]))
+            )
+            if response.get("data"):
+                self.set_cached("files", key, file_phid)
+                return file_phid
+
         name = os.path.basename(path)
         allocation = self.call(
             "file.allocate",
-            dict(
-                name=name,
-                contentLength=len(data),
-                contentHash=hashlib.sha256(data).hexdigest(),
-            ),
+            dict(name=name, contentLength=len(data), contentHash=content_hash),
         )
         file_phid = allocation["filePHID"]
         if allocation["upload"]:
             if not file_phid:
-                data_base64 = base64.standard_b64encode(data)
                 file_phid = self.call(
-                    "file.upload", dict(data_base64=data_base64.decode(), name=name)
+                    "file.upload", dict(data_base64=Base64Data(data), name=name)
                 )
             else:
-                chunks = self.call("file.querychunks", dict(filePHID=file_phid))
-                for chunk in chunks:
-                    if chunk["complete"]:
-                        continue
-                    byte_start = int(chunk["byteStart"])
-                    byte_end = int(chunk["byteEnd"])
-                    data_base64 = base64.standard_b64encode(data[byte_start:byte_end])
-                    self.call(
-                        "file.uploadchunk",
-                        dict(
-                            filePHID=file_phid,
-                            byteStart=byte_start,
-                            data=data_base64.decode(),
-                            dataEncoding="base64",
-                        ),
-                    )
+                self._upload_chunks(file_phid, data)
 
+        self.set_cached("files", key, file_phid)
         return file_phid
 
+    def _upload_chunks(self, file_phid, data):
+        """Upload the missing chunks of an allocated file concurrently.
+
+        If the upload is interrupted by a network error, the chunks received
+        by Phabricator are queried again and only the missing ones are sent.
+        """
+        view = memoryview(data)
+        attempt = 0
+        while True:
+            chunks = self.call("file.querychunks", dict(filePHID=file_phid))
+            futures = [
+                self.upload_executor.submit(
+                    self._upload_chunk,
+                    file_phid,
+                    view,
+                    int(chunk["byteStart"]),
+                    int(chunk["byteEnd"]),
+                )
+                for chunk in chunks
+                if not chunk["complete"]
+            ]
+            try:
+                self.gather(futures)
+                return
+            except RETRY_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+
+                attempt += 1
+                logger.debug("Resuming the upload of %s after %s", file_phid, e)
+
+    def _upload_chunk(self, file_phid, view, byte_start, byte_end):
+        self.call(
+            "file.uploadchunk",
+            dict(
+                filePHID=file_phid,
+                byteStart=byte_start,
+                data=Base64Data(view[byte_start:byte_end]),
+                dataEncoding="base64",
+            ),
+        )
+
     def whoami(self):
-        if "whoami" in cache:
-            return cache.get("whoami")
+        who = self.get_cached("users", "whoami")
+        if who is not None:
+            return who
 
         who = self.call("user.whoami", {})
-        cache.set("whoami", who)
+        self.set_cached("users", "whoami", who)
         return who
 
     def update_revision_reviewers(self, transactions, commit):
@@ -686,14 +1639,6 @@ class ConduitAPI:
                 ]
             )
 
-        users = []
-        if all_reviewers:
-            users = self.get_users(all_reviewers)
-            found_names = [
-                normalise_reviewer(data["userName"], strip_group=False)
-                for data in users
-            ]
-
         # Group reviewers are represented by a "#" prefix
         all_groups = []
         found_groups = []
@@ -706,8 +1651,22 @@ class ConduitAPI:
                 ]
             )
 
-        if all_groups:
-            groups = self.get_groups(all_groups)
+        # Users and groups are queried concurrently.
+        users_future = (
+            self.submit(self.get_users, all_reviewers) if all_reviewers else None
+        )
+        groups_future = self.submit(self.get_groups, all_groups) if all_groups else None
+
+        users = []
+        if users_future:
+            users = users_future.result()
+            found_names = [
+                normalise_reviewer(data["userName"], strip_group=False)
+                for data in users
+            ]
+
+        if groups_future:
+            groups = groups_future.result()
             found_groups = [
                 "#%s" % normalise_reviewer(group["name"]) for group in groups
             ]
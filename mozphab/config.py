@@ -41,6 +41,15 @@ class Config(object):
             create_bookmark = True
             always_full_stack = False
 
+            [network]
+            pool_size = 4
+            idle_timeout = 30
+            max_in_flight = 4
+            timeout = 60
+            deadline = 0
+            retries = 3
+            hedge_percentile = 0
+
             [updater]
             self_last_check = 0
             arc_last_check = 0
@@ -72,6 +81,13 @@ class Config(object):
         self.apply_patch_to = self._config.get("patch", "apply_to")
         self.create_bookmark = self._config.getboolean("patch", "create_bookmark")
         self.always_full_stack = self._config.getboolean("patch", "always_full_stack")
+        self.connection_pool_size = self._config.getint("network", "pool_size")
+        self.connection_idle_timeout = self._config.getint("network", "idle_timeout")
+        self.max_in_flight = self._config.getint("network", "max_in_flight")
+        self.network_timeout = self._config.getint("network", "timeout")
+        self.command_deadline = self._config.getint("network", "deadline")
+        self.read_retries = self._config.getint("network", "retries")
+        self.hedge_percentile = self._config.getint("network", "hedge_percentile")
         self.self_last_check = self._config.getint("updater", "self_last_check")
         self.self_auto_update = self._config.getboolean("updater", "self_auto_update")
         self.arc_last_check = self._config.getint("updater", "arc_last_check")
@@ -123,6 +139,13 @@ class Config(object):
             self._set("patch", "apply_to", self.apply_patch_to)
             self._set("patch", "create_bookmark", self.create_bookmark)
             self._set("patch", "always_full_stack", self.always_full_stack)
+            self._set("network", "pool_size", self.connection_pool_size)
+            self._set("network", "idle_timeout", self.connection_idle_timeout)
+            self._set("network", "max_in_flight", self.max_in_flight)
+            self._set("network", "timeout", self.network_timeout)
+            self._set("network", "deadline", self.command_deadline)
+            self._set("network", "retries", self.read_retries)
+            self._set("network", "hedge_percentile", self.hedge_percentile)
             self._set("telemetry", "enabled", self.telemetry_enabled)
 
         with open(self._filename, "w", encoding="utf-8") as f:
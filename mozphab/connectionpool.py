@@ -0,0 +1,292 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import threading
+import time
+import urllib.parse
+import zlib
+
+from contextlib import contextmanager
+from http.client import (
+    HTTPConnection,
+    HTTPSConnection,
+    ImproperConnectionState,
+    RemoteDisconnected,
+)
+
+from mozphab import environment
+
+from .config import config
+from .exceptions import CommandError
+from .logger import logger
+
+# Compressed size of the response body read at once.
+CHUNK_SIZE = 64 * 1024
+
+# Errors raised when a kept-alive socket was closed by the server in the meantime.
+STALE_CONNECTION_ERRORS = (
+    BrokenPipeError,
+    ConnectionAbortedError,
+    ConnectionResetError,
+    ImproperConnectionState,
+    RemoteDisconnected,
+)
+
+
+class DecodedResponse(io.BufferedIOBase):
+    """HTTP response with the body decompressed while it is read.
+
+    Supports the gzip and deflate content encodings. Counts the number of
+    bytes received and returned.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.encoding = (response.getheader("Content-Encoding") or "").lower()
+        if self.encoding == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self._decompressor = zlib.decompressobj()
+        else:
+            self._decompressor = None
+
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def isclosed(self):
+        return self.response.isclosed()
+
+    def readable(self):
+        return True
+
+    def _decompress(self, data, size):
+        try:
+            return self._decompressor.decompress(data, size)
+        except zlib.error:
+            if self.encoding != "deflate" or self.compressed_bytes > len(data):
+                raise
+
+            # Some servers send a raw deflate stream without the zlib header.
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decompressor.decompress(data, size)
+
+    def _read_chunk(self, size):
+        """Return up to `size` bytes, an empty result means the end of body."""
+        if self._decompressor is None:
+            data = self.response.read(size)
+            self.compressed_bytes += len(data)
+            return data
+
+        while True:
+            if self._decompressor.unconsumed_tail:
+                data = self._decompress(self._decompressor.unconsumed_tail, size)
+            elif self._decompressor.eof:
+                return b""
+            else:
+                compressed = self.response.read(CHUNK_SIZE)
+                self.compressed_bytes += len(compressed)
+                if not compressed:
+                    return self._decompressor.flush()
+
+                data = self._decompress(compressed, size)
+
+            if data:
+                return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self._read_chunk(CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            data = b"".join(chunks)
+        else:
+            chunks = []
+            remaining = size
+            while remaining:
+                chunk = self._read_chunk(remaining)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            data = b"".join(chunks)
+
+        self.decompressed_bytes += len(data)
+        return data
+
+    def read1(self, size=-1):
+        data = self._read_chunk(CHUNK_SIZE if size is None or size < 0 else size)
+        self.decompressed_bytes += len(data)
+        return data
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections shared between API calls.
+
+    Connections are stored per host. An idle connection is reused if it was
+    released less than `idle_timeout` seconds ago, otherwise it is closed and
+    a new one is created. At most `max_size` idle connections are kept per host.
+    """
+
+    def __init__(self, max_size=None, idle_timeout=None):
+        self.max_size = config.connection_pool_size if max_size is None else max_size
+        self.idle_timeout = (
+            config.connection_idle_timeout if idle_timeout is None else idle_timeout
+        )
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(url):
+        return url.scheme, url.netloc
+
+    @staticmethod
+    def _new_connection(url, timeout=None):
+        kwargs = {} if timeout is None else dict(timeout=timeout)
+        if url.scheme == "https":
+            return HTTPSConnection(url.netloc, **kwargs)
+
+        return HTTPConnection(url.netloc, **kwargs)
+
+    def acquire(self, url, timeout=None):
+        """Return a pair of an idle or new connection and a `reused` flag."""
+        # Allow for an HTTP connection in suite.
+        if url.scheme != "https" and not environment.HTTP_ALLOWED:
+            raise CommandError("Only https connections are allowed.")
+
+        key = self._key(url)
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, released = idle.pop()
+                if now - released < self.idle_timeout:
+                    if timeout is not None:
+                        conn.timeout = timeout
+                        if conn.sock is not None:
+                            conn.sock.settimeout(timeout)
+                    return conn, True
+
+                conn.close()
+
+        logger.debug("Opening a new connection to %s", url.netloc)
+        return self._new_connection(url, timeout=timeout), False
+
+    def release(self, url, conn):
+        """Return the connection to the pool so it might be reused."""
+        with self._lock:
+            idle = self._idle.setdefault(self._key(url), [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.monotonic()))
+                return
+
+        conn.close()
+
+    def preconnect(self, url, timeout=None):
+        """Open a connection in advance and keep it in the pool.
+
+        Used to establish the TLS session while the local work is being done.
+        Errors are ignored, the connection is opened again by the next request.
+        """
+        if isinstance(url, str):
+            url = urllib.parse.urlparse(url)
+
+        try:
+            conn, reused = self.acquire(url, timeout=timeout)
+        except CommandError:
+            return
+
+        if not reused:
+            try:
+                conn.connect()
+            except OSError as e:
+                logger.debug("Failed to connect to %s: %s", url.netloc, e)
+                conn.close()
+                return
+
+        self.release(url, conn)
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for conn, _released in connections:
+                conn.close()
+
+    @contextmanager
+    def request(
+        self, method, url, body=None, headers=None, timeout=None, idempotent=False
+    ):
+        """Send a request and yield the response.
+
+        A request over a reused connection is repeated once over a new
+        connection if the server has closed the socket in the meantime.
+        If the request has been sent in full it might have been handled
+        already, so it's repeated only if it's `idempotent` or a GET.
+        The connection is returned to the pool only if the response has been
+        read in full. The yielded response body is decompressed if the server
+        has used the gzip or deflate encoding.
+        """
+        if isinstance(url, str):
+            url = urllib.parse.urlparse(url)
+
+        headers = dict(headers or {})
+        headers.setdefault("Accept-Encoding", "gzip, deflate")
+        conn, reused = self.acquire(url, timeout=timeout)
+        sent = False
+        try:
+            conn.request(method, url.geturl(), body=body, headers=headers)
+            sent = True
+            response = conn.getresponse()
+        except STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused or (sent and not idempotent and method != "GET"):
+                raise
+
+            logger.debug("Reconnecting to %s", url.netloc)
+            if hasattr(body, "seek"):
+                body.seek(0)
+            conn = self._new_connection(url, timeout=timeout)
+            try:
+                conn.request(method, url.geturl(), body=body, headers=headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        decoded = DecodedResponse(response)
+        try:
+            yield decoded
+        except Exception:
+            conn.close()
+            raise
+
+        logger.debug(
+            "%s%s: %s bytes received, %s bytes decoded (%s)",
+            url.netloc,
+            url.path,
+            decoded.compressed_bytes,
+            decoded.decompressed_bytes,
+            decoded.encoding or "identity",
+        )
+        if response.isclosed():
+            self.release(url, conn)
+        else:
+            conn.close()
+
+
+connection_pool = ConnectionPool()
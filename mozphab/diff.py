@@ -8,6 +8,7 @@ import re
 from collections import namedtuple
 
 from .conduit import conduit
+from .jsonstream import LazyList
 
 
 class Diff:
@@ -201,19 +202,26 @@ class Diff:
             raise "unsupported change type %s" % kind
 
     def upload_files(self):
+        uploads = []
+        futures = []
         for change in list(self.changes.values()):
             for upload in change.uploads:
                 path = change.cur_path if upload["type"] == "new" else change.old_path
-                upload["phid"] = conduit.file_upload(path, upload["value"])
+                uploads.append(upload)
+                futures.append(
+                    conduit.submit(conduit.file_upload, path, upload["value"])
+                )
+
+        for upload, phid in zip(uploads, conduit.gather(futures)):
+            upload["phid"] = phid
 
     def submit(self, commit, message):
         files_changed = sorted(
             self.changes.values(), key=operator.attrgetter("cur_path")
         )
-        changes = [
-            change.to_conduit(conduit.repo.get_public_node(commit["node"]))
-            for change in files_changed
-        ]
+        node = conduit.repo.get_public_node(commit["node"])
+        # Changes are serialized one by one when the request is sent.
+        changes = LazyList(files_changed, lambda change: change.to_conduit(node))
         diff = conduit.create_diff(
             changes, conduit.repo.get_public_node(commit["parent"])
         )
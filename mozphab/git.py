@@ -16,8 +16,8 @@ from mozphab import environment
 from .config import config
 from .diff import Diff
 from .exceptions import CommandError, Error, NotFoundError
-from .gitcommand import GitCommand
-from .helpers import prompt, short_node, temporary_binary_file, temporary_file
+from .gitcommand import CatFile, DiffTree, GitCommand
+from .helpers import prompt, short_node, temporary_file
 from .logger import logger
 from .repository import Repository
 from .spinner import wait_message
@@ -52,6 +52,12 @@ class Git(Repository):
         self.vcs_version = m.group(0)
         self.revset = None
         self.branch = None
+        self.cat_file = CatFile(self.git, self.path)
+        self.diff_tree = DiffTree(self.git, self.path)
+        # Nodes read by `diff_tree` keyed by the original nodes of the commits.
+        self._prepared_nodes = {}
+        # Original nodes of the stack commits to re-create on a new parent.
+        self._outdated_nodes = set()
 
     @property
     def is_cinnabar_installed(self):
@@ -130,35 +136,113 @@ class Git(Repository):
         )
 
     def cleanup(self):
+        self.cat_file.close()
+        self.diff_tree.close()
         self.git_call(["gc", "--auto", "--quiet"])
         if self.branch:
             self.checkout(self.branch)
 
-    def _find_branches_to_rebase(self, commits):
-        """Create a list of branches to rebase."""
-        branches_to_rebase = dict()
-        for commit in commits:
-            if commit["node"] == commit["orig-node"]:
+    def _get_branches_to_update(self, commits):
+        """Find branches containing the amended commits.
+
+        Amending a commit re-creates all its descendants within the stack,
+        so the branches are the ones containing the first amended commit.
+
+        Returns a dict with names of the branch refs as keys and SHA1 of
+        their tips as values.
+        """
+        amended = [c for c in commits if c["node"] != c["orig-node"]]
+        if not amended:
+            return {}
+
+        branches = {}
+        for line in self.git_out(
+            [
+                "for-each-ref",
+                "--contains",
+                amended[0]["orig-node"],
+                "--format=%(objectname) %(refname)",
+                "refs/heads/",
+            ]
+        ):
+            tip, ref = line.split(" ", 1)
+            branches[ref] = tip
+
+        return branches
+
+    def _rebase_branches(self, branches, commits):
+        """Re-create commits of the branches going beyond the stack.
+
+        Amending changes only the messages of the commits, trees are the
+        same. Commits descending from the amended ones are re-created with
+        `commit-tree`, so the worktree isn't touched.
+
+        Returns a dict with the original SHA1 of commits as keys and their
+        new SHA1 as values.
+        """
+        new_nodes = {c["orig-node"]: c["node"] for c in commits}
+        tips = sorted(set(tip for tip in branches.values() if tip not in new_nodes))
+        if not tips:
+            return new_nodes
+
+        first = next(c["orig-node"] for c in commits if c["node"] != c["orig-node"])
+        boundary = "--%s--\n" % uuid.uuid4().hex
+        log = self.git_out(
+            [
+                "log",
+                "--reverse",
+                "--topo-order",
+                "--ancestry-path",
+                "--format=%H%n%P%n%T%n%an%n%ae%n%aD%n%B{}".format(boundary),
+                "^%s" % first,
+            ]
+            + tips,
+            split=False,
+            strip=False,
+        )[: -len(boundary) - 1]
+        for log_line in log.split("%s\n" % boundary):
+            if not log_line:
+                continue
+
+            (
+                node,
+                parents,
+                tree_hash,
+                author_name,
+                author_email,
+                author_date,
+                message,
+            ) = log_line.split("\n", 6)
+            if node in new_nodes:
+                continue
+
+            parents = parents.split(" ")
+            new_parents = [new_nodes.get(parent, parent) for parent in parents]
+            if new_parents == parents:
                 continue
-            branches = self.git_out(["branch", "--contains", commit["orig-node"]])
-            for branch in branches:
-                if branch.startswith("* ("):
-                    # Omit `* (detached from {SHA1})`
-                    continue
 
-                branch = branch.lstrip("* ")
-                # Rebase the branch to the last commit from the stack .
-                branches_to_rebase[branch] = [commit["node"], commit["orig-node"]]
+            new_nodes[node] = self._commit_tree(
+                new_parents, tree_hash, message, author_name, author_email, author_date,
+            )
 
-        return branches_to_rebase
+        return new_nodes
 
     def finalize(self, commits):
-        """Rebase all branches based on changed commits from the stack."""
-        branches_to_rebase = self._find_branches_to_rebase(commits)
+        """Move all branches based on changed commits from the stack.
 
-        for branch, nodes in branches_to_rebase.items():
-            self.checkout(branch)
-            self._rebase(*nodes)
+        Branches are moved to the new commits with a single `update-ref`.
+        """
+        self._rewrite_stack(commits)
+        branches = self._get_branches_to_update(commits)
+        if branches:
+            new_nodes = self._rebase_branches(branches, commits)
+            updates = "".join(
+                "update %s %s %s\n" % (ref, new_nodes.get(tip, tip), tip)
+                for ref, tip in branches.items()
+            )
+            with temporary_file(updates) as updates_file:
+                with open(updates_file) as f:
+                    self.git_call(["update-ref", "--stdin"], stdin=f)
 
         self.checkout(self.branch)
 
@@ -253,35 +337,25 @@ class Git(Repository):
             end = start_rev if is_single else self.args.end_rev
             self.revset = (start, end)
 
-    def _git_get_children(self, node):
+    def _git_get_children(self, start, end):
         """Get commits SHA1 with their children.
 
-        Args:
-            node: The SHA1 of a node to check for all children
+        Only the commits which are descendants of `start` and ancestors of
+        `end` are listed, so the cost depends on the size of the stack, not
+        the size of the repository.
 
-        Returns: A list of "aaaa bbbb cccc"" strings, where bbbb and cccc are
-            SHA1 of direct children of aaaa
+        Returns: A dict with SHA1 of commits as keys and lists of SHA1 of their
+            direct children as values.
         """
-        return self.git_out(["rev-list", "--all", "--children", "--not", "%s^@" % node])
+        children = {}
+        revisions = "{}..{}".format(start, end)
+        for line in self.git_out(
+            ["rev-list", "--children", "--ancestry-path", revisions]
+        ):
+            node, *node_children = line.split(" ")
+            children[node] = node_children
 
-    @staticmethod
-    def _get_direct_children(node, rev_list):
-        """ Return direct children of the commit.
-
-        Args:
-            node: The SHA1 of a node to check for direct children
-            rev_list: A list of SHA1 strings - result of the _git_get_children method
-
-        Returns: A list of SHA1 representing direct children of a commit
-        """
-        # Find the line containing the node to extract its commit's children
-        for line in rev_list:
-            if line.startswith(node):
-                children = line.split(" ")
-                children.remove(node)
-                return children
-
-        return []
+        return children
 
     def _get_commits_info(self, start, end):
         """Log useful info about the commits within the desired range.
@@ -315,27 +389,25 @@ class Git(Repository):
         )[: -len(boundary) - 1]
         return log.split("%s\n" % boundary)
 
-    def _is_child(self, parent, node, rev_list):
-        """Check if `node` is a direct or indirect child of the `parent`.
+    @staticmethod
+    def _get_descendants(node, children):
+        """Return a set of direct and indirect children of the commit.
 
         Args:
-            parent: The parent node whose children will be searched
-            node: The string we check if it's in parent-child relation to the `parent`
-            rev_list: A response from the git _git_get_children method - a list of
-                "aaaa bbbb cccc"" strings, where "bbbb" and cccc" are SHA1 of direct
-                children of "aaaa"
+            node: The SHA1 of a node to find descendants of
+            children: A response from the `_git_get_children` method
 
-        Returns: a Boolean True if the `node` represents a child of the `parent`.
+        Returns: A set of SHA1 of the descendants, not including the `node`
         """
-        direct_children = self._get_direct_children(parent, rev_list)
-        if node in direct_children:
-            return True
+        descendants = set()
+        queue = list(children.get(node, []))
+        while queue:
+            child = queue.pop()
+            if child not in descendants:
+                descendants.add(child)
+                queue.extend(children.get(child, []))
 
-        for child in direct_children:
-            if self._is_child(child, node, rev_list):
-                return True
-
-        return False
+        return descendants
 
     def commit_stack(self, single=False):
         """Collect all the info about commits."""
@@ -344,7 +416,7 @@ class Git(Repository):
             return None
 
         commits = []
-        rev_list = None
+        descendants = None
         first_node = None
         for log_line in self._get_commits_info(*self.revset):
             if not log_line:
@@ -363,10 +435,12 @@ class Git(Repository):
 
             if not single:
                 # Check if the commit is a child of the first one
-                if rev_list is None:
-                    rev_list = self._git_get_children(node)
+                if descendants is None:
                     first_node = node
-                elif not self._is_child(first_node, node, rev_list):
+                    descendants = self._get_descendants(
+                        node, self._git_get_children(*self.revset)
+                    )
+                elif node not in descendants:
                     raise Error(
                         "Commit %s is not a child of %s, unable to continue"
                         % (short_node(node), short_node(first_node))
@@ -505,11 +579,8 @@ class Git(Repository):
             self.git_call(["checkout", "-q", "-b", branch_name])
             logger.info("Created branch %s", branch_name)
 
-    def apply_patch(self, diff, body, author, author_date):
-        # apply the patch as a binary file to ensure the correct line endings
-        # is used.
-        with temporary_binary_file(diff.encode("utf8")) as patch_file:
-            self.git_call(["apply", "--index", patch_file])
+    def apply_patch(self, diff_file, body, author, author_date):
+        self.git_call(["apply", "--index", diff_file])
 
         self.commit(body, author, author_date)
 
@@ -533,16 +604,18 @@ class Git(Repository):
 
         Creates a new commit for the tree_hash.
         Args:
-            parent: SHA1 of the parent commit
+            parent: SHA1 of the parent commit, or a list of SHA1 of the parents
             tree_hash: SHA1 of the tree_hash to use for the commit
             message: commit message
 
         Returns:
             str: SHA1 of the new commit.
         """
+        parents = [parent] if isinstance(parent, str) else parent
+        parent_args = [arg for parent in parents for arg in ("-p", parent)]
         with temporary_file(message) as message_file:
             return self.git_out(
-                ["commit-tree", "-p", parent, "-F", message_file, tree_hash],
+                ["commit-tree"] + parent_args + ["-F", message_file, tree_hash],
                 split=False,
                 extra_env={
                     "GIT_AUTHOR_NAME": author_name,
@@ -551,12 +624,52 @@ class Git(Repository):
                 },
             )
 
+    def _rewrite_stack(self, commits, until=None):
+        """Re-create the outdated commits of the stack on their new parents.
+
+        Args:
+            commits: List of commits within the stack
+            until: The commit to stop at, all commits are re-created if None
+        """
+        for index, commit in enumerate(commits):
+            if commit is until:
+                break
+
+            if commit["orig-node"] not in self._outdated_nodes:
+                continue
+
+            self._outdated_nodes.discard(commit["orig-node"])
+            commit["node"] = self._commit_tree(
+                commit["parent"],
+                commit["tree-hash"],
+                "%s\n%s" % (commit["title"], commit["body"]),
+                commit["author-name"],
+                commit["author-email"],
+                commit["author-date"],
+            )
+            if index + 1 < len(commits):
+                commits[index + 1]["parent"] = commit["node"]
+
+    def prepare_commit(self, commit, commits):
+        """Re-create the outdated commits up to and including the commit.
+
+        The node and the parent of the commit describe an existing commit
+        before it's checked out or its diff is submitted. Commits which
+        aren't outdated are left as they are.
+        """
+        children = commits[commits.index(commit) + 1 :]
+        self._rewrite_stack(commits, until=children[0] if children else None)
+
     def amend_commit(self, commit, commits):
         """Amend the commit with an updated message.
 
         Changing commit's message changes also its SHA1.
-        All the children within the stack and branches are then updated
-        to keep the history.
+        The children within the stack are re-created on top of it by
+        `prepare_commit` when they're submitted, or by `finalize`, instead
+        of re-creating the whole stack for each amended commit. A child is
+        re-created again if its own message is amended after it's been
+        submitted, so each commit is re-created at most twice. Branches are
+        updated by `finalize`.
 
         Args:
             commit: Information about the commit to be amended
@@ -571,38 +684,14 @@ class Git(Repository):
             logger.debug("not amending commit %s, unchanged", commit["name"])
             return
 
-        # Create a new commit with the updated body.
-        new_parent_sha = self._commit_tree(
-            commit["parent"],
-            commit["tree-hash"],
-            updated_body,
-            commit["author-name"],
-            commit["author-email"],
-            commit["author-date"],
-        )
-
-        # Update commit info
-        commit["node"] = new_parent_sha
-        # Update parent for all the children of the `commit` within the stack
-        has_children = False
-        for c in commits:
-            if not has_children:
-                # Find the amended commit info in the list of all commits in the stack.
-                # Next commits are children of this one.
-                has_children = c == commit
-                continue
+        # Re-create the commit, and its parents if they're outdated.
+        self._outdated_nodes.add(commit["orig-node"])
+        self.prepare_commit(commit, commits)
 
-            # Update parent information and create a new commit
-            c["parent"] = new_parent_sha
-            new_parent_sha = self._commit_tree(
-                new_parent_sha,
-                c["tree-hash"],
-                "%s\n%s" % (c["title"], c["body"]),
-                c["author-name"],
-                c["author-email"],
-                c["author-date"],
-            )
-            c["node"] = new_parent_sha
+        # The parent of the children has changed.
+        self._outdated_nodes.update(
+            c["orig-node"] for c in commits[commits.index(commit) + 1 :]
+        )
 
     def rebase_commit(self, source_commit, dest_commit):
         self._rebase(dest_commit["node"], source_commit["node"])
@@ -611,14 +700,53 @@ class Git(Repository):
         self.git_call(["rebase", "--quiet", "--onto", newbase, upstream])
 
     def _file_size(self, blob):
-        return int(self.git_out(["cat-file", "-s", blob], split=False))
-
-    def _cat_file(self, blob):
-        return self.git_out(["cat-file", "blob", blob], split=False, expect_binary=True)
+        # The size is known if the blob has been read already.
+        if blob not in self.cat_file.sizes:
+            self._cat_file([blob])
+        return self.cat_file.sizes[blob]
+
+    def _cat_file(self, blobs):
+        """Return a list of bodies of the blobs, all read in one request."""
+        bodies = self.cat_file.read(blobs)
+        for blob, body in zip(blobs, bodies):
+            if body is None:
+                raise CommandError("Object %s not found" % blob)
+        return bodies
+
+    def _read_blobs(self, raw_changes):
+        """Yield a dict of blob bodies for each of the raw `git` changes.
+
+        All blobs are requested from `cat_file` at once, but the bodies of
+        a change are read only when it's parsed, so the bodies of a single
+        file are held in memory.
+        """
+        blobs = []
+        for raw in raw_changes:
+            fields = raw.split("\0", 1)[0].split(" ")
+            blobs.append([blob for blob in fields[2:4] if blob != NULL_SHA1])
 
-    def _parse_diff_change(self, raw, diff):
+        bodies = self.cat_file.iter_read([blob for change in blobs for blob in change])
+        try:
+            for change in blobs:
+                found = {blob: next(bodies) for blob in change}
+                for blob, body in found.items():
+                    if body is None:
+                        raise CommandError("Object %s not found" % blob)
+                yield found
+
+            # Let `cat_file` finish the request.
+            next(bodies, None)
+        finally:
+            bodies.close()
+
+    def _parse_diff_change(self, raw, diff, patch=None, bodies=None):
         """Parse the changes provided in raw `git` response.
 
+        `patch` is a list of the hunk lines read by `diff_tree`. Blobs of
+        a changed file are compared with `git diff` if it's not provided.
+        `bodies` is a dict of the blob bodies yielded by `_read_blobs`, the
+        blobs of the change are read if it's not provided.
+
         Returns a Diff.Change object.
         """
         # find changed path
@@ -636,16 +764,19 @@ class Git(Repository):
         change = diff.change_for(b_path)
 
         # Extract the bodies of blobs to compare
+        if bodies is None:
+            (bodies,) = self._read_blobs([raw])
+
         if a_blob == NULL_SHA1:
             a_blob, a_body, a_size = None, b"", 0
         else:
-            a_body = self._cat_file(a_blob)
+            a_body = bodies[a_blob]
             a_size = self._file_size(a_blob)
 
         if b_blob == NULL_SHA1:
             b_blob, b_body, b_size = None, b"", 0
         else:
-            b_body = self._cat_file(b_blob)
+            b_body = bodies[b_blob]
             b_size = self._file_size(b_blob)
 
         file_size = max(a_size, b_size)
@@ -717,19 +848,23 @@ class Git(Repository):
                 else:
                     context_size = environment.MAX_CONTEXT_SIZE
 
-                diff_args = [
-                    "diff",
-                    "--submodule=short",
-                    "--no-ext-diff",
-                    "--no-color",
-                    "--no-textconv",
-                    "-U%s" % context_size,
-                    a_blob,
-                    b_blob,
-                ]
-                git_diff = self.git_out(diff_args, expect_binary=True)
-                git_diff = str(git_diff, "utf-8").splitlines(keepends=True)
-                lines = git_diff[4:]
+                if patch is not None and context_size == self._diff_context_size:
+                    lines = str(b"".join(patch), "utf-8").splitlines(keepends=True)
+                else:
+                    diff_args = [
+                        "diff",
+                        "--submodule=short",
+                        "--no-ext-diff",
+                        "--no-color",
+                        "--no-textconv",
+                        "-U%s" % context_size,
+                        a_blob,
+                        b_blob,
+                    ]
+                    git_diff = self.git_out(diff_args, expect_binary=True)
+                    git_diff = str(git_diff, "utf-8").splitlines(keepends=True)
+                    lines = git_diff[4:]
+
                 old_off, new_off, old_len, new_len = Diff.parse_git_diff(lines.pop(0))
 
             # Collect some stats about the diff, and generate the corpus we
@@ -766,8 +901,30 @@ class Git(Repository):
 
         return change
 
+    @property
+    def _diff_context_size(self):
+        """Size of the context in patches read by `diff_tree`."""
+        return 100 if self.args.lesscontext else environment.MAX_CONTEXT_SIZE
+
+    def prepare_diffs(self, commits):
+        """Read changes of all commits with a single `git diff-tree`."""
+        self._prepared_nodes = {c["orig-node"]: c["node"] for c in commits}
+        self.diff_tree.start(
+            list(self._prepared_nodes.values()), self._diff_context_size
+        )
+
     def get_diff(self, commit):
         """Create a Diff object with changes."""
+        node = self._prepared_nodes.pop(commit["orig-node"], None)
+        if node is not None:
+            changes = self.diff_tree.changes(node)
+            blobs = self._read_blobs([raw_change for raw_change, _ in changes])
+            diff = Diff()
+            for bodies, (raw_change, patch) in zip(blobs, changes):
+                self._parse_diff_change(raw_change, diff, patch, bodies)
+
+            return diff
+
         raw = self.git_out(
             [
                 "diff-tree",
@@ -782,9 +939,11 @@ class Git(Repository):
             split=False,
         )
 
+        raw_changes = raw[:-1].split("\0:")[1:]
+        blobs = self._read_blobs(raw_changes)
         diff = Diff()
-        for raw_change in raw[:-1].split("\0:")[1:]:
-            self._parse_diff_change(raw_change, diff)
+        for bodies, raw_change in zip(blobs, raw_changes):
+            self._parse_diff_change(raw_change, diff, bodies=bodies)
 
         return diff
 
@@ -5,13 +5,28 @@
 
 import os
 import re
+import subprocess
+import threading
+from contextlib import suppress
 from pathlib import Path
 from shutil import which
 
 from .config import config
-from .exceptions import Error
+from .exceptions import CommandError, Error
 from .helpers import parse_config, which_path
-from .subprocess_wrapper import check_call, check_output
+from .logger import logger
+from .subprocess_wrapper import check_call, check_output, start_process
+
+# Number of object names written to `git cat-file` at once. Their length is
+# kept below the size of a pipe buffer, so writing never waits for Git, which
+# might be waiting for its output to be read.
+CAT_FILE_PIPELINE = 64
+
+# Size of the chunks of the `git diff-tree` output read at once.
+DIFF_TREE_CHUNK = 64 * 1024
+
+# A commit in the `git diff-tree --stdin -z` output starts with its SHA1.
+DIFF_TREE_COMMIT = re.compile(rb"[0-9a-f]{40,64}\0")
 
 
 class GitCommand:
@@ -50,6 +65,10 @@ class GitCommand:
         ]
         return check_output(self.command + unicode_args + git_args, env=env, **kwargs)
 
+    def start(self, git_args, **kwargs):
+        """Start a long-lived git process, see `start_process`."""
+        return start_process(self.command + git_args, env=self._env, **kwargs)
+
     def set_args(self, args):
         """Read and set the configuration."""
         git_config = parse_config(self.output(["config", "--list"], never_log=True))
@@ -104,3 +123,282 @@ class GitCommand:
                 self._cinnabar_installed = which("git-cinnabar") is not None
 
         return self._cinnabar_installed
+
+
+class CatFile:
+    """A long-lived `git cat-file --batch` process reading objects on request.
+
+    Sizes and bodies of the objects are read from a single stream, so no
+    process is spawned for each of them. Names of the objects requested at
+    once are pipelined. The process is started by the first request and
+    stopped by `close`.
+    """
+
+    def __init__(self, git, cwd):
+        self.git = git
+        self.cwd = cwd
+        self.sizes = {}
+        self._process = None
+        self._lock = threading.Lock()
+
+    def read(self, names):
+        """Return a list of bodies of the objects, None for the missing ones."""
+        return list(self.iter_read(names))
+
+    def iter_read(self, names):
+        """Yield bodies of the objects, None for the missing ones.
+
+        The names are pipelined, but a body is read from the stream only
+        after the previous one is consumed, so a single body is held at once.
+        The process is locked until the generator is exhausted or closed.
+        """
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._process = self.git.start(["cat-file", "--batch"], cwd=self.cwd)
+
+            finished = False
+            try:
+                for start in range(0, len(names), CAT_FILE_PIPELINE):
+                    chunk = names[start : start + CAT_FILE_PIPELINE]
+                    try:
+                        self._process.stdin.write(
+                            "".join("%s\n" % name for name in chunk).encode("utf-8")
+                        )
+                        self._process.stdin.flush()
+                    except OSError as e:
+                        raise CommandError("git cat-file failed: %s" % e)
+
+                    for name in chunk:
+                        yield self._read_object(name)
+
+                finished = True
+            finally:
+                if not finished:
+                    # Objects left in the stream would be read by the next
+                    # request, the process is started again instead.
+                    process, self._process = self._process, None
+                    process.kill()
+                    process.wait()
+                    self._stop(process)
+
+    def _read_object(self, name):
+        header = self._process.stdout.readline().split()
+        if not header:
+            raise CommandError("git cat-file stopped unexpectedly")
+
+        if header[-1] in (b"missing", b"ambiguous"):
+            return None
+
+        size = int(header[2])
+        body = self._process.stdout.read(size)
+        # Each body is followed by a newline.
+        self._process.stdout.read(1)
+        self.sizes[name] = size
+        return body
+
+    def close(self):
+        """Stop the process, it's started again by the next request."""
+        with self._lock:
+            process, self._process = self._process, None
+
+        if process is not None:
+            self._stop(process)
+
+    @staticmethod
+    def _stop(process):
+        with suppress(BrokenPipeError):
+            process.stdin.close()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            logger.debug("git cat-file has not stopped, killing it")
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+
+class DiffTree:
+    """A single `git diff-tree --stdin` process reading changes of many commits.
+
+    The raw changes and the patches of all the commits are read from one
+    stream, so no process is spawned for each commit or file. The stream is
+    parsed incrementally, changes of a commit are returned by `changes` as
+    soon as its part of the output is read.
+    """
+
+    def __init__(self, git, cwd):
+        self.git = git
+        self.cwd = cwd
+        self._process = None
+        self._writer = None
+        self._buffer = bytearray()
+        self._pos = 0
+        self._changes = {}
+
+    def start(self, nodes, context_size):
+        """Start reading the changes of the commits."""
+        self.close()
+        self._process = self.git.start(
+            [
+                "diff-tree",
+                "--stdin",
+                "--root",
+                "-r",
+                "-z",
+                "--raw",
+                "-p",
+                "-M",
+                "-C",
+                "--no-abbrev",
+                "--full-index",
+                "--submodule=short",
+                "--no-ext-diff",
+                "--no-color",
+                "--no-textconv",
+                "-U%s" % context_size,
+            ],
+            cwd=self.cwd,
+        )
+        # Git stops reading the nodes if its output is not read, they're
+        # written from another thread.
+        self._writer = threading.Thread(
+            target=self._write, args=(self._process.stdin, nodes), daemon=True
+        )
+        self._writer.start()
+
+    @staticmethod
+    def _write(stdin, nodes):
+        with suppress(OSError):
+            stdin.write("".join("%s\n" % node for node in nodes).encode("ascii"))
+            stdin.close()
+
+    def changes(self, node):
+        """Return a list of `(raw, patch)` tuples with changes of the commit.
+
+        `raw` is a change in the `git diff-tree --raw -z` format without the
+        leading colon, `patch` is a list of lines of its hunks or None for
+        a file Git considers binary. Git prints nothing for a commit with no
+        changes, an empty list is returned.
+        """
+        while node not in self._changes and self._process is not None:
+            commit = self._read_commit()
+            if commit is None:
+                self._finish()
+            else:
+                self._changes[commit[0]] = commit[1]
+
+        return self._changes.pop(node, [])
+
+    def _fill(self):
+        chunk = self._process.stdout.read1(DIFF_TREE_CHUNK)
+        if chunk:
+            del self._buffer[: self._pos]
+            self._pos = 0
+            self._buffer += chunk
+
+        return bool(chunk)
+
+    def _read_until(self, separator):
+        """Return the data up to the separator including it, or up to EOF."""
+        searched = 0
+        while True:
+            index = self._buffer.find(separator, self._pos + searched)
+            if index != -1:
+                end = index + len(separator)
+                break
+
+            searched = len(self._buffer) - self._pos
+            if not self._fill():
+                end = len(self._buffer)
+                break
+
+        data = bytes(self._buffer[self._pos : end])
+        self._pos = end
+        return data
+
+    def _peek(self, size):
+        while len(self._buffer) - self._pos < size and self._fill():
+            pass
+
+        return bytes(self._buffer[self._pos : self._pos + size])
+
+    def _read_commit(self):
+        header = self._read_until(b"\0")
+        if not header:
+            return None
+
+        node = header[:-1].decode("ascii")
+        raw_changes = []
+        # Raw changes are followed by an empty field.
+        fields = self._read_until(b"\0")[1:-1].decode("ascii")
+        while fields:
+            status = fields.split(" ")[-1][0]
+            paths = [
+                self._read_until(b"\0")[:-1].decode("utf-8")
+                for _ in range(2 if status in "RC" else 1)
+            ]
+            raw_changes.append(("\0".join([fields] + paths), status))
+            fields = self._read_until(b"\0")[1:-1].decode("ascii")
+
+        changes = []
+        for raw, status in raw_changes:
+            patch = self._read_patch()
+            if status == "T":
+                # A type change is printed as a removal and an addition.
+                added = self._read_patch()
+                patch = None if patch is None or added is None else patch + added
+            changes.append((raw, patch))
+
+        return node, changes
+
+    def _read_patch(self):
+        """Return the hunk lines of the next patch, its header is skipped.
+
+        Git doesn't print the contents of a binary file, None is returned.
+        """
+        self._read_until(b"\n")
+        lines = []
+        binary = False
+        while True:
+            start = self._peek(65)
+            if (
+                not start
+                or start.startswith(b"diff --git ")
+                or DIFF_TREE_COMMIT.match(start)
+            ):
+                return None if binary else lines
+
+            line = self._read_until(b"\n")
+            if lines or line.startswith(b"@@ "):
+                lines.append(line)
+            elif line.startswith(b"Binary files "):
+                binary = True
+
+    def _finish(self):
+        changes = self._changes
+        returncode = self._process.wait()
+        self.close()
+        # Changes of the commits read before are still returned.
+        self._changes = changes
+        if returncode:
+            raise CommandError("git diff-tree failed", returncode)
+
+    def close(self):
+        """Stop the process and drop changes which haven't been read."""
+        process, self._process = self._process, None
+        self._buffer = bytearray()
+        self._pos = 0
+        self._changes = {}
+        if process is None:
+            return
+
+        process.stdout.close()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            logger.debug("git diff-tree has not stopped, killing it")
+            process.kill()
+            process.wait()
+        self._writer.join()
+        with suppress(OSError):
+            process.stdin.close()
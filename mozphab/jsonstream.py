@@ -0,0 +1,262 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import base64
+import codecs
+import json
+import re
+import tempfile
+import uuid
+
+from collections.abc import Sequence
+
+CHUNK_SIZE = 64 * 1024
+
+# Number of bytes base64 encoded at once. A multiple of 3, so the encoded
+# pieces can be concatenated.
+BASE64_CHUNK_SIZE = 3 * 16 * 1024
+
+# Request bodies bigger than this are stored in a temporary file.
+MAX_BODY_IN_MEMORY = 1024 * 1024
+
+# Beginning of a JSON object.
+OBJECT_START = re.compile(r"\s*\{")
+
+# A key of a JSON object followed by the beginning of its value.
+OBJECT_KEY = re.compile(r'\s*"((?:[^"\\]|\\.)*)"\s*:\s*(?=\S)')
+
+# Separator following a value in a JSON object.
+VALUE_END = re.compile(r"\s*([,}])")
+
+# Complete characters and escape sequences of a JSON string.
+STRING_CONTENT = re.compile(r'(?:[^"\\]|\\u[0-9a-fA-F]{4}|\\[^u])*')
+
+
+def _is_high_surrogate(char):
+    return "\ud800" <= char <= "\udbff"
+
+
+def stream_result(response, fileobj, chunk_size=CHUNK_SIZE):
+    """Write the string result of a Conduit response to a binary file.
+
+    The response is read and decoded in chunks, the result is written to the
+    `fileobj` encoded as UTF-8 without being kept in memory as a whole. Other
+    keys of the response may precede the result, their values are parsed.
+
+    Args:
+        response: a file-like object with the JSON response
+        fileobj: a binary file the result is written to
+
+    Returns the response object. Its `result` is None if it has been written
+    to the file. If the result is not a string (i.e. an error has been
+    returned) nothing is written and the whole response is returned.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    json_decoder = json.JSONDecoder()
+    buffer = ""
+    more = True
+
+    def read():
+        chunk = response.read(chunk_size)
+        return decoder.decode(chunk, final=not chunk), bool(chunk)
+
+    def read_more():
+        nonlocal buffer, more
+        if not more:
+            return False
+
+        text, more = read()
+        buffer += text
+        return True
+
+    def whole_response():
+        return json.loads(buffer + decoder.decode(response.read(), final=True))
+
+    while not OBJECT_START.match(buffer):
+        if buffer.strip() or not read_more():
+            return whole_response()
+
+    # Values of other keys preceding the result are kept.
+    fields = {}
+    pos = OBJECT_START.match(buffer).end()
+    while True:
+        key = OBJECT_KEY.match(buffer, pos)
+        name = key and json.loads('"%s"' % key.group(1))
+        if name == "result" and buffer[key.end()] == '"':
+            break
+
+        end = None
+        if key:
+            try:
+                value, value_end = json_decoder.raw_decode(buffer, key.end())
+            except json.JSONDecodeError:
+                pass
+            else:
+                # A number might continue in the next chunk.
+                end = VALUE_END.match(buffer, value_end)
+
+        if not end:
+            if not read_more():
+                return whole_response()
+            continue
+
+        if end.group(1) == "}":
+            # The result is not a string.
+            return whole_response()
+
+        fields[name] = value
+        pos = end.end()
+
+    buffer = buffer[key.end() + 1 :]
+    high_surrogate = ""
+    while True:
+        end = STRING_CONTENT.match(buffer).end()
+        text = high_surrogate + json.loads('"%s"' % buffer[:end])
+        high_surrogate = ""
+        if text and _is_high_surrogate(text[-1]):
+            # The low surrogate might be in the next chunk.
+            text, high_surrogate = text[:-1], text[-1]
+        if text[:1] and _is_high_surrogate(text[0]):
+            text = (
+                text[:2].encode("utf-16", "surrogatepass").decode("utf-16") + text[2:]
+            )
+
+        fileobj.write(text.encode("utf-8"))
+        buffer = buffer[end:]
+        if buffer.startswith('"'):
+            break
+
+        text, more = read()
+        if not more and not text:
+            raise ValueError("Unterminated string in the Conduit response")
+
+        buffer += text
+
+    rest = (buffer[1:] + decoder.decode(response.read(), final=True)).strip()
+    if rest.startswith(","):
+        rest = rest[1:]
+
+    fields.update(json.loads("{%s" % rest))
+    fields["result"] = None
+    return fields
+
+
+class LazyList(Sequence):
+    """List of `func(item)` values computed only when accessed.
+
+    Used for big API call arguments (like changes of a diff) which are
+    serialized one by one by `write_json`.
+    """
+
+    def __init__(self, items, func):
+        self.items = list(items)
+        self.func = func
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.func(item) for item in self.items[index]]
+
+        return self.func(self.items[index])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "<%s of %s items>" % (self.__class__.__name__, len(self))
+
+
+class Base64Data:
+    """Binary data sent as a base64 encoded string.
+
+    The data is kept as a `memoryview` (i.e. a chunk of a file) and encoded
+    piece by piece by `write_json`.
+    """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        return str(self) == other or (
+            isinstance(other, Base64Data) and self.data == other.data
+        )
+
+    def __str__(self):
+        return base64.standard_b64encode(self.data).decode()
+
+    def __repr__(self):
+        return "<%s of %s bytes>" % (self.__class__.__name__, len(self))
+
+    def write(self, fileobj):
+        """Write the encoded data to a binary file."""
+        for start in range(0, len(self.data), BASE64_CHUNK_SIZE):
+            fileobj.write(
+                base64.standard_b64encode(self.data[start : start + BASE64_CHUNK_SIZE])
+            )
+
+
+def write_json(value, fileobj):
+    """Write the value as JSON to a binary file.
+
+    Values of a dict and items of a `LazyList` are serialized one by one,
+    `Base64Data` is encoded in pieces.
+    """
+    if isinstance(value, dict):
+        fileobj.write(b"{")
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                fileobj.write(b", ")
+            fileobj.write(json.dumps(str(key)).encode("utf-8") + b": ")
+            write_json(item, fileobj)
+        fileobj.write(b"}")
+
+    elif isinstance(value, LazyList):
+        fileobj.write(b"[")
+        for i, item in enumerate(value):
+            if i:
+                fileobj.write(b", ")
+            write_json(item, fileobj)
+        fileobj.write(b"]")
+
+    elif isinstance(value, Base64Data):
+        fileobj.write(b'"')
+        value.write(fileobj)
+        fileobj.write(b'"')
+
+    else:
+        fileobj.write(json.dumps(value).encode("utf-8"))
+
+
+def multipart_body(fields):
+    """Return a multipart/form-data body of the fields.
+
+    String values are sent as they are, other values are written as JSON
+    by `write_json`. Unlike the form encoding, no value is escaped.
+
+    Returns a tuple of a file object, its length and the content type.
+    """
+    boundary = "----moz-phab-%s" % uuid.uuid4().hex
+    body = tempfile.SpooledTemporaryFile(max_size=MAX_BODY_IN_MEMORY)
+    for name, value in fields.items():
+        body.write(
+            (
+                '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+                % (boundary, name)
+            ).encode("utf-8")
+        )
+        if isinstance(value, str):
+            body.write(value.encode("utf-8"))
+        else:
+            write_json(value, body)
+        body.write(b"\r\n")
+
+    body.write(("--%s--\r\n" % boundary).encode("utf-8"))
+    length = body.tell()
+    body.seek(0)
+    return body, length, "multipart/form-data; boundary=%s" % boundary
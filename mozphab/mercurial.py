@@ -5,6 +5,7 @@
 import mimetypes
 import os
 import re
+import shutil
 import time
 import uuid
 
@@ -449,7 +450,7 @@ class Mercurial(Repository):
             if not self.args.raw:
                 logger.info("Bookmark set to %s", bookmark_name)
 
-    def apply_patch(self, diff, body, author, author_date):
+    def apply_patch(self, diff_file, body, author, author_date):
         changeset = ["# HG changeset patch"]
         if author:
             changeset.append("# User {}".format(author))
@@ -457,9 +458,12 @@ class Mercurial(Repository):
         if author_date:
             changeset.append("# Date {} 0".format(author_date))
 
-        changeset.extend([body, diff])
+        changeset.extend([body, ""])
         changeset_str = "\n".join(changeset)
         with temporary_binary_file(changeset_str.encode("utf8")) as changeset_file:
+            with open(changeset_file, "ab") as f, open(diff_file, "rb") as diff:
+                shutil.copyfileobj(diff, f)
+
             self.hg(["import", changeset_file, "--quiet"])
 
     def _amend_commit_body(self, node, body):
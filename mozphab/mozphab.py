@@ -17,6 +17,7 @@ from mozphab import environment
 
 from .arcanist import install_arc_if_required
 from .args import parse_args
+from .cassette import Cassette
 from .conduit import conduit
 from .config import config
 from .detect_repository import repo_from_args
@@ -24,7 +25,9 @@ from .exceptions import Error
 from .logger import init_logging, logger
 from .spinner import wait_message
 from .sentry import init_sentry, report_to_sentry
+from .simplecache import persistent_cache
 from .telemetry import telemetry
+from .timings import timings
 from .updater import check_for_updates, get_name_and_version
 
 # Known Issues
@@ -36,6 +39,7 @@ from .updater import check_for_updates, get_name_and_version
 
 
 def main(argv, *, is_development):
+    args = None
     try:
         if not is_development and config.report_to_sentry:
             init_sentry()
@@ -53,6 +57,18 @@ def main(argv, *, is_development):
 
         init_logging()
         logger.debug(get_name_and_version())
+        conduit.set_deadline(config.command_deadline)
+        if args.record_conduit:
+            conduit.set_cassette(Cassette(args.record_conduit))
+        elif args.replay_conduit:
+            conduit.set_cassette(
+                Cassette(args.replay_conduit, replay=True, speed=args.replay_speed)
+            )
+
+        if conduit.cassette is not None:
+            # Every call is recorded or replayed, no cached responses are used
+            # and the replayed ones are not stored.
+            persistent_cache.enabled = False
 
         if not args.no_arc:
             install_arc_if_required()
@@ -69,6 +85,9 @@ def main(argv, *, is_development):
                 repo = repo_from_args(args)
 
             conduit.set_repo(repo)
+            if conduit.cassette is None or not conduit.cassette.replaying:
+                # Open the connection while the local work is being done.
+                conduit.preconnect()
 
         telemetry.set_metrics(args, is_development=is_development)
 
@@ -77,6 +96,7 @@ def main(argv, *, is_development):
             try:
                 args.func(repo, args)
             finally:
+                persistent_cache.save()
                 repo.cleanup()
 
         else:
@@ -98,6 +118,11 @@ def main(argv, *, is_development):
             logger.error("Run moz-phab again with '--trace' to show debugging output")
         report_to_sentry(e)
         sys.exit(1)
+    finally:
+        if conduit.cassette is not None:
+            conduit.cassette.save()
+        if args is not None and args.timings:
+            timings.report()
 
 
 def run():
@@ -4,17 +4,15 @@
 
 from .exceptions import Error
 from .gitcommand import GitCommand
-from .helpers import temporary_binary_file
 from .logger import logger
 
 
-def apply_patch(diff, cwd):
-    """Apply a patch provided in the `diff`."""
+def apply_patch(diff_file, cwd):
+    """Apply a patch stored in the `diff_file`."""
     try:
         git = GitCommand()
     except Error:
         logger.error("Git is required to apply patches.")
         raise
 
-    with temporary_binary_file(diff.encode("utf8")) as temp_f:
-        git.call(["apply", temp_f], cwd=cwd)
+    git.call(["apply", diff_file], cwd=cwd)
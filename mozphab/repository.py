@@ -146,14 +146,20 @@ class Repository(object):
     def amend_commit(self, commit, commits):
         """Amend commit description from `title` and `desc` fields"""
 
+    def prepare_commit(self, commit, commits):
+        """Make sure the commit is written before it's checked out."""
+
+    def prepare_diffs(self, commits):
+        """Prepare to create diffs of the commits with `get_diff`."""
+
     def rebase_commit(self, source_commit, dest_commit):
         """Rebase source onto destination."""
 
     def before_patch(self, node, name):
         """Prepare repository to apply the patches."""
 
-    def apply_patch(self, diff, body, author, author_date):
-        """Apply the patch and commit the changes."""
+    def apply_patch(self, diff_file, body, author, author_date):
+        """Apply the patch stored in the `diff_file` and commit the changes."""
 
     def check_commits_for_submit(
         self, commits, *, validate_reviewers=True, require_bug=True
@@ -270,7 +276,11 @@ class Repository(object):
             logger.warning("Notice: reviewer availability overridden.")
 
     def check_arc(self):
-        """Check if arc can communicate with Phabricator."""
+        """Check if arc can communicate with Phabricator.
+
+        arc is still needed for `arc diff`, even if the API calls are made
+        with the API Token. It's spawned only until it succeeds once.
+        """
         # Check if the cache file exists
         path = os.path.join(self.dot_path, ".moz-phab_arc-configured")
         if os.path.isfile(path):
@@ -2,6 +2,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import json
+import os
+import re
+import threading
+import time
+
+from mozphab import environment
+
+# Number of seconds entries are kept in the persistent cache.
+# Revisions and files are kept longer as they are revalidated before being used
+# (see `ConduitAPI.get_revisions` and `ConduitAPI.file_upload`).
+CACHE_TTL = dict(
+    users=60 * 60,
+    groups=6 * 60 * 60,
+    repositories=7 * 24 * 60 * 60,
+    revisions=24 * 60 * 60,
+    files=30 * 24 * 60 * 60,
+)
+
 
 class SimpleCache:
     """Simple key/value store with all lowercase keys."""
@@ -26,4 +45,107 @@ class SimpleCache:
         self._cache = dict()
 
 
+class PersistentCache:
+    """Key/value store kept on disk between the runs.
+
+    Entries are stored in a file per host and grouped in namespaces. Every
+    namespace has its own time to live (see `CACHE_TTL`). Changes are written
+    to disk by the `save` method. Nothing is read or stored if `enabled` is
+    unset, but entries are still deleted, so outdated values are not read by
+    the next run.
+    """
+
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = ttl or CACHE_TTL
+        self.enabled = True
+        self._hosts = dict()
+        self._modified = set()
+        self._lock = threading.Lock()
+
+    def _filename(self, host):
+        return os.path.join(self.directory, "%s.json" % re.sub(r"[^\w.-]", "_", host))
+
+    def _entries(self, host):
+        """Return entries for the host, load them from the file if needed."""
+        if host in self._hosts:
+            return self._hosts[host]
+
+        try:
+            with open(self._filename(host), encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+
+        if not isinstance(entries, dict):
+            entries = {}
+
+        # Remove expired entries.
+        now = time.time()
+        self._hosts[host] = {}
+        for namespace, ttl in self.ttl.items():
+            self._hosts[host][namespace] = {
+                key: entry
+                for key, entry in entries.get(namespace, {}).items()
+                if now - entry[0] < ttl
+            }
+
+        return self._hosts[host]
+
+    def get_entry(self, host, namespace, key):
+        """Return a `(timestamp, value)` pair or None if not found or expired.
+
+        The timestamp is the time the value was stored.
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries(host)[namespace].get(key.lower())
+
+        if entry is None or time.time() - entry[0] >= self.ttl[namespace]:
+            return None
+
+        return tuple(entry)
+
+    def get(self, host, namespace, key):
+        """Return the value or None if not found or expired."""
+        entry = self.get_entry(host, namespace, key)
+        return None if entry is None else entry[1]
+
+    def set(self, host, namespace, key, value):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._entries(host)[namespace][key.lower()] = [time.time(), value]
+            self._modified.add(host)
+
+    def delete(self, host, namespace, key):
+        with self._lock:
+            if self._entries(host)[namespace].pop(key.lower(), None) is not None:
+                self._modified.add(host)
+
+    def save(self):
+        """Write the modified entries to disk."""
+        with self._lock:
+            modified, self._modified = self._modified, set()
+            if not modified:
+                return
+
+            os.makedirs(self.directory, exist_ok=True)
+            for host in modified:
+                filename = self._filename(host)
+                with open("%s.tmp" % filename, "w", encoding="utf-8") as f:
+                    json.dump(self._hosts[host], f)
+                os.replace("%s.tmp" % filename, filename)
+
+    def reset(self):
+        with self._lock:
+            self._hosts = dict()
+            self._modified = set()
+            self.enabled = True
+
+
 cache = SimpleCache()
+persistent_cache = PersistentCache(os.path.join(environment.MOZBUILD_PATH, "cache"))
@@ -0,0 +1,77 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from .exceptions import NonLinearException
+
+
+class StackGraph:
+    """Dependencies between revisions connected to each other in Phabricator.
+
+    Built from `edge.search` results by `ConduitAPI.get_stack_graph`.
+    `parents` and `children` are dicts of lists of related revision PHIDs keyed
+    by revision PHID.
+    """
+
+    def __init__(self, edges=None):
+        self.parents = {}
+        self.children = {}
+        self.phids = set()
+        for edge in edges or []:
+            self.add_edge(edge)
+
+    def add_edge(self, edge):
+        source = edge["sourcePHID"]
+        destination = edge["destinationPHID"]
+        self.phids.update((source, destination))
+        if edge["edgeType"] == "revision.parent":
+            related = self.parents.setdefault(source, [])
+        else:
+            related = self.children.setdefault(source, [])
+
+        if destination not in related:
+            related.append(destination)
+
+    @property
+    def is_linear(self):
+        return all(len(p) < 2 for p in self.parents.values()) and all(
+            len(c) < 2 for c in self.children.values()
+        )
+
+    def _walk(self, related, phid):
+        result = []
+        while related.get(phid):
+            if len(related[phid]) > 1:
+                raise NonLinearException()
+
+            phid = related[phid][0]
+            if phid in result:
+                raise NonLinearException()
+
+            result.append(phid)
+
+        return result
+
+    def ancestors(self, phid):
+        """Return PHIDs of the revision's ancestors, the closest first.
+
+        Raises NonLinearException if any of them has more than one parent.
+        """
+        return self._walk(self.parents, phid)
+
+    def successors(self, phid):
+        """Return PHIDs of the revision's successors, the closest first.
+
+        Raises NonLinearException if any of them has more than one child.
+        """
+        return self._walk(self.children, phid)
+
+    def ordered(self, phid):
+        """Return the stack containing the revision, the root first.
+
+        Raises NonLinearException if the graph is not a single linear stack.
+        """
+        if not self.is_linear:
+            raise NonLinearException()
+
+        return list(reversed(self.ancestors(phid))) + [phid] + self.successors(phid)
@@ -4,23 +4,55 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import subprocess
+import time
 
 from shlex import quote
 
 from .exceptions import CommandError
 from .logger import logger
+from .timings import command_name, timings
 
 
 def check_call(command, **kwargs):
     # wrapper around subprocess.check_call with debug output
     logger.debug("$ %s", " ".join(quote(s) for s in command))
     kwargs["encoding"] = "UTF-8"
+    start = time.monotonic()
     try:
         subprocess.check_call(command, **kwargs)
     except subprocess.CalledProcessError as e:
         raise CommandError(
             "command '%s' failed to complete successfully" % command[0], e.returncode
         )
+    finally:
+        timings.record("command", command_name(command), time.monotonic() - start)
+
+
+class TimedProcess(subprocess.Popen):
+    """A process recording its wall time in `timings` once it has stopped."""
+
+    def __init__(self, command, **kwargs):
+        self._start = time.monotonic()
+        self._recorded = False
+        super().__init__(command, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout=timeout)
+        if not self._recorded:
+            self._recorded = True
+            timings.record(
+                "command", command_name(self.args), time.monotonic() - self._start
+            )
+        return returncode
+
+
+def start_process(command, cwd=None, env=None):
+    # starts a long-lived process with pipes connected to its stdin and stdout,
+    # its wall time is recorded when it's waited for
+    logger.debug("$ %s &", " ".join(quote(s) for s in command))
+    return TimedProcess(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd, env=env
+    )
 
 
 def check_call_by_line(command, cwd=None, never_log=False):
@@ -29,6 +61,8 @@ def check_call_by_line(command, cwd=None, never_log=False):
 
     # Connecting the STDIN to the PIPE will make arc throw an exception on reading
     # user input
+    start = time.monotonic()
+    received = 0
     process = subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
@@ -38,6 +72,7 @@ def check_call_by_line(command, cwd=None, never_log=False):
     )
     try:
         for line in iter(process.stdout.readline, ""):
+            received += len(line)
             line = line.rstrip()
             if not never_log:
                 logger.debug("> %s", line)
@@ -45,6 +80,12 @@ def check_call_by_line(command, cwd=None, never_log=False):
     finally:
         process.stdout.close()
         process.wait()
+        timings.record(
+            "command",
+            command_name(command),
+            time.monotonic() - start,
+            received=received,
+        )
 
     if process.returncode:
         raise CommandError(
@@ -76,6 +117,8 @@ def check_output(
     if env:
         kwargs["env"] = env
 
+    start = time.monotonic()
+    output = None
     try:
         output = subprocess.check_output(command, **kwargs)
     except subprocess.CalledProcessError as e:
@@ -93,6 +136,13 @@ def check_output(
         raise CommandError(
             "command '%s' failed to complete successfully" % command[0], e.returncode
         )
+    finally:
+        timings.record(
+            "command",
+            command_name(command),
+            time.monotonic() - start,
+            received=len(output or ""),
+        )
 
     if expect_binary:
         logger.debug("%s bytes of data received", len(output))
@@ -0,0 +1,116 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import threading
+
+from .logger import logger
+
+# Options of VCS commands followed by a value.
+OPTIONS_WITH_VALUE = {"-c", "-C", "--config", "--cwd", "-R", "--repository"}
+
+
+def command_name(command):
+    """Return the program and the subcommand (i.e. "git log") of a command."""
+    program = os.path.basename(command[0])
+    args = iter(command[1:])
+    for arg in args:
+        if arg in OPTIONS_WITH_VALUE:
+            next(args, None)
+        elif not arg.startswith("-"):
+            return "%s %s" % (program, arg)
+
+    return program
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0
+
+    index = max(int(round(len(values) * percent / 100.0)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class Timings:
+    """Latencies and transferred bytes of API calls and VCS commands.
+
+    Calls are recorded per category (i.e. "conduit", "bmo" or "command")
+    and name (an API method or a command with its subcommand). The summary
+    is printed by `moz-phab --timings`. Bytes sent to commands aren't
+    counted, the "sent" column shows "-" for them.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, category, name, seconds, sent=0, received=0):
+        with self._lock:
+            stats = self._stats.setdefault(
+                (category, name), dict(latencies=[], sent=0, received=0)
+            )
+            stats["latencies"].append(seconds)
+            stats["sent"] += sent
+            stats["received"] += received
+
+    def summary(self):
+        """Return a list of stats dicts, the longest total time first."""
+        with self._lock:
+            items = [
+                (key, dict(stats, latencies=sorted(stats["latencies"])))
+                for key, stats in self._stats.items()
+            ]
+
+        rows = []
+        for (category, name), stats in items:
+            latencies = stats["latencies"]
+            rows.append(
+                dict(
+                    category=category,
+                    name=name,
+                    count=len(latencies),
+                    total=sum(latencies),
+                    p50=percentile(latencies, 50),
+                    p95=percentile(latencies, 95),
+                    max=latencies[-1],
+                    sent=stats["sent"],
+                    received=stats["received"],
+                )
+            )
+
+        return sorted(rows, key=lambda row: row["total"], reverse=True)
+
+    def report(self):
+        """Log the summary table."""
+        rows = self.summary()
+        if not rows:
+            logger.info("No API calls or commands recorded.")
+            return
+
+        width = max(len(row["name"]) for row in rows)
+        line = "%-8s %-" + str(width) + "s %6s %9s %8s %8s %8s %10s %10s"
+        logger.info(
+            line, "type", "name", "count", "total", "p50", "p95", "max", "sent", "recv"
+        )
+        for row in rows:
+            logger.info(
+                line,
+                row["category"],
+                row["name"],
+                row["count"],
+                "%.3fs" % row["total"],
+                "%.3fs" % row["p50"],
+                "%.3fs" % row["p95"],
+                "%.3fs" % row["max"],
+                "-" if row["category"] == "command" else row["sent"],
+                row["received"],
+            )
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+timings = Timings()
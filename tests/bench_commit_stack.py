@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Measure `Git.commit_stack` on repositories of different sizes.
+
+A repository with a history of the given length and a number of branches
+forking from it is generated with `git fast-import`, a stack of commits is
+added on top of the history and read with `commit_stack`. The time should
+grow with the size of the stack, not with the history or the branches.
+
+Run it with:
+
+    python -m tests.bench_commit_stack --history 1000 --history 50000 \
+        --stack 10 --stack 100
+"""
+
+import argparse
+import json
+import subprocess
+import tempfile
+import time
+
+from pathlib import Path
+
+from mozphab import environment
+from mozphab.git import Git
+
+
+def _commit(ref, mark, parent, message):
+    data = message.encode("utf-8")
+    lines = [
+        "commit %s" % ref,
+        "mark :%s" % mark,
+        "committer Bench <bench@example.com> %s +0000" % (1500000000 + mark),
+        "data %s" % len(data),
+        message,
+    ]
+    if parent:
+        lines.append("from :%s" % parent)
+
+    return "\n".join(lines) + "\n\n"
+
+
+def create_repository(path, history, branches, stack):
+    """Create the `main` history, branches forking from it and the `stack`."""
+    subprocess.check_call(["git", "init", "--quiet", str(path)])
+    (path / ".arcconfig").write_text(
+        json.dumps({"phabricator.uri": "http://phabricator.test"})
+    )
+    commands = []
+    for mark in range(1, history + 1):
+        commands.append(_commit("refs/heads/main", mark, mark - 1, "history %s" % mark))
+
+    mark = history
+    for branch in range(branches):
+        mark += 1
+        fork = 1 + branch * history // max(branches, 1)
+        commands.append(
+            _commit("refs/heads/branch%s" % branch, mark, fork, "branch %s" % branch)
+        )
+
+    parent = history
+    for index in range(stack):
+        mark += 1
+        commands.append(_commit("refs/heads/stack", mark, parent, "stack %s" % index))
+        parent = mark
+
+    subprocess.run(
+        ["git", "fast-import", "--quiet"],
+        input="".join(commands).encode("utf-8"),
+        cwd=str(path),
+        check=True,
+    )
+
+
+def measure(history, branches, stack, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)
+        create_repository(path, history, branches, stack)
+        git = Git(str(path))
+        git.revset = ("main", "stack")
+        timings = []
+        for _ in range(repeat):
+            start = time.monotonic()
+            commits = git.commit_stack()
+            timings.append(time.monotonic() - start)
+
+        assert len(commits) == stack
+        return min(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--history",
+        action="append",
+        type=int,
+        help="Number of commits in the history (default 1000 and 20000)",
+    )
+    parser.add_argument(
+        "--stack",
+        action="append",
+        type=int,
+        help="Number of commits in the stack (default 10 and 100)",
+    )
+    parser.add_argument("--branches", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    environment.SHOW_SPINNER = False
+    print("%10s %10s %10s %10s" % ("history", "branches", "stack", "seconds"))
+    for history in args.history or [1000, 20000]:
+        for stack in args.stack or [10, 100]:
+            seconds = measure(history, args.branches, stack, args.repeat)
+            print("%10s %10s %10s %10.3f" % (history, args.branches, stack, seconds))
+
+
+if __name__ == "__main__":
+    main()
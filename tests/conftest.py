@@ -19,6 +19,7 @@ from mozphab.mercurial import Mercurial
 from mozphab import (
     arcanist,
     conduit,
+    connectionpool,
     environment,
     mozphab,
     repository,
@@ -60,8 +61,27 @@ def init_sha(in_process, git_repo_path, git_sha):
 
 
 @pytest.fixture(autouse=True)
-def reset_cache():
+def reset_cache(tmp_path):
     simplecache.cache.reset()
+    simplecache.persistent_cache.reset()
+    simplecache.persistent_cache.directory = str(tmp_path / "conduit-cache")
+
+
+@pytest.fixture(autouse=True)
+def reset_connection_pool():
+    connectionpool.connection_pool.clear()
+
+
+@pytest.fixture()
+def raw_diff_from_call():
+    """Get raw diffs from `ConduitAPI.call`, which is usually mocked in tests."""
+
+    def get_raw_diff(self, diff_id, fileobj):
+        raw = self.call("differential.getrawdiff", {"diffID": diff_id})
+        fileobj.write(raw.encode("utf-8"))
+
+    with mock.patch("mozphab.conduit.ConduitAPI.get_raw_diff", get_raw_diff):
+        yield
 
 
 @pytest.fixture()
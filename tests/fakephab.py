@@ -0,0 +1,728 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""A local stand-in for the Phabricator Conduit API.
+
+Implements the API methods used by moz-phab over plain HTTP, so the whole
+client (connection handling, request encoding, concurrency) can be measured
+on a single machine. Per-method latency, error injection and padding of
+the responses are configurable.
+
+Run it with:
+
+    python -m tests.fakephab --port 8080 --latency 'differential.*=0.2'
+
+and use it with the `HTTP_ALLOWED` environment variable set and
+`phabricator.uri` of the repository pointing to `http://127.0.0.1:8080/`.
+"""
+
+import argparse
+import base64
+import fnmatch
+import gzip
+import hashlib
+import http.server
+import itertools
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+
+# Stack dependency in the summary of a revision.
+DEPENDS_ON = re.compile(r"^Depends on D(\d+)", re.MULTILINE)
+
+# Revision statuses set by the transactions.
+STATUSES = {
+    "needs-review": dict(name="Needs Review", closed=False),
+    "changes-planned": dict(name="Changes Planned", closed=False),
+    "abandoned": dict(name="Abandoned", closed=True),
+}
+STATUS_TRANSACTIONS = {
+    "plan-changes": "changes-planned",
+    "request-review": "needs-review",
+    "abandon": "abandoned",
+}
+
+SEARCH_LIMIT = 100
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class ConduitError(Exception):
+    """Returned to the client as an `error_code`/`error_info` response.
+
+    Raised with the error code and the description.
+    """
+
+
+class FakePhabricator:
+    """In-memory Phabricator state and the Conduit methods using it.
+
+    Args:
+        latency: dict of seconds each call sleeps, keyed by a method name
+            pattern (i.e. "differential.*")
+        errors: dict of `(rate, kind)` pairs keyed by a method name pattern,
+            `kind` is "conduit" (an API error), "http" (a 500 response) or
+            "drop" (the connection is closed without a response)
+        padding: dict of the number of bytes added to the responses, keyed by
+            a method name pattern
+        seed: seed of the random error injection
+    """
+
+    def __init__(self, latency=None, errors=None, padding=None, seed=None):
+        self.latency = dict(latency or {})
+        self.errors = dict(errors or {})
+        self.padding = dict(padding or {})
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.calls = []
+
+        self._ids = itertools.count(1)
+        self.users = {}
+        self.projects = {}
+        self.repositories = {}
+        self.revisions = {}
+        self.diffs = {}
+        self.files = {}
+        self.parents = {}
+
+        self.methods = {
+            "conduit.ping": self.ping,
+            "user.whoami": self.whoami,
+            "user.query": self.user_query,
+            "project.search": self.project_search,
+            "diffusion.repository.search": self.repository_search,
+            "edge.search": self.edge_search,
+            "differential.revision.search": self.revision_search,
+            "differential.revision.edit": self.revision_edit,
+            "differential.diff.search": self.diff_search,
+            "differential.creatediff": self.create_diff,
+            "differential.setdiffproperty": self.set_diff_property,
+            "differential.getrawdiff": self.get_raw_diff,
+            "file.allocate": self.file_allocate,
+            "file.upload": self.file_upload,
+            "file.querychunks": self.file_querychunks,
+            "file.uploadchunk": self.file_uploadchunk,
+            "file.search": self.file_search,
+        }
+        self.user = self.add_user("fake")
+
+    @staticmethod
+    def _match(settings, method, default=None):
+        for pattern, value in settings.items():
+            if fnmatch.fnmatchcase(method, pattern):
+                return value
+
+        return default
+
+    def _phid(self, kind):
+        return "PHID-%s-%s" % (kind, next(self._ids))
+
+    def latency_of(self, method):
+        return self._match(self.latency, method, 0)
+
+    def padding_of(self, method):
+        return self._match(self.padding, method, 0)
+
+    def error_of(self, method):
+        """Return the kind of the error injected into the call or None."""
+        rate, kind = self._match(self.errors, method, (0, None))
+        with self.lock:
+            if rate and self.random.random() < rate:
+                return kind
+
+        return None
+
+    def call(self, method, params):
+        """Return the result of the API method."""
+        with self.lock:
+            self.calls.append(method)
+            if method not in self.methods:
+                raise ConduitError(
+                    "ERR-CONDUIT-CALL", "Method %s does not exist." % method
+                )
+
+            return self.methods[method](**params)
+
+    # Data
+
+    def add_user(self, name, **fields):
+        user = dict(
+            phid=self._phid("USER"),
+            userName=name,
+            realName=name.capitalize(),
+            roles=["verified", "approved", "activated"],
+            **fields
+        )
+        self.users[name.lower()] = user
+        return user
+
+    def add_project(self, slug):
+        project = dict(id=next(self._ids), phid=self._phid("PROJ"), slug=slug)
+        self.projects[slug] = project
+        return project
+
+    def add_repository(self, callsign, vcs="git"):
+        repo = dict(
+            id=next(self._ids),
+            phid=self._phid("REPO"),
+            fields=dict(name=callsign.lower(), callsign=callsign, vcs=vcs),
+        )
+        self.repositories[callsign] = repo
+        return repo
+
+    def children(self, phid):
+        return [child for child, parents in self.parents.items() if phid in parents]
+
+    # Searches
+
+    @staticmethod
+    def _page(items, limit=SEARCH_LIMIT, after=None, **extra):
+        start = int(after or 0)
+        end = start + int(limit or SEARCH_LIMIT)
+        return dict(
+            data=items[start:end],
+            cursor=dict(
+                limit=limit, after=str(end) if end < len(items) else None, before=None
+            ),
+            **extra
+        )
+
+    @staticmethod
+    def _matches(item, constraints, fields=("ids", "phids")):
+        for field in fields:
+            values = constraints.get(field)
+            if values is not None and str(item[field[:-1]]) not in map(str, values):
+                return False
+
+        return True
+
+    def ping(self):
+        return "fakephab"
+
+    def whoami(self):
+        return self.user
+
+    def user_query(self, usernames=(), phids=()):
+        return [
+            user
+            for user in self.users.values()
+            if user["userName"].lower() in {name.lower() for name in usernames}
+            or user["phid"] in phids
+        ]
+
+    def project_search(self, constraints=None, queryKey=None, limit=None, after=None):
+        slugs = (constraints or {}).get("slugs") or []
+        projects = [self.projects[slug] for slug in slugs if slug in self.projects]
+        return self._page(
+            [
+                dict(id=p["id"], phid=p["phid"], fields=dict(slug=p["slug"]))
+                for p in projects
+            ],
+            limit,
+            after,
+            maps=dict(
+                slugMap={
+                    p["slug"]: dict(slug=p["slug"], projectPHID=p["phid"])
+                    for p in projects
+                }
+            ),
+        )
+
+    def repository_search(self, constraints=None, limit=None, after=None):
+        callsigns = (constraints or {}).get("callsigns") or []
+        return self._page(
+            [self.repositories[c] for c in callsigns if c in self.repositories],
+            limit,
+            after,
+        )
+
+    def edge_search(self, sourcePHIDs=(), types=(), limit=None, after=None):
+        edges = []
+        for phid in sourcePHIDs:
+            related = []
+            if "revision.parent" in types:
+                related += [("revision.parent", p) for p in self.parents.get(phid, [])]
+            if "revision.child" in types:
+                related += [("revision.child", c) for c in self.children(phid)]
+
+            edges.extend(
+                dict(sourcePHID=phid, edgeType=edge_type, destinationPHID=destination)
+                for edge_type, destination in related
+            )
+
+        return self._page(edges, limit, after)
+
+    def revision_search(
+        self, constraints=None, attachments=None, limit=None, after=None, order=None
+    ):
+        constraints = constraints or {}
+        attachments = attachments or {}
+        modified_start = constraints.get("modifiedStart")
+        revisions = []
+        for revision in sorted(self.revisions.values(), key=lambda r: -r["id"]):
+            if not self._matches(revision, constraints):
+                continue
+
+            fields = revision["fields"]
+            if modified_start is not None and fields["dateModified"] < modified_start:
+                continue
+
+            result = dict(revision, attachments={})
+            if attachments.get("reviewers"):
+                result["attachments"]["reviewers"] = dict(
+                    reviewers=[
+                        dict(
+                            reviewerPHID=phid,
+                            status="added",
+                            isBlocking=blocking,
+                            actorPHID=None,
+                        )
+                        for phid, blocking in revision["reviewers"]
+                    ]
+                )
+            del result["reviewers"]
+            revisions.append(result)
+
+        return self._page(revisions, limit, after)
+
+    def diff_search(self, constraints=None, attachments=None, limit=None, after=None):
+        constraints = constraints or {}
+        diffs = []
+        for diff in sorted(self.diffs.values(), key=lambda d: -d["id"]):
+            if not self._matches(diff, constraints):
+                continue
+
+            result = dict(
+                id=diff["id"],
+                type="DIFF",
+                phid=diff["phid"],
+                fields=diff["fields"],
+                attachments={},
+            )
+            if (attachments or {}).get("commits"):
+                result["attachments"]["commits"] = dict(commits=diff["commits"])
+            diffs.append(result)
+
+        return self._page(diffs, limit, after)
+
+    # Revisions and diffs
+
+    def revision_edit(self, transactions, objectIdentifier=None):
+        now = int(time.time())
+        if objectIdentifier is None:
+            revision = dict(
+                id=next(self._ids),
+                type="DREV",
+                phid=self._phid("DREV"),
+                reviewers=[],
+                fields={
+                    "title": "",
+                    "summary": "",
+                    "authorPHID": self.user["phid"],
+                    "status": dict(value="needs-review", **STATUSES["needs-review"]),
+                    "diffPHID": None,
+                    "repositoryPHID": None,
+                    "bugzilla.bug-id": "",
+                    "dateCreated": now,
+                    "dateModified": now,
+                },
+            )
+        else:
+            revision = self._revision(objectIdentifier)
+
+        phid = revision["phid"]
+        fields = revision["fields"]
+        applied = []
+        for transaction in transactions:
+            kind = transaction["type"]
+            value = transaction.get("value")
+            if kind in ("title", "summary", "bugzilla.bug-id"):
+                fields[kind] = value
+                if kind == "summary":
+                    depends_on = DEPENDS_ON.search(value or "")
+                    if depends_on:
+                        parent = self._revision(int(depends_on.group(1)))
+                        self.parents[phid] = [parent["phid"]]
+            elif kind == "update":
+                diff = self._diff(phid=value)
+                diff["fields"]["revisionPHID"] = phid
+                fields["diffPHID"] = value
+            elif kind == "reviewers.set":
+                revision["reviewers"] = [
+                    (re.sub(r"^blocking\((.*)\)$", r"\1", r), r.startswith("blocking("))
+                    for r in value
+                ]
+            elif kind in STATUS_TRANSACTIONS:
+                status = STATUS_TRANSACTIONS[kind]
+                fields["status"] = dict(value=status, **STATUSES[status])
+            elif kind == "parents.set":
+                self.parents[phid] = list(value)
+            elif kind == "children.set":
+                for child in self.children(phid):
+                    self.parents[child].remove(phid)
+                for child in value:
+                    self.parents.setdefault(child, []).append(phid)
+            elif kind == "children.remove":
+                for child in value:
+                    if phid in self.parents.get(child, []):
+                        self.parents[child].remove(phid)
+            elif kind != "comment":
+                raise ConduitError(
+                    "ERR-CONDUIT-CALL", "Transaction type %s is not supported." % kind
+                )
+
+            applied.append(dict(phid=self._phid("XACT")))
+
+        fields["dateModified"] = now
+        self.revisions[revision["id"]] = revision
+        return dict(object=dict(id=revision["id"], phid=phid), transactions=applied)
+
+    def _revision(self, identifier):
+        for revision in self.revisions.values():
+            if identifier in (revision["id"], str(revision["id"]), revision["phid"]):
+                return revision
+
+        raise ConduitError("ERR-CONDUIT-CORE", "Revision %s not found." % identifier)
+
+    def _diff(self, id=None, phid=None):
+        for diff in self.diffs.values():
+            if diff["id"] == id or diff["phid"] == phid:
+                return diff
+
+        raise ConduitError("ERR-CONDUIT-CORE", "Diff %s not found." % (id or phid))
+
+    def create_diff(self, changes, sourceControlBaseRevision=None, **kwargs):
+        now = int(time.time())
+        diff_id = next(self._ids)
+        diff = dict(
+            id=diff_id,
+            phid=self._phid("DIFF"),
+            changes=changes,
+            properties={},
+            commits=[],
+            fields=dict(
+                revisionPHID=None,
+                authorPHID=self.user["phid"],
+                repositoryPHID=kwargs.get("repositoryPHID"),
+                refs=[dict(type="base", identifier=sourceControlBaseRevision)],
+                dateCreated=now,
+                dateModified=now,
+            ),
+        )
+        self.diffs[diff_id] = diff
+        return dict(
+            diffid=diff_id, phid=diff["phid"], uri="/differential/diff/%s/" % diff_id
+        )
+
+    def set_diff_property(self, diff_id, name, data):
+        diff = self._diff(id=int(diff_id))
+        diff["properties"][name] = data
+        if name == "local:commits":
+            diff["commits"] = [
+                dict(
+                    identifier=commit["commit"],
+                    tree=commit.get("tree"),
+                    parents=commit["parents"],
+                    author=dict(
+                        name=commit["author"],
+                        email=commit["authorEmail"],
+                        raw="%s <%s>" % (commit["author"], commit["authorEmail"]),
+                        epoch=commit["time"],
+                    ),
+                    message=commit["message"],
+                )
+                for commit in json.loads(data).values()
+            ]
+
+    def get_raw_diff(self, diffID):
+        lines = []
+        for change in self._diff(id=int(diffID))["changes"]:
+            old_path = change["oldPath"] or change["currentPath"]
+            new_path = change["currentPath"]
+            lines.append("diff --git a/%s b/%s" % (old_path, new_path))
+            if change["type"] == 1:
+                lines.append("new file mode 100644")
+            elif change["type"] == 3:
+                lines.append("deleted file mode 100644")
+            lines.append(
+                "--- %s" % ("/dev/null" if change["type"] == 1 else "a/" + old_path)
+            )
+            lines.append(
+                "+++ %s" % ("/dev/null" if change["type"] == 3 else "b/" + new_path)
+            )
+            for hunk in change["hunks"]:
+                lines.append(
+                    "@@ -%s,%s +%s,%s @@"
+                    % (
+                        hunk["oldOffset"],
+                        hunk["oldLength"],
+                        hunk["newOffset"],
+                        hunk["newLength"],
+                    )
+                )
+                lines.append(hunk["corpus"].rstrip("\n"))
+
+        return "\n".join(lines) + "\n"
+
+    # Files
+
+    def file_allocate(self, name, contentLength, contentHash=None):
+        for phid, stored in self.files.items():
+            if contentHash and stored["hash"] == contentHash:
+                return dict(upload=False, filePHID=phid)
+
+        if contentLength <= CHUNK_SIZE:
+            return dict(upload=True, filePHID=None)
+
+        phid = self._phid("FILE")
+        self.files[phid] = dict(
+            name=name, hash=contentHash, data=bytearray(contentLength), received=set(),
+        )
+        return dict(upload=True, filePHID=phid)
+
+    def _chunks(self, stored):
+        length = len(stored["data"])
+        return [
+            (start, min(start + CHUNK_SIZE, length))
+            for start in range(0, length, CHUNK_SIZE)
+        ]
+
+    def file_upload(self, data_base64, name=None):
+        data = base64.standard_b64decode(data_base64)
+        phid = self._phid("FILE")
+        self.files[phid] = dict(
+            name=name,
+            hash=hashlib.sha256(data).hexdigest(),
+            data=bytearray(data),
+            received={0},
+        )
+        return phid
+
+    def file_querychunks(self, filePHID):
+        stored = self.files[filePHID]
+        return [
+            dict(
+                byteStart=str(start),
+                byteEnd=str(end),
+                complete=start in stored["received"],
+            )
+            for start, end in self._chunks(stored)
+        ]
+
+    def file_uploadchunk(self, filePHID, byteStart, data, dataEncoding):
+        stored = self.files[filePHID]
+        chunk = base64.standard_b64decode(data)
+        stored["data"][byteStart : byteStart + len(chunk)] = chunk
+        stored["received"].add(byteStart)
+
+    def file_search(self, constraints=None, limit=None, after=None):
+        phids = (constraints or {}).get("phids") or []
+        return self._page(
+            [
+                dict(phid=phid, fields=dict(name=self.files[phid]["name"]))
+                for phid in phids
+                if phid in self.files
+            ],
+            limit,
+            after,
+        )
+
+
+def parse_multipart(body, content_type):
+    """Return a dict of the multipart/form-data fields."""
+    boundary = content_type.split("boundary=", 1)[1].encode("utf-8")
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+
+        headers, value = part.split(b"\r\n\r\n", 1)
+        name = re.search(rb'name="([^"]*)"', headers)
+        if name:
+            fields[name.group(1).decode("utf-8")] = value[: -len(b"\r\n")].decode(
+                "utf-8"
+            )
+
+    return fields
+
+
+class ConduitHandler(http.server.BaseHTTPRequestHandler):
+    """Serve `POST /api/<method>` requests of the Conduit API."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _params(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type") or ""
+        if content_type.startswith("multipart/form-data"):
+            fields = parse_multipart(body, content_type)
+        else:
+            fields = {
+                key: values[0]
+                for key, values in urllib.parse.parse_qs(body.decode("utf-8")).items()
+            }
+
+        params = json.loads(fields.get("params") or "{}")
+        params.pop("__conduit__", None)
+        return params
+
+    def _send(self, status, body):
+        data = body.encode("utf-8")
+        encoded = "gzip" in (self.headers.get("Accept-Encoding") or "")
+        if encoded:
+            data = gzip.compress(data, compresslevel=1)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if encoded:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        phabricator = self.server.phabricator
+        method = self.path.rstrip("/").rsplit("/", 1)[-1]
+        params = self._params()
+
+        latency = phabricator.latency_of(method)
+        if latency:
+            time.sleep(latency)
+
+        error = phabricator.error_of(method)
+        if error == "drop":
+            self.close_connection = True
+            return
+        if error == "http":
+            self._send(500, "Internal Server Error")
+            return
+
+        response = dict(result=None, error_code=None, error_info=None)
+        try:
+            if error == "conduit":
+                raise ConduitError("ERR-CONDUIT-CORE", "Injected error.")
+            response["result"] = phabricator.call(method, params)
+        except ConduitError as e:
+            response["error_code"], response["error_info"] = e.args
+
+        padding = phabricator.padding_of(method)
+        if padding:
+            response["padding"] = "x" * padding
+
+        self._send(200, json.dumps(response))
+
+
+class FakePhabricatorServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server of a `FakePhabricator`, each request served in a thread."""
+
+    daemon_threads = True
+
+    def __init__(self, phabricator=None, host="127.0.0.1", port=0, verbose=False):
+        super().__init__((host, port), ConduitHandler)
+        self.phabricator = phabricator or FakePhabricator()
+        self.verbose = verbose
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%s/" % self.server_address[:2]
+
+    def start(self):
+        """Serve the requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _setting(value, convert):
+    pattern, _sep, setting = value.rpartition("=")
+    if not pattern:
+        raise argparse.ArgumentTypeError("Expected METHOD=VALUE, got %s" % value)
+
+    return pattern, convert(setting)
+
+
+def _error(setting):
+    rate, _sep, kind = setting.partition(":")
+    if (kind or "conduit") not in ("conduit", "http", "drop"):
+        raise argparse.ArgumentTypeError("Unknown error kind %s" % kind)
+
+    return float(rate), kind or "conduit"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        type=lambda value: _setting(value, float),
+        metavar="METHOD=SECONDS",
+        help="Delay the responses of the methods matching the pattern",
+    )
+    parser.add_argument(
+        "--error",
+        action="append",
+        default=[],
+        type=lambda value: _setting(value, _error),
+        metavar="METHOD=RATE[:KIND]",
+        help="Fail a share of the calls with a conduit, http or drop error",
+    )
+    parser.add_argument(
+        "--padding",
+        action="append",
+        default=[],
+        type=lambda value: _setting(value, int),
+        metavar="METHOD=BYTES",
+        help="Add the number of bytes to the responses",
+    )
+    parser.add_argument("--seed", type=int, help="Seed of the error injection")
+    parser.add_argument("--repository", default="TEST", help="Repository callsign")
+    parser.add_argument("--user", action="append", default=[], dest="users")
+    parser.add_argument("--project", action="append", default=[], dest="projects")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    phabricator = FakePhabricator(
+        latency=dict(args.latency),
+        errors=dict(args.error),
+        padding=dict(args.padding),
+        seed=args.seed,
+    )
+    phabricator.add_repository(args.repository)
+    for name in args.users:
+        phabricator.add_user(name)
+    for slug in args.projects:
+        phabricator.add_project(slug)
+
+    server = FakePhabricatorServer(
+        phabricator, host=args.host, port=args.port, verbose=args.verbose
+    )
+    print("Serving the Conduit API at %sapi/" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import mock
+
+from mozphab.args import parse_args
+
+
+@mock.patch("mozphab.args.find_repo_root")
+def test_global_options_before_command(m_find_repo_root):
+    m_find_repo_root.return_value = "/repo"
+
+    args = parse_args(["--timings", "submit"])
+    assert args.command == "submit"
+    assert args.timings
+    assert args.start_rev == "(auto)"
+
+    args = parse_args(["--record-conduit", "f.json", "submit", "HEAD~2"])
+    assert args.command == "submit"
+    assert args.record_conduit == "f.json"
+    assert args.start_rev == "HEAD~2"
+
+    # Submit is the default command within a repository.
+    args = parse_args(["--timings", "HEAD~2"])
+    assert args.command == "submit"
+    assert args.timings
+    assert args.start_rev == "HEAD~2"
+
+    args = parse_args(["--replay-conduit", "f.json", "--replay-speed", "0"])
+    assert args.command == "submit"
+    assert args.replay_conduit == "f.json"
+    assert args.replay_speed == 0
+
+
+@mock.patch("mozphab.args.find_repo_root")
+def test_command_outside_of_repository(m_find_repo_root):
+    m_find_repo_root.return_value = None
+
+    args = parse_args(["--timings", "version"])
+    assert args.command == "version"
+    assert args.timings
@@ -26,10 +26,10 @@ def test_whoami(m_conduit, m_get):
 
 
 @mock.patch("mozphab.bmo.conduit")
-@mock.patch("mozphab.bmo.HTTPConnection")
-@mock.patch("mozphab.bmo.HTTPSConnection")
+@mock.patch("mozphab.connectionpool.HTTPConnection")
+@mock.patch("mozphab.connectionpool.HTTPSConnection")
 @mock.patch("mozphab.bmo.urllib.parse")
-@mock.patch("mozphab.bmo.environment")
+@mock.patch("mozphab.connectionpool.environment")
 @mock.patch("mozphab.bmo.json")
 def test_call(m_json, m_env, m_parse, m_https, m_http, m_conduit):
     bmo = BMOAPI()
@@ -42,6 +42,9 @@ def test_call(m_json, m_env, m_parse, m_https, m_http, m_conduit):
     m_parse.urljoin.return_value = "http://bmo/rest/someapi"
     m_parse.urlparse.return_value = url
     m_json.loads.return_value = dict(success=True)
+    response = m_http.return_value.getresponse.return_value
+    response.getheader.return_value = None
+    response.read.return_value = b""
 
     url.get_url.reset_mock()
     assert dict(success=True) == bmo.call("someapi", "GET")
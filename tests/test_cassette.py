@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import json
+from contextlib import contextmanager
+
+import mock
+import pytest
+
+from mozphab.cassette import Cassette, plain
+from mozphab.conduit import ConduitAPI, ConduitAPIError
+from mozphab.exceptions import Error
+from mozphab.jsonstream import Base64Data, LazyList
+from mozphab.timings import timings
+
+
+def fake_post(responses):
+    @contextmanager
+    def post(self, api_method, api_call_args):
+        yield io.BytesIO(json.dumps(responses.pop(0)).encode("utf-8"))
+
+    return post
+
+
+def test_plain():
+    assert plain(
+        {
+            "__conduit__": {"token": "cli-secret"},
+            "changes": LazyList([1, 2], lambda x: {"x": x}),
+            "data": Base64Data(b"abc"),
+        }
+    ) == {
+        "__conduit__": "<scrubbed>",
+        "changes": [{"x": 1}, {"x": 2}],
+        "data": {
+            "sha256": (
+                "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+            ),
+            "length": 3,
+        },
+    }
+
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / "cassette.json")
+    api = ConduitAPI(max_in_flight=1)
+    api.set_cassette(Cassette(path))
+    responses = [
+        dict(result="pong", error_code=None, error_info=None),
+        dict(result=None, error_code="ERR", error_info="failed"),
+        dict(result="diff", error_code=None, error_info=None),
+    ]
+    with mock.patch("mozphab.conduit.ConduitAPI._post", fake_post(responses)):
+        assert api.call("conduit.ping", {}) == "pong"
+        with pytest.raises(ConduitAPIError):
+            api.call("differential.revision.edit", {"transactions": []})
+
+        fileobj = io.BytesIO()
+        api.get_raw_diff(1, fileobj)
+        assert fileobj.getvalue() == b"diff"
+
+    api.cassette.save()
+    with open(path) as f:
+        recorded = json.load(f)
+    assert [i["method"] for i in recorded["interactions"]] == [
+        "conduit.ping",
+        "differential.revision.edit",
+        "differential.getrawdiff",
+    ]
+
+    api.set_cassette(Cassette(path, replay=True, speed=0))
+    timings.reset()
+    with mock.patch("mozphab.conduit.ConduitAPI._post") as m_post:
+        fileobj = io.BytesIO()
+        api.get_raw_diff(1, fileobj)
+        assert fileobj.getvalue() == b"diff"
+        with pytest.raises(ConduitAPIError):
+            api.call("differential.revision.edit", {"transactions": [1]})
+        assert api.call("conduit.ping", {}) == "pong"
+        with pytest.raises(Error):
+            api.call("conduit.ping", {})
+
+    m_post.assert_not_called()
+    # Replayed calls are timed.
+    assert [name for _category, name in timings._stats] == [
+        "differential.getrawdiff",
+        "differential.revision.edit",
+        "conduit.ping",
+    ]
+    timings.reset()
+
+
+@mock.patch("mozphab.cassette.time")
+def test_replay_latency(m_time, tmp_path):
+    path = tmp_path / "cassette.json"
+    path.write_text(
+        json.dumps(
+            dict(
+                version=1,
+                interactions=[
+                    dict(method="a", params={}, response={"x": 1}, latency=2),
+                    dict(method="a", params={"y": 1}, response={"x": 2}, latency=2),
+                ],
+            )
+        )
+    )
+    cassette = Cassette(str(path), replay=True, speed=4)
+    # The exact match is used first.
+    assert cassette.play("a", {"y": 1}) == {"x": 2}
+    assert cassette.play("a", {"y": 1}) == {"x": 1}
+    m_time.sleep.assert_called_with(0.5)
+
+    path.write_text("{}")
+    with pytest.raises(Error):
+        Cassette(str(path), replay=True)
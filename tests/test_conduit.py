@@ -3,7 +3,11 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import base64
+import hashlib
+import io
 import json
+import threading
 import mock
 import pytest
 from contextlib import contextmanager
@@ -11,7 +15,15 @@ from frozendict import frozendict
 
 from mozphab import diff, exceptions, mozphab, repository, simplecache
 
-from mozphab.conduit import conduit, ConduitAPIError
+from mozphab.conduit import (
+    conduit,
+    ConduitAPI,
+    ConduitAPIError,
+    FILE_REFRESH_INTERVAL,
+    REVISION_REFRESH_MARGIN,
+    RevisionEdit,
+)
+from mozphab.jsonstream import LazyList
 
 
 class Repo:
@@ -39,14 +51,40 @@ def test_load_api_token(m_read):
     assert mozphab.conduit.load_api_token() == "x"
 
 
-@mock.patch("mozphab.conduit.HTTPSConnection")
+@mock.patch("mozphab.conduit.read_json_field")
+def test_has_api_token(m_read):
+    m_read.return_value = False
+    mozphab.conduit.set_repo(Repo())
+    assert not mozphab.conduit.has_api_token()
+
+    m_read.return_value = "x"
+    assert mozphab.conduit.has_api_token()
+
+
+class HTTPResponse(io.BytesIO):
+    status = 200
+    reason = "OK"
+
+    def getheader(self, name, default=None):
+        return default
+
+    def isclosed(self):
+        return self.tell() == len(self.getvalue())
+
+
+def http_response(data):
+    return HTTPResponse(data)
+
+
+@mock.patch("mozphab.connectionpool.HTTPSConnection")
 @mock.patch("mozphab.conduit.ConduitAPI.load_api_token")
 def test_call(m_token, m_Connect):
     conn = mock.Mock()
     m_Connect.return_value = conn
-    from io import BytesIO
 
-    conn.getresponse.return_value = BytesIO(b'{"result": "x", "error_code": false}')
+    conn.getresponse.return_value = http_response(
+        b'{"result": "x", "error_code": false}'
+    )
     m_token.return_value = "token"
     mozphab.conduit.set_repo(Repo())
 
@@ -59,9 +97,12 @@ def test_call(m_token, m_Connect):
         "%22token%22%3A+%22token%22%7D%7D&"
         "output=json"
         "&__conduit__=True",
+        headers={"Accept-Encoding": "gzip, deflate"},
     )
 
-    conn.getresponse.return_value = BytesIO(b'{"result": "x", "error_code": false}')
+    conn.getresponse.return_value = http_response(
+        b'{"result": "x", "error_code": false}'
+    )
     assert mozphab.conduit.call("method", dict(call="ćwikła")) == "x"
     conn.request.assert_called_with(
         "POST",
@@ -69,11 +110,16 @@ def test_call(m_token, m_Connect):
         body="params=%7B%22call%22%3A+%22%5Cu0107wik%5Cu0142a%22%2C+"
         "%22__conduit__%22%3A+%7B%22token%22%3A+%22token%22%7D%7D"
         "&output=json&__conduit__=True",
+        headers={"Accept-Encoding": "gzip, deflate"},
     )
+    # The kept-alive connection has been reused.
+    m_Connect.assert_called_once_with("api_url", timeout=60)
 
     m_Connect.reset_mock()
     conn.reset_mock()
-    conn.getresponse.return_value = BytesIO(b'{"result": "x", "error_code": false}')
+    conn.getresponse.return_value = http_response(
+        b'{"result": "x", "error_code": false}'
+    )
     assert mozphab.conduit.call("method", dict(empty_dict={}, empty_list=[])) == "x"
     conn.request.assert_called_once_with(
         "POST",
@@ -81,14 +127,308 @@ def test_call(m_token, m_Connect):
         body="params=%7B%22empty_dict%22%3A+%7B%7D%2C+%22empty_list%22%3A+"
         "%5B%5D%2C+%22__conduit__%22%3A+%7B%22token%22%3A+%22token%22%7D%7D"
         "&output=json&__conduit__=True",
+        headers={"Accept-Encoding": "gzip, deflate"},
     )
 
-    conn.getresponse.return_value = BytesIO(b'{"error_info": "x", "error_code": 1}')
+    conn.getresponse.return_value = http_response(
+        b'{"error_info": "x", "error_code": 1}'
+    )
 
     with pytest.raises(ConduitAPIError):
         mozphab.conduit.call("method", dict(call="args"))
 
 
+@mock.patch("mozphab.connectionpool.HTTPSConnection")
+@mock.patch("mozphab.conduit.ConduitAPI.load_api_token")
+def test_call_multipart(m_token, m_Connect):
+    m_token.return_value = "token"
+    conn = m_Connect.return_value
+    bodies = []
+    conn.request.side_effect = lambda *args, body, headers: bodies.append(body.read())
+    conn.getresponse.return_value = http_response(
+        b'{"result": "x", "error_code": null}'
+    )
+    mozphab.conduit.set_repo(Repo())
+
+    changes = LazyList(["a"], lambda path: dict(currentPath=path))
+    assert mozphab.conduit.call("method", dict(changes=changes)) == "x"
+    headers = conn.request.call_args[1]["headers"]
+    assert headers["Content-Type"].startswith("multipart/form-data; boundary=")
+    assert headers["Content-Length"] == str(len(bodies[0]))
+    assert (
+        b'name="params"\r\n\r\n'
+        b'{"changes": [{"currentPath": "a"}], "__conduit__": {"token": "token"}}\r\n'
+    ) in bodies[0]
+
+
+@mock.patch("mozphab.connectionpool.HTTPSConnection")
+@mock.patch("mozphab.conduit.ConduitAPI.load_api_token")
+def test_get_raw_diff(m_token, m_Connect):
+    m_token.return_value = "token"
+    conn = m_Connect.return_value
+    conn.getresponse.return_value = http_response(
+        b'{"result": "diff \\u0107\\n", "error_code": null, "error_info": null}'
+    )
+    mozphab.conduit.set_repo(Repo())
+    f = io.BytesIO()
+    mozphab.conduit.get_raw_diff(1, f)
+    assert f.getvalue() == "diff \u0107\n".encode("utf-8")
+    assert conn.request.call_args[1]["body"].startswith(
+        "params=%7B%22diffID%22%3A+1%2C"
+    )
+
+    conn.getresponse.return_value = http_response(
+        b'{"result": null, "error_code": "ERR", "error_info": "x"}'
+    )
+    with pytest.raises(ConduitAPIError):
+        mozphab.conduit.get_raw_diff(1, io.BytesIO())
+
+
+@mock.patch("mozphab.conduit.time.sleep")
+@mock.patch("mozphab.conduit.ConduitAPI._call")
+def test_call_retry(m_call, m_sleep):
+    conduit = ConduitAPI()
+    conduit.retries = 2
+    m_call.side_effect = (ConnectionResetError, ValueError, "x")
+    assert conduit.call("user.query", {}) == "x"
+    assert m_call.call_count == 3
+    assert m_sleep.call_count == 2
+
+    # Only network errors are retried.
+    m_call.reset_mock()
+    m_call.side_effect = (ConduitAPIError, "x")
+    with pytest.raises(ConduitAPIError):
+        conduit.call("differential.revision.search", {})
+
+    # All retries failed.
+    m_call.reset_mock()
+    m_call.side_effect = OSError
+    with pytest.raises(OSError):
+        conduit.call("edge.search", {})
+    assert m_call.call_count == 3
+
+    # Methods changing data are not retried.
+    m_call.reset_mock()
+    with pytest.raises(OSError):
+        conduit.call("differential.revision.edit", {})
+    m_call.assert_called_once()
+
+
+@mock.patch("mozphab.conduit.time")
+def test_deadline(m_time):
+    conduit = ConduitAPI()
+    conduit.timeout = 60
+    m_time.monotonic.return_value = 100
+    assert conduit._get_timeout() == 60
+
+    conduit.set_deadline(30)
+    assert conduit._get_timeout() == 30
+    m_time.monotonic.return_value = 120
+    assert conduit._get_timeout() == 10
+    m_time.monotonic.return_value = 130
+    with pytest.raises(ConduitAPIError):
+        conduit._get_timeout()
+
+    conduit.set_deadline(0)
+    assert conduit._get_timeout() == 60
+
+
+@mock.patch("mozphab.conduit.ConduitAPI._call")
+def test_hedged_call(m_call):
+    conduit = ConduitAPI()
+    conduit.hedge_percentile = 50
+    m_call.return_value = "x"
+    # Not enough latencies recorded.
+    assert conduit._hedged_call("user.query", {}) == "x"
+    m_call.assert_called_once()
+
+    for _ in range(10):
+        conduit._record_latency("user.query", 0.01)
+
+    release = threading.Event()
+
+    def call(api_method, api_call_args):
+        if m_call.call_count == 1:
+            # The first request is stalled.
+            release.wait(5)
+            return "slow"
+        return "fast"
+
+    m_call.reset_mock()
+    m_call.side_effect = call
+    assert conduit._hedged_call("user.query", {}) == "fast"
+    assert m_call.call_count == 2
+    release.set()
+
+
+def test_single_flight():
+    conduit = ConduitAPI()
+    started = threading.Event()
+    release = threading.Event()
+    fetched = []
+
+    def fetch(keys):
+        fetched.append(keys)
+        if len(fetched) == 1:
+            started.set()
+            release.wait(5)
+        return {key: key.upper() for key in keys if key != "missing"}
+
+    first = threading.Thread(
+        target=conduit._single_flight, args=(["a", "b", "missing"], fetch)
+    )
+    first.start()
+    started.wait(5)
+    second = conduit.executor.submit(conduit._single_flight, ["b", "c"], fetch)
+    # Only the keys not being fetched are queried.
+    while len(fetched) < 2:
+        pass
+    release.set()
+    first.join()
+
+    assert second.result() == {"b": "B", "c": "C"}
+    assert fetched == [["a", "b", "missing"], ["c"]]
+    assert conduit._in_flight == {}
+
+    assert conduit._single_flight(["missing"], fetch) == {"missing": None}
+
+
+def test_single_flight_error():
+    conduit = ConduitAPI()
+    started = threading.Event()
+    waiting = threading.Event()
+    release = threading.Event()
+
+    def fetch(keys):
+        if keys == ["b"]:
+            # The waiter has registered for the pending "a" key.
+            waiting.set()
+            return {}
+
+        started.set()
+        release.wait(5)
+        raise ConduitAPIError("failed")
+
+    owner = conduit.executor.submit(conduit._single_flight, ["a"], fetch)
+    started.wait(5)
+    waiter = conduit.executor.submit(conduit._single_flight, ["a", "b"], fetch)
+    waiting.wait(5)
+    release.set()
+
+    for future in (owner, waiter):
+        with pytest.raises(ConduitAPIError):
+            future.result()
+
+    assert conduit._in_flight == {}
+
+
+@mock.patch("mozphab.conduit.ConduitAPI.search_pages")
+def test_get_groups_single_flight(m_search_pages):
+    conduit = ConduitAPI()
+    started = threading.Event()
+    release = threading.Event()
+    queried = []
+
+    def search_pages(method, args):
+        slugs = args["constraints"]["slugs"]
+        queried.append(slugs)
+        if len(queried) == 1:
+            started.set()
+            release.wait(5)
+        data = [
+            dict(fields=dict(slug=s.lstrip("#").lower()), phid="PHID-%s" % s)
+            for s in slugs
+        ]
+        return [dict(data=data, maps=dict(slugMap={}))]
+
+    m_search_pages.side_effect = search_pages
+    first = conduit.executor.submit(conduit.get_groups, ["#group-a", "#group-b"])
+    started.wait(5)
+    second = conduit.executor.submit(conduit.get_groups, ["#Group-B!", "#group-c"])
+    # Only the groups not being queried are searched for.
+    while len(queried) < 2:
+        pass
+    release.set()
+
+    assert [g["name"] for g in first.result()] == ["group-a", "group-b"]
+    assert [g["name"] for g in second.result()] == ["group-b", "group-c"]
+    assert queried == [["#group-a", "#group-b"], ["#group-c"]]
+    assert conduit._in_flight == {}
+
+
+@mock.patch("mozphab.conduit.ConduitAPI._hedged_call")
+def test_call_single_flight(m_hedged_call):
+    conduit = ConduitAPI()
+    started = threading.Event()
+    release = threading.Event()
+
+    def call(api_method, api_call_args):
+        started.set()
+        release.wait(5)
+        return ["result"]
+
+    m_hedged_call.side_effect = call
+    first = conduit.executor.submit(
+        conduit.call, "user.search", {"constraints": {"ids": [1]}, "limit": 10}
+    )
+    started.wait(5)
+    # Calls with the same arguments in a different order share the request.
+    key = (
+        "call",
+        "user.search",
+        json.dumps({"limit": 10, "constraints": {"ids": [1]}}, sort_keys=True),
+    )
+    assert list(conduit._in_flight) == [key]
+    release.set()
+
+    assert first.result() == ["result"]
+    assert conduit._in_flight == {}
+
+
+@mock.patch("mozphab.conduit.ConduitAPI.get_groups")
+@mock.patch("mozphab.conduit.ConduitAPI.get_users")
+@mock.patch("mozphab.conduit.ConduitAPI.whoami")
+@mock.patch("mozphab.conduit.ConduitAPI.get_revisions")
+def test_prefetch(m_get_revisions, m_whoami, m_get_users, m_get_groups):
+    conduit = ConduitAPI(max_in_flight=2)
+    commits = [
+        {"rev-id": "1", "reviewers": {"granted": ["Alice"], "request": ["#Group!"]}},
+        {"rev-id": None, "reviewers": {"granted": [], "request": ["bob!", "alice"]}},
+    ]
+    m_get_revisions.return_value = [dict(fields=dict(authorPHID="PHID-USER-1"))]
+    conduit.prefetch(commits).result()
+
+    m_get_revisions.assert_called_once_with(ids=[1], attachments=["reviewers"])
+    m_whoami.assert_called_once_with()
+    m_get_users.assert_called_once_with(["alice", "bob"])
+    m_get_groups.assert_called_once_with(["#group"])
+
+    # Without existing revisions there's no author to check.
+    m_whoami.reset_mock()
+    m_get_revisions.return_value = []
+    conduit.prefetch(commits).result()
+    m_whoami.assert_not_called()
+
+    m_get_users.reset_mock()
+    m_get_revisions.side_effect = ConduitAPIError
+    # Errors are ignored.
+    conduit.prefetch(commits, reviewers=False).result()
+    m_get_users.assert_not_called()
+
+    assert ConduitAPI(max_in_flight=1).prefetch(commits) is None
+
+
+@mock.patch("mozphab.conduit.connection_pool")
+def test_preconnect(m_pool):
+    conduit = ConduitAPI(max_in_flight=2)
+    conduit.repo = mock.Mock(api_url="https://phab.test/api/")
+    conduit.preconnect().result()
+    m_pool.preconnect.assert_called_once_with("https://phab.test/api/", timeout=60)
+
+    conduit.max_in_flight = 1
+    assert conduit.preconnect() is None
+
+
 @mock.patch("mozphab.conduit.ConduitAPI.call")
 def test_ping(m_call):
     m_call.return_value = {}
@@ -160,8 +500,7 @@ def test_get_revisions_search_by_revid(get_revs, m_call):
 
     assert len(get_revs(ids=[1])) == 1
     m_call.assert_called_with(
-        "differential.revision.search",
-        dict(constraints=dict(ids=[1]), attachments=dict(reviewers=True)),
+        "differential.revision.search", dict(constraints=dict(ids=[1])),
     )
 
 
@@ -171,8 +510,7 @@ def test_get_revisions_search_by_phid(get_revs, m_call):
 
     assert len(get_revs(phids=["PHID-1"])) == 1
     m_call.assert_called_with(
-        "differential.revision.search",
-        dict(constraints=dict(phids=["PHID-1"]), attachments=dict(reviewers=True)),
+        "differential.revision.search", dict(constraints=dict(phids=["PHID-1"])),
     )
 
 
@@ -182,19 +520,25 @@ def test_get_revisions_search_by_revid_with_dups(get_revs, m_call):
 
     assert len(get_revs(ids=[1, 1])) == 2
     m_call.assert_called_with(
-        "differential.revision.search",
-        dict(constraints=dict(ids=[1]), attachments=dict(reviewers=True)),
+        "differential.revision.search", dict(constraints=dict(ids=[1])),
     )
 
 
+def test_get_revisions_missing_not_queried_again(get_revs, m_call):
+    m_call.return_value = basic_phab_result
+
+    assert len(get_revs(ids=[1, 2])) == 1
+    assert len(get_revs(ids=[1, 2])) == 1
+    m_call.assert_called_once()
+
+
 def test_get_revisions_search_by_phid_with_dups(get_revs, m_call):
     """differential.revision.search by phid with duplicates"""
     m_call.return_value = basic_phab_result
 
     assert len(get_revs(phids=["PHID-1", "PHID-1"])) == 2
     m_call.assert_called_with(
-        "differential.revision.search",
-        dict(constraints=dict(phids=["PHID-1"]), attachments=dict(reviewers=True)),
+        "differential.revision.search", dict(constraints=dict(phids=["PHID-1"])),
     )
 
 
@@ -239,6 +583,411 @@ def test_get_revisions_search_by_revids_missing(get_revs, m_call):
     ]
 
 
+def test_get_revisions_persistent_cache(get_revs, m_call):
+    m_call.return_value = basic_phab_result
+    get_revs(ids=[1])
+
+    # A next run only has the persistent cache.
+    simplecache.cache.reset()
+    assert get_revs(ids=[1]) == [dict(id=1, phid="PHID-1")]
+    assert get_revs(phids=["PHID-1"]) == [dict(id=1, phid="PHID-1")]
+    m_call.assert_called_once()
+
+
+@mock.patch("time.time")
+def test_get_revisions_refresh(m_time, get_revs, m_call):
+    m_time.return_value = 1000
+    m_call.return_value = multiple_phab_result
+    get_revs(ids=[1, 2, 3])
+
+    # Stale revisions are refreshed with the modified ones only.
+    simplecache.cache.reset()
+    m_time.return_value = 2000
+    m_call.return_value = dict(data=[dict(id=2, phid="PHID-2", changed=True)])
+    assert get_revs(ids=[1, 2, 3, 4]) == [
+        dict(id=1, phid="PHID-1"),
+        dict(id=2, phid="PHID-2", changed=True),
+        dict(id=3, phid="PHID-3"),
+    ]
+    assert m_call.call_args_list[1] == mock.call(
+        "differential.revision.search",
+        dict(
+            constraints=dict(
+                phids=["PHID-1", "PHID-2", "PHID-3"],
+                modifiedStart=1000 - REVISION_REFRESH_MARGIN,
+            ),
+        ),
+    )
+    # Revision 4 is not cached.
+    assert m_call.call_args_list[2] == mock.call(
+        "differential.revision.search", dict(constraints=dict(ids=[4])),
+    )
+
+    # Refreshed revisions are stored as current.
+    simplecache.cache.reset()
+    m_call.reset_mock()
+    assert get_revs(phids=["PHID-2"]) == [dict(id=2, phid="PHID-2", changed=True)]
+    m_call.assert_not_called()
+
+    # Revisions requested fresh are refreshed even if they're current.
+    m_call.return_value = dict(data=[dict(id=2, phid="PHID-2", title="edited")])
+    assert get_revs(ids=[2], fresh=True) == [dict(id=2, phid="PHID-2", title="edited")]
+    m_call.assert_called_once_with(
+        "differential.revision.search",
+        dict(
+            constraints=dict(
+                phids=["PHID-2"], modifiedStart=2000 - REVISION_REFRESH_MARGIN
+            ),
+        ),
+    )
+
+    # Revisions received by the process are current.
+    m_call.reset_mock()
+    assert get_revs(ids=[2], fresh=True) == [dict(id=2, phid="PHID-2", title="edited")]
+    m_call.assert_not_called()
+
+
+def test_get_revisions_attachments(get_revs, m_call):
+    m_call.return_value = dict(data=[dict(id=1, phid="PHID-1", attachments={})])
+    get_revs(ids=[1])
+
+    # Only the missing attachments are queried.
+    reviewers = dict(reviewers=[])
+    m_call.return_value = dict(
+        data=[dict(id=1, phid="PHID-1", attachments=dict(reviewers=reviewers))]
+    )
+    assert get_revs(ids=[1], attachments=["reviewers"]) == [
+        dict(id=1, phid="PHID-1", attachments=dict(reviewers=reviewers))
+    ]
+    assert m_call.call_args == mock.call(
+        "differential.revision.search",
+        dict(constraints=dict(ids=[1]), attachments=dict(reviewers=True)),
+    )
+
+    # Attachments are kept if the revision is received without them.
+    m_call.reset_mock()
+    m_call.return_value = dict(
+        data=[
+            dict(id=1, phid="PHID-1", attachments=dict(commits=[])),
+            dict(id=2, phid="PHID-2", attachments=dict(commits=[])),
+        ]
+    )
+    assert get_revs(ids=[1, 2], attachments=["commits"]) == [
+        dict(id=1, phid="PHID-1", attachments=dict(reviewers=reviewers, commits=[])),
+        dict(id=2, phid="PHID-2", attachments=dict(commits=[])),
+    ]
+    assert m_call.call_args == mock.call(
+        "differential.revision.search",
+        dict(constraints=dict(ids=[1, 2]), attachments=dict(commits=True)),
+    )
+
+    m_call.reset_mock()
+    get_revs(phids=["PHID-1", "PHID-2"], attachments=["commits"])
+    get_revs(phids=["PHID-1"], attachments=["reviewers", "commits"])
+    m_call.assert_not_called()
+
+
+@mock.patch("time.time")
+def test_get_revisions_refresh_attachments(m_time, get_revs, m_call):
+    m_time.return_value = 1000
+    m_call.return_value = dict(
+        data=[dict(id=1, phid="PHID-1", attachments=dict(reviewers=[]))]
+    )
+    get_revs(ids=[1], attachments=["reviewers"])
+
+    # Modified revisions are received with the cached attachments.
+    simplecache.cache.reset()
+    m_time.return_value = 2000
+    m_call.return_value = dict(data=[])
+    get_revs(ids=[1])
+    assert m_call.call_args == mock.call(
+        "differential.revision.search",
+        dict(
+            constraints=dict(
+                phids=["PHID-1"], modifiedStart=1000 - REVISION_REFRESH_MARGIN,
+            ),
+            attachments=dict(reviewers=True),
+        ),
+    )
+
+
+@mock.patch("time.time")
+def test_file_upload_index(m_time, m_call):
+    mozphab.conduit.set_repo(repository.Repository("", "", "dummy"))
+    upload = mozphab.conduit.file_upload
+    m_time.return_value = 1000
+    m_call.side_effect = (
+        # file.allocate
+        dict(filePHID="PHID-FILE-1", upload=False),
+    )
+    assert upload("a.png", b"data") == "PHID-FILE-1"
+    m_call.assert_called_once_with(
+        "file.allocate",
+        dict(
+            name="a.png",
+            contentLength=4,
+            contentHash=hashlib.sha256(b"data").hexdigest(),
+        ),
+    )
+
+    # The same content is not uploaded again, neither in a next run.
+    m_call.reset_mock()
+    assert upload("b.png", b"data") == "PHID-FILE-1"
+    simplecache.cache.reset()
+    assert upload("c.png", b"data") == "PHID-FILE-1"
+    m_call.assert_not_called()
+
+    # An old entry is checked.
+    simplecache.cache.reset()
+    m_time.return_value = 1000 + FILE_REFRESH_INTERVAL
+    m_call.side_effect = (
+        # file.search
+        dict(data=[dict(phid="PHID-FILE-1")]),
+    )
+    assert upload("a.png", b"data") == "PHID-FILE-1"
+    m_call.assert_called_once_with(
+        "file.search", dict(constraints=dict(phids=["PHID-FILE-1"]))
+    )
+
+    # A file deleted in Phabricator is uploaded again.
+    simplecache.cache.reset()
+    m_time.return_value = 1000 + 2 * FILE_REFRESH_INTERVAL
+    m_call.reset_mock()
+    m_call.side_effect = (
+        # file.search
+        dict(data=[]),
+        # file.allocate
+        dict(filePHID=None, upload=True),
+        # file.upload
+        "PHID-FILE-2",
+    )
+    assert upload("a.png", b"data") == "PHID-FILE-2"
+    assert m_call.call_count == 3
+
+
+def test_file_upload_chunks(m_call):
+    mozphab.conduit.set_repo(repository.Repository("", "", "dummy"))
+    received = {}
+    failed = []
+
+    def call(api_method, api_call_args):
+        if api_method == "file.allocate":
+            return dict(filePHID="PHID-FILE-1", upload=True)
+
+        if api_method == "file.querychunks":
+            return [
+                dict(
+                    byteStart=str(start),
+                    byteEnd=str(start + 4),
+                    complete=start in received,
+                )
+                for start in (0, 4, 8)
+            ]
+
+        start = api_call_args["byteStart"]
+        if start == 4 and not failed:
+            failed.append(start)
+            raise ConnectionResetError
+
+        received[start] = base64.standard_b64decode(str(api_call_args["data"]))
+        return {}
+
+    m_call.side_effect = call
+    assert mozphab.conduit.file_upload("a.bin", b"0123456789") == "PHID-FILE-1"
+    assert received == {0: b"0123", 4: b"4567", 8: b"89"}
+    # The upload is resumed with the missing chunk only.
+    assert [c[0][0] for c in m_call.call_args_list[-2:]] == [
+        "file.querychunks",
+        "file.uploadchunk",
+    ]
+    assert m_call.call_args[0][1]["byteStart"] == 4
+
+
+@mock.patch("mozphab.conduit.SEARCH_CHUNK_SIZE", 2)
+def test_search(m_call):
+    conduit = ConduitAPI(max_in_flight=1)
+    m_call.side_effect = (
+        dict(data=[1, 2], cursor=dict(after="2")),
+        dict(data=[3], cursor=dict(after=None)),
+    )
+    assert list(conduit.search("x.search", dict(constraints=dict(ids=[1])))) == [
+        1,
+        2,
+        3,
+    ]
+    assert m_call.call_args_list == [
+        mock.call("x.search", dict(constraints=dict(ids=[1]))),
+        mock.call("x.search", dict(constraints=dict(ids=[1]), after="2")),
+    ]
+
+    # Long constraint lists are split.
+    m_call.reset_mock()
+    m_call.side_effect = (dict(data=[1, 2]), dict(data=[3]))
+    assert list(conduit.search("x.search", dict(constraints=dict(ids=[1, 2, 3])))) == [
+        1,
+        2,
+        3,
+    ]
+    assert m_call.call_args_list == [
+        mock.call("x.search", dict(constraints=dict(ids=[1, 2]))),
+        mock.call("x.search", dict(constraints=dict(ids=[3]))),
+    ]
+
+
+def test_search_prefetch(m_call):
+    m_call.side_effect = (
+        dict(data=[1], cursor=dict(after="1")),
+        dict(data=[2], cursor=dict(after=None)),
+    )
+    conduit = ConduitAPI(max_in_flight=2)
+    with mock.patch.object(conduit, "call_async", wraps=conduit.call_async) as m_async:
+        pages = conduit.search_pages("x.search", {}, prefetch=True)
+        assert next(pages)["data"] == [1]
+        # The next page has been requested before the first one was processed.
+        m_async.assert_called_once_with("x.search", dict(after="1"))
+        assert next(pages)["data"] == [2]
+        assert list(pages) == []
+
+
+def test_edit_revision_invalidates_cache(get_revs, m_call):
+    m_call.return_value = basic_phab_result
+    get_revs(ids=[1])
+
+    m_call.return_value = dict(object=dict(id=1, phid="PHID-1"))
+    mozphab.conduit.edit_revision(rev_id=1)
+
+    simplecache.cache.reset()
+    m_call.return_value = basic_phab_result
+    get_revs(ids=[1])
+    assert m_call.call_count == 3
+
+
+def test_invalidate_revision_id(get_revs, m_call):
+    m_call.return_value = basic_phab_result
+    get_revs(ids=[1])
+
+    # i.e. the revision has been updated by arc.
+    mozphab.conduit.invalidate_revision_id("1")
+    mozphab.conduit.invalidate_revision_id(None)
+    simplecache.cache.reset()
+    get_revs(ids=[1])
+    assert m_call.call_count == 2
+
+
+def test_revision_edit():
+    revision = dict(id=1, fields={"title": "A", "bugzilla.bug-id": "1"})
+    edit = RevisionEdit(revision)
+    assert edit.rev_id == 1
+    edit.set_field("title", "A")
+    edit.set_field("bugzilla.bug-id", "2")
+    edit.set_field("summary", "")
+    edit.add("bugzilla.bug-id", "3")
+    edit.add("request-review")
+    assert edit.has("summary")
+    assert list(edit) == [
+        dict(type="summary", value=""),
+        dict(type="bugzilla.bug-id", value="3"),
+        dict(type="request-review"),
+    ]
+
+    # Transactions of the caller are kept as given.
+    edit = RevisionEdit(rev_id=1)
+    edit.extend(
+        [
+            dict(type="children.remove", value=["PHID-2"]),
+            dict(type="children.set", value=["PHID-3"]),
+            dict(type="children.set", value=["PHID-4"]),
+        ]
+    )
+    edit.append(dict(type="children.remove", value=["PHID-5"]))
+    edit.add("update", "PHID-DIFF-1")
+    assert list(edit) == [
+        dict(type="children.remove", value=["PHID-2"]),
+        dict(type="children.set", value=["PHID-3"]),
+        dict(type="children.set", value=["PHID-4"]),
+        dict(type="children.remove", value=["PHID-5"]),
+        dict(type="update", value="PHID-DIFF-1"),
+    ]
+
+
+def test_update_revision_single_call(m_call):
+    revision = {
+        "id": 1,
+        "phid": "PHID-1",
+        "fields": {
+            "title": "A",
+            "summary": "B",
+            "bugzilla.bug-id": "1",
+            "status": {"value": "needs-review"},
+        },
+    }
+    commit = {"rev-id": "1", "title": "A", "body": "B", "bug-id": "1"}
+    m_call.return_value = dict(object=dict(id=1, phid="PHID-1"))
+
+    # Nothing has changed.
+    assert mozphab.conduit.update_revision(commit, False, [], revision=revision) is None
+    m_call.assert_not_called()
+
+    mozphab.conduit.update_revision(
+        commit, False, [], diff_phid="PHID-DIFF-1", wip=True, revision=revision
+    )
+    m_call.assert_called_once_with(
+        "differential.revision.edit",
+        dict(
+            transactions=[
+                dict(type="update", value="PHID-DIFF-1"),
+                dict(type="plan-changes", value=True),
+            ],
+            objectIdentifier="1",
+        ),
+    )
+
+
+def test_update_revision_changes_planned(m_call):
+    revision = {
+        "id": 1,
+        "phid": "PHID-1",
+        "fields": {
+            "title": "A",
+            "summary": "B",
+            "status": {"value": "changes-planned"},
+        },
+    }
+    commit = {"rev-id": "1", "title": "A", "body": "B", "bug-id": None}
+    m_call.return_value = dict(object=dict(id=1, phid="PHID-1"))
+
+    # The revision is WIP already.
+    mozphab.conduit.update_revision(
+        commit, False, [], wip=True, comment="C", revision=revision
+    )
+    m_call.assert_called_once_with(
+        "differential.revision.edit",
+        dict(transactions=[dict(type="comment", value="C")], objectIdentifier="1"),
+    )
+
+    # A diff update moves the revision back to review.
+    m_call.reset_mock()
+    mozphab.conduit.update_revision(
+        commit, False, [], diff_phid="PHID-DIFF-1", wip=True, revision=revision
+    )
+    assert m_call.call_args_list == [
+        mock.call(
+            "differential.revision.edit",
+            dict(
+                transactions=[dict(type="update", value="PHID-DIFF-1")],
+                objectIdentifier="1",
+            ),
+        ),
+        mock.call(
+            "differential.revision.edit",
+            dict(
+                transactions=[dict(type="plan-changes", value=True)],
+                objectIdentifier="1",
+            ),
+        ),
+    ]
+
+
 @mock.patch("mozphab.conduit.ConduitAPI.call")
 def test_get_diffs(m_call):
     conduit = mozphab.conduit
@@ -255,27 +1004,35 @@ def test_get_diffs(m_call):
     }
 
 
+def edge(source, destination, edge_type="revision.parent"):
+    return dict(sourcePHID=source, destinationPHID=destination, edgeType=edge_type)
+
+
 @mock.patch("mozphab.conduit.ConduitAPI.call")
 def test_get_related_phids(m_call):
     get_related_phids = mozphab.conduit.get_related_phids
 
-    m_call.return_value = {}
+    m_call.return_value = dict(data=[])
     assert [] == get_related_phids("aaa", include_abandoned=True)
     m_call.assert_called_once_with(
-        "edge.search", {"sourcePHIDs": ["aaa"], "types": ["revision.parent"]}
+        "edge.search",
+        {
+            "sourcePHIDs": ["aaa"],
+            "types": ["revision.parent", "revision.child"],
+            "limit": 10000,
+        },
     )
 
     m_call.side_effect = [
-        dict(data=[dict(destinationPHID="bbb")]),
-        dict(data=[dict(destinationPHID="aaa")]),
-        dict(),
+        dict(data=[edge("ccc", "bbb")]),
+        dict(data=[edge("bbb", "aaa"), edge("bbb", "ccc", "revision.child")]),
+        dict(data=[edge("aaa", "bbb", "revision.child")]),
     ]
     assert ["bbb", "aaa"] == get_related_phids("ccc", include_abandoned=True)
 
+    # Edges are memoized.
+    m_call.reset_mock()
     m_call.side_effect = [
-        dict(data=[dict(destinationPHID="bbb")]),
-        dict(data=[dict(destinationPHID="aaa")]),
-        dict(),
         dict(
             data=[
                 dict(id=1, phid="aaa", fields=dict(status=dict(value="-"))),
@@ -284,6 +1041,34 @@ def test_get_related_phids(m_call):
         ),
     ]
     assert ["aaa"] == get_related_phids("ccc", include_abandoned=False)
+    m_call.assert_called_once_with(
+        "differential.revision.search", mock.ANY,
+    )
+    assert [] == mozphab.conduit.get_successor_phids("ccc")
+
+
+@mock.patch("mozphab.conduit.ConduitAPI.call")
+def test_get_stack_graph(m_call):
+    m_call.side_effect = [
+        dict(data=[edge("bbb", "aaa"), edge("bbb", "ccc", "revision.child")]),
+        dict(
+            data=[
+                edge("aaa", "bbb", "revision.child"),
+                edge("ccc", "bbb"),
+                edge("ccc", "ddd", "revision.child"),
+                edge("ccc", "eee", "revision.child"),
+            ]
+        ),
+        dict(data=[edge("ddd", "ccc"), edge("eee", "ccc")]),
+    ]
+    graph = mozphab.conduit.get_stack_graph(["bbb"])
+    assert m_call.call_count == 3
+    assert sorted(m_call.call_args_list[1][0][1]["sourcePHIDs"]) == ["aaa", "ccc"]
+    assert sorted(m_call.call_args_list[2][0][1]["sourcePHIDs"]) == ["ddd", "eee"]
+    assert not graph.is_linear
+    assert graph.ancestors("bbb") == ["aaa"]
+    with pytest.raises(exceptions.NonLinearException):
+        graph.successors("bbb")
 
 
 @mock.patch("builtins.open")
@@ -435,3 +1220,65 @@ def test_diff_property(m_call, git, hg):
             ),
         },
     )
+
+
+@mock.patch("mozphab.conduit.ConduitAPI.call")
+def test_call_many(m_call):
+    api = ConduitAPI(max_in_flight=4)
+    m_call.side_effect = lambda method, args: "%s-%s" % (method, args["id"])
+
+    assert api.call_many([("a", dict(id=1)), ("b", dict(id=2)), ("c", dict(id=3))]) == [
+        "a-1",
+        "b-2",
+        "c-3",
+    ]
+    assert m_call.call_count == 3
+
+
+@mock.patch("mozphab.conduit.ConduitAPI.call")
+def test_call_many_errors(m_call):
+    api = ConduitAPI(max_in_flight=4)
+
+    def call(method, args):
+        if method == "ok":
+            return "ok"
+        raise ConduitAPIError(method)
+
+    m_call.side_effect = call
+    with pytest.raises(ConduitAPIError) as e:
+        api.call_many([("ok", {}), ("first", {}), ("second", {})])
+
+    assert str(e.value) == "first\nsecond"
+    # All calls are finished even if one of them fails.
+    assert m_call.call_count == 3
+
+    m_call.reset_mock()
+    with pytest.raises(ConduitAPIError) as e:
+        api.call_many([("only", {}), ("ok", {})])
+
+    assert str(e.value) == "only"
+    assert m_call.call_count == 2
+
+
+def test_submit_sequential():
+    api = ConduitAPI(max_in_flight=1)
+    future = api.submit(lambda x: x * 2, 2)
+    assert future.done()
+    assert future.result() == 4
+    assert api._executor is None
+
+    future = api.submit(lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        future.result()
+
+
+def test_submit_nested_runs_inline():
+    api = ConduitAPI(max_in_flight=2)
+
+    def outer():
+        inner = api.submit(lambda: "inner")
+        # Nested tasks don't wait for a free worker.
+        assert inner.done()
+        return inner.result()
+
+    assert api.gather([api.submit(outer), api.submit(outer)]) == ["inner", "inner"]
@@ -0,0 +1,232 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import io
+import mock
+import pytest
+import urllib.parse
+import zlib
+
+from http.client import RemoteDisconnected
+
+from mozphab.connectionpool import ConnectionPool, DecodedResponse
+from mozphab.exceptions import CommandError
+
+URL = urllib.parse.urlparse("https://phab.test/api/conduit.ping")
+
+
+def fake_response(data=b"", encoding=None):
+    response = mock.Mock()
+    response.getheader.return_value = encoding
+    response.read.side_effect = io.BytesIO(data).read
+    response.isclosed.return_value = True
+    return response
+
+
+def fake_connection(*args, **kwargs):
+    conn = mock.Mock()
+    conn.getresponse.return_value = fake_response()
+    return conn
+
+
+@pytest.fixture
+def m_https():
+    with mock.patch("mozphab.connectionpool.HTTPSConnection") as xmock:
+        xmock.side_effect = fake_connection
+        yield xmock
+
+
+def test_request_reuses_connection(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    with pool.request("POST", URL, body="x") as response:
+        response.read()
+    with pool.request("POST", URL, body="y"):
+        pass
+
+    m_https.assert_called_once_with("phab.test")
+    assert len(pool._idle[("https", "phab.test")]) == 1
+
+
+def test_request_accepts_string_url(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    with pool.request("GET", "https://phab.test/x"):
+        pass
+
+    m_https.assert_called_once_with("phab.test")
+
+
+def test_request_not_read_response_is_not_reused(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    m_https.side_effect = None
+    conn = m_https.return_value
+    conn.getresponse.return_value.isclosed.return_value = False
+
+    with pool.request("POST", URL):
+        pass
+
+    conn.close.assert_called_once()
+    assert not pool._idle.get(("https", "phab.test"))
+
+
+@mock.patch("mozphab.connectionpool.time")
+def test_idle_timeout(m_time, m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    m_time.monotonic.return_value = 100
+    with pool.request("POST", URL):
+        pass
+
+    m_time.monotonic.return_value = 200
+    with pool.request("POST", URL):
+        pass
+
+    assert m_https.call_count == 2
+
+
+def test_max_size(m_https):
+    pool = ConnectionPool(max_size=1, idle_timeout=30)
+    first, _ = pool.acquire(URL)
+    second, _ = pool.acquire(URL)
+    pool.release(URL, first)
+    pool.release(URL, second)
+
+    second.close.assert_called_once()
+    first.close.assert_not_called()
+    assert pool._idle[("https", "phab.test")] == [(first, mock.ANY)]
+
+
+def test_stale_connection_reconnects(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    with pool.request("POST", URL):
+        pass
+
+    stale = pool._idle[("https", "phab.test")][0][0]
+    stale.getresponse.side_effect = RemoteDisconnected
+
+    with pool.request("POST", URL, idempotent=True):
+        pass
+
+    stale.close.assert_called_once()
+    assert m_https.call_count == 2
+
+
+def test_stale_connection_not_idempotent(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    with pool.request("POST", URL):
+        pass
+
+    # The request might have been handled before the socket was closed.
+    stale = pool._idle[("https", "phab.test")][0][0]
+    stale.getresponse.side_effect = RemoteDisconnected
+    with pytest.raises(RemoteDisconnected):
+        with pool.request("POST", URL):
+            pass
+
+    assert m_https.call_count == 1
+
+    # It's repeated if it failed to be sent.
+    with pool.request("POST", URL):
+        pass
+
+    stale = pool._idle[("https", "phab.test")][0][0]
+    stale.request.side_effect = ConnectionResetError
+    with pool.request("POST", URL):
+        pass
+
+    assert m_https.call_count == 3
+
+
+def test_new_connection_error_is_raised(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    m_https.side_effect = None
+    m_https.return_value.getresponse.side_effect = RemoteDisconnected
+
+    with pytest.raises(RemoteDisconnected):
+        with pool.request("POST", URL):
+            pass
+
+    assert m_https.call_count == 1
+
+
+@mock.patch("mozphab.connectionpool.environment")
+@mock.patch("mozphab.connectionpool.HTTPConnection")
+def test_http_allowed(m_http, m_env):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    url = urllib.parse.urlparse("http://phab.test/api/")
+    m_env.HTTP_ALLOWED = False
+    with pytest.raises(CommandError):
+        pool.acquire(url)
+
+    m_env.HTTP_ALLOWED = True
+    conn, reused = pool.acquire(url)
+    assert conn == m_http.return_value
+    assert not reused
+
+
+def test_preconnect(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    pool.preconnect("https://phab.test/api/")
+
+    conn = pool._idle[("https", "phab.test")][0][0]
+    conn.connect.assert_called_once()
+
+    # An idle connection is kept.
+    pool.preconnect(URL)
+    assert m_https.call_count == 1
+    assert len(pool._idle[("https", "phab.test")]) == 1
+
+
+def test_preconnect_error(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    m_https.side_effect = None
+    m_https.return_value.connect.side_effect = ConnectionRefusedError
+
+    pool.preconnect(URL)
+    m_https.return_value.close.assert_called_once()
+    assert not pool._idle.get(("https", "phab.test"))
+
+
+def test_clear(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    with pool.request("POST", URL):
+        pass
+
+    conn = pool._idle[("https", "phab.test")][0][0]
+    pool.clear()
+    conn.close.assert_called_once()
+    assert pool._idle == {}
+
+
+@pytest.mark.parametrize(
+    "encoding,compress",
+    [
+        (None, lambda data: data),
+        ("gzip", gzip.compress),
+        ("deflate", zlib.compress),
+        ("deflate", lambda data: zlib.compress(data)[2:-4]),
+    ],
+)
+def test_decoded_response(encoding, compress):
+    data = b"0123456789" * 10000
+    response = DecodedResponse(fake_response(compress(data), encoding))
+    assert response.read(5) == b"01234"
+    assert response.read1(5) == b"56789"
+    assert response.read() == data[10:]
+    assert response.read() == b""
+    assert response.decompressed_bytes == len(data)
+    assert response.compressed_bytes == len(compress(data))
+
+
+def test_request_accept_encoding(m_https):
+    pool = ConnectionPool(max_size=2, idle_timeout=30)
+    with pool.request("GET", URL, headers={"X": "y"}):
+        pass
+
+    request = pool._idle[("https", "phab.test")][0][0].request
+    request.assert_called_once_with(
+        "GET",
+        URL.geturl(),
+        body=None,
+        headers={"X": "y", "Accept-Encoding": "gzip, deflate"},
+    )
@@ -13,13 +13,17 @@ from mozphab.diff import Diff
 mozphab.SHOW_SPINNER = False
 
 
+def bodies(*values):
+    return (value for value in values)
+
+
 class Args:
     def __init__(self, less_context=False):
         self.lesscontext = less_context
 
 
 @mock.patch("mozphab.git.Git._file_size")
-@mock.patch("mozphab.git.Git._cat_file")
+@mock.patch("mozphab.gitcommand.CatFile.iter_read")
 @mock.patch("mozphab.git.Git.git_out")
 def test_create(m_git_out, m_cat_file, m_file_size, git):
     raw = (
@@ -27,7 +31,7 @@ def test_create(m_git_out, m_cat_file, m_file_size, git):
         "78981922613b2afb6025042ff6bd878ac1994e85 A\x00a"
     )
     diff = Diff()
-    m_cat_file.side_effect = (b"a\n",)
+    m_cat_file.side_effect = (bodies(b"a\n"),)
     m_file_size.return_value = 5
     git.args = Args()
 
@@ -50,7 +54,7 @@ def test_create(m_git_out, m_cat_file, m_file_size, git):
 
 
 @mock.patch("mozphab.git.Git._file_size")
-@mock.patch("mozphab.git.Git._cat_file")
+@mock.patch("mozphab.gitcommand.CatFile.iter_read")
 @mock.patch("mozphab.git.Git.git_out")
 def test_change_file(m_git_out, m_cat_file, m_file_size, git):
     raw = (
@@ -58,7 +62,7 @@ def test_change_file(m_git_out, m_cat_file, m_file_size, git):
         "422c2b7ab3b3c668038da977e4e93a5fc623169c M\x00a"
     )
     diff = Diff()
-    m_cat_file.side_effect = (b"a\n", b"a\nb\n")
+    m_cat_file.side_effect = (bodies(b"a\n", b"a\nb\n"),)
     m_git_out.return_value = b"""\
 diff --git a/78981922613b2afb6025042ff6bd878ac1994e85 \
 b/422c2b7ab3b3c668038da977e4e93a5fc623169c
@@ -73,6 +77,12 @@ b/422c2b7ab3b3c668038da977e4e93a5fc623169c
 
     change = git._parse_diff_change(raw, diff)
     assert change.file_type.name == "TEXT"
+    m_cat_file.assert_called_once_with(
+        [
+            "78981922613b2afb6025042ff6bd878ac1994e85",
+            "422c2b7ab3b3c668038da977e4e93a5fc623169c",
+        ]
+    )
     m_git_out.assert_called_once_with(
         [
             "diff",
@@ -104,7 +114,7 @@ b/422c2b7ab3b3c668038da977e4e93a5fc623169c
 
 
 @mock.patch("mozphab.git.Git._file_size")
-@mock.patch("mozphab.git.Git._cat_file")
+@mock.patch("mozphab.gitcommand.CatFile.iter_read")
 @mock.patch("mozphab.git.Git.git_out")
 def test_create_empty(m_git_out, m_cat_file, m_file_size, git):
     raw = (
@@ -112,7 +122,7 @@ def test_create_empty(m_git_out, m_cat_file, m_file_size, git):
         "78981922613b2afb6025042ff6bd878ac1994e85 A\x00a"
     )
     diff = Diff()
-    m_cat_file.side_effect = (b"",)
+    m_cat_file.side_effect = (bodies(b""),)
     m_file_size.return_value = 0
     git.args = Args()
 
@@ -125,7 +135,7 @@ def test_create_empty(m_git_out, m_cat_file, m_file_size, git):
 
 
 @mock.patch("mozphab.git.Git._file_size")
-@mock.patch("mozphab.git.Git._cat_file")
+@mock.patch("mozphab.gitcommand.CatFile.iter_read")
 @mock.patch("mozphab.git.Git.git_out")
 def test_delete_file(m_git_out, m_cat_file, m_file_size, git):
     raw = (
@@ -133,7 +143,7 @@ def test_delete_file(m_git_out, m_cat_file, m_file_size, git):
         "0000000000000000000000000000000000000000 D\x00a"
     )
     diff = Diff()
-    m_cat_file.side_effect = (b"a\nb\n",)
+    m_cat_file.side_effect = (bodies(b"a\nb\n"),)
     m_file_size.return_value = 5
     git.args = Args()
 
@@ -154,7 +164,7 @@ def test_delete_file(m_git_out, m_cat_file, m_file_size, git):
 
 
 @mock.patch("mozphab.git.Git._file_size")
-@mock.patch("mozphab.git.Git._cat_file")
+@mock.patch("mozphab.gitcommand.CatFile.iter_read")
 @mock.patch("mozphab.git.Git.git_out")
 def test_recognize_binary(m_git_out, m_cat_file, m_file_size, git):
     raw = (
@@ -163,7 +173,7 @@ def test_recognize_binary(m_git_out, m_cat_file, m_file_size, git):
     )
     diff = Diff()
     content = b"\x08\x00\x00\x10"
-    m_cat_file.side_effect = (content,)
+    m_cat_file.side_effect = (bodies(content),)
     m_file_size.return_value = 5
     git.args = Args()
 
@@ -178,7 +188,7 @@ def test_recognize_binary(m_git_out, m_cat_file, m_file_size, git):
 
 
 @mock.patch("mozphab.git.Git._file_size")
-@mock.patch("mozphab.git.Git._cat_file")
+@mock.patch("mozphab.gitcommand.CatFile.iter_read")
 @mock.patch("mozphab.git.Git.git_out")
 def test_recognize_long_text_as_binary(m_git_out, m_cat_file, m_file_size, git):
     raw = (
@@ -187,7 +197,7 @@ def test_recognize_long_text_as_binary(m_git_out, m_cat_file, m_file_size, git):
     )
     diff = Diff()
     content = b"a\n"
-    m_cat_file.side_effect = (content,)
+    m_cat_file.side_effect = (bodies(content),)
     m_file_size.return_value = environment.MAX_TEXT_SIZE + 1
     git.args = Args()
 
@@ -202,7 +212,7 @@ def test_recognize_long_text_as_binary(m_git_out, m_cat_file, m_file_size, git):
 
 
 @mock.patch("mozphab.git.Git._file_size")
-@mock.patch("mozphab.git.Git._cat_file")
+@mock.patch("mozphab.gitcommand.CatFile.iter_read")
 @mock.patch("mozphab.git.Git.git_out")
 def test_less_context(m_git_out, m_cat_file, m_file_size, git):
     raw = (
@@ -210,7 +220,7 @@ def test_less_context(m_git_out, m_cat_file, m_file_size, git):
         "422c2b7ab3b3c668038da977e4e93a5fc623169c M\x00a"
     )
     diff = Diff()
-    m_cat_file.side_effect = (b"a\n", b"a\nb\n")
+    m_cat_file.side_effect = (bodies(b"a\n", b"a\nb\n"),)
     m_git_out.return_value = b"""\
 diff --git a/78981922613b2afb6025042ff6bd878ac1994e85 \
 b/422c2b7ab3b3c668038da977e4e93a5fc623169c
@@ -240,7 +250,7 @@ b/422c2b7ab3b3c668038da977e4e93a5fc623169c
 
     git.args = Args(less_context=False)
     m_file_size.return_value = environment.MAX_CONTEXT_SIZE + 1
-    m_cat_file.side_effect = (b"a\n", b"a\nb\n")
+    m_cat_file.side_effect = (bodies(b"a\n", b"a\nb\n"),)
     m_git_out.reset_mock()
 
     git._parse_diff_change(raw, diff)
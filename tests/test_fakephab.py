@@ -0,0 +1,185 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import json
+
+import mock
+import pytest
+
+from mozphab.conduit import conduit, ConduitAPIError
+from mozphab.jsonstream import LazyList
+
+from tests import fakephab
+from tests.fakephab import FakePhabricator, FakePhabricatorServer
+
+
+class Repo:
+    vcs = "git"
+    phab_vcs = "git"
+    is_cinnabar_required = False
+    path = "path"
+    phid = "PHID-REPO-1"
+
+    def __init__(self, url):
+        self.phab_url = url
+        self.api_url = url + "api/"
+
+    @staticmethod
+    def get_public_node(node):
+        return node
+
+
+@pytest.fixture
+def phab(monkeypatch):
+    monkeypatch.setattr("mozphab.environment.HTTP_ALLOWED", True)
+    server = FakePhabricatorServer(FakePhabricator(seed=1)).start()
+    conduit.set_repo(Repo(server.url))
+    with mock.patch("mozphab.conduit.ConduitAPI.load_api_token") as m_token:
+        m_token.return_value = "cli-token"
+        yield server.phabricator
+
+    server.stop()
+
+
+def test_ping(phab):
+    assert conduit.ping()
+    assert conduit.whoami()["userName"] == "fake"
+    assert phab.calls == ["conduit.ping", "user.whoami"]
+
+
+def test_revisions_and_stack(phab):
+    phab.add_user("alice")
+    phab.add_project("reviewers")
+    first = conduit.edit_revision(
+        transactions=[
+            dict(type="title", value="first"),
+            dict(type="reviewers.set", value=["blocking(PHID-USER-1)"]),
+        ]
+    )
+    second = conduit.edit_revision(
+        transactions=[
+            dict(type="title", value="second"),
+            dict(type="summary", value="Depends on D%s" % first["object"]["id"]),
+        ]
+    )
+
+    revisions = conduit.get_revisions(
+        ids=[second["object"]["id"], first["object"]["id"]], attachments=["reviewers"]
+    )
+    assert [r["fields"]["title"] for r in revisions] == ["second", "first"]
+    assert revisions[1]["attachments"]["reviewers"]["reviewers"][0]["isBlocking"]
+
+    graph = conduit.get_stack_graph([first["object"]["phid"]])
+    assert graph.ordered(first["object"]["phid"]) == [
+        first["object"]["phid"],
+        second["object"]["phid"],
+    ]
+
+    conduit.edit_revision(
+        transactions=[dict(type="children.remove", value=[second["object"]["phid"]])],
+        rev_id=first["object"]["id"],
+    )
+    assert conduit.get_successor_phids(first["object"]["phid"]) == []
+
+    assert [u["userName"] for u in conduit.get_users(["ALICE", "bob"])] == ["alice"]
+    assert conduit.get_groups(["reviewers"])[0]["name"] == "reviewers"
+
+    with pytest.raises(ConduitAPIError):
+        conduit.edit_revision(rev_id=999, transactions=[dict(type="title", value="")])
+
+
+def test_diff(phab):
+    hunk = dict(oldOffset=1, oldLength=1, newOffset=1, newLength=1, corpus="-a\n+b\n")
+    change = dict(oldPath="a.txt", currentPath="a.txt", type=2, hunks=[hunk])
+    diff = conduit.create_diff(LazyList([change], dict), "base-node")
+    commit = {
+        "node": "node",
+        "parent": "base-node",
+        "author-name": "Alice",
+        "author-email": "alice@example.com",
+        "author-date-epoch": 1,
+        "title-preview": "title",
+    }
+    conduit.set_diff_property(diff["diffid"], commit, "message")
+
+    found = conduit.get_diffs([diff["phid"]])[diff["phid"]]
+    assert found["fields"]["refs"] == [dict(type="base", identifier="base-node")]
+    assert found["attachments"]["commits"]["commits"][0]["author"]["email"] == (
+        "alice@example.com"
+    )
+
+    raw = io.BytesIO()
+    conduit.get_raw_diff(diff["diffid"], raw)
+    assert raw.getvalue().decode("utf-8") == (
+        "diff --git a/a.txt b/a.txt\n"
+        "--- a/a.txt\n"
+        "+++ b/a.txt\n"
+        "@@ -1,1 +1,1 @@\n"
+        "-a\n"
+        "+b\n"
+    )
+
+
+def test_file_upload(phab, monkeypatch):
+    monkeypatch.setattr(fakephab, "CHUNK_SIZE", 4)
+    data = b"0123456789"
+    phid = conduit.file_upload("data.bin", data)
+    assert phab.files[phid]["data"] == data
+    assert phab.calls.count("file.uploadchunk") == 3
+
+    # Small files are sent at once.
+    monkeypatch.setattr(fakephab, "CHUNK_SIZE", 1024)
+    phid = conduit.file_upload("small.bin", b"small")
+    assert phab.files[phid]["data"] == b"small"
+
+
+def test_errors_latency_and_padding(phab):
+    phab.errors = {"conduit.*": (1, "conduit")}
+    assert not conduit.ping()
+
+    phab.errors = {}
+    phab.latency = {"user.*": 0.01}
+    phab.padding = {"user.*": 10000}
+    assert conduit.call("user.query", dict(usernames=["fake"]))[0]["userName"] == (
+        "fake"
+    )
+
+
+@mock.patch("tests.fakephab.FakePhabricatorServer")
+def test_main(m_server):
+    m_server.return_value.serve_forever.side_effect = KeyboardInterrupt
+    fakephab.main(
+        [
+            "--port",
+            "0",
+            "--latency",
+            "differential.*=0.5",
+            "--error",
+            "file.uploadchunk=0.1:drop",
+            "--padding",
+            "*=100",
+            "--project",
+            "reviewers",
+        ]
+    )
+
+    phabricator = m_server.call_args[0][0]
+    assert phabricator.latency_of("differential.creatediff") == 0.5
+    assert phabricator.errors == {"file.uploadchunk": (0.1, "drop")}
+    assert phabricator.padding_of("conduit.ping") == 100
+    assert "TEST" in phabricator.repositories
+    assert "reviewers" in phabricator.projects
+    m_server.return_value.server_close.assert_called_once()
+
+
+def test_parse_multipart():
+    body = (
+        b'--b\r\nContent-Disposition: form-data; name="params"\r\n\r\n'
+        + json.dumps({"x": 1}).encode()
+        + b"\r\n--b--\r\n"
+    )
+    assert fakephab.parse_multipart(body, "multipart/form-data; boundary=b") == {
+        "params": '{"x": 1}'
+    }
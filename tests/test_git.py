@@ -4,9 +4,10 @@ import mock
 import pytest
 from pathlib import Path
 
-from .conftest import create_temp_fn
-
 from mozphab import environment, exceptions, mozphab
+from mozphab.gitcommand import CatFile, DiffTree, GitCommand
+
+from .conftest import git_out
 
 environment.SHOW_SPINNER = False
 
@@ -58,122 +59,152 @@ def test_first_unpublished(m_config, m_git_cherry, m_git_git_out, git):
         first()
 
 
-@mock.patch("mozphab.git.Git.git_out")
-def test_branches_to_rebase(m_git_git_out, git):
-    git_find = git._find_branches_to_rebase
-
-    # No branch returned - not a real case - we don't work without branches
-    m_git_git_out.return_value = []
-    assert dict() == git_find([{"orig-node": "_aaa", "node": "aaa"}])
-
-    # No amend, no branches to rebase
-    m_git_git_out.return_value = ["branch"]
-    assert dict() == git_find([{"orig-node": "aaa", "node": "aaa"}])
-
-    # One commit, one branch
-    m_git_git_out.return_value = ["branch"]
-    assert dict(branch=["aaa", "_aaa"]) == git_find(
-        [{"orig-node": "_aaa", "node": "aaa"}]
-    )
-
-    # Two commits one branch
-    m_git_git_out.return_value = ["branch"]
-    assert dict(branch=["bbb", "_bbb"]) == git_find(
-        [{"orig-node": "_aaa", "node": "aaa"}, {"orig-node": "_bbb", "node": "bbb"}]
-    )
-
-    # Two branches one commit
-    # ... (branch1)
-    # | ... (branch2)
-    # |/
-    # * aaa
-    # More realistic output from the git command
-    m_git_git_out.return_value = ["*  branch1", "  branch2"]
-    assert dict(branch1=["aaa", "_aaa"], branch2=["aaa", "_aaa"]) == git_find(
-        [{"orig-node": "_aaa", "node": "aaa"}]
-    )
-
-    # ... (branch1)
-    # | * bbb (branch2)
-    # |/
-    # * aaa
-    m_git_git_out.side_effect = (["branch1", "branch2"], ["branch2"])
-    assert dict(branch1=["aaa", "_aaa"], branch2=["bbb", "_bbb"]) == git_find(
-        [{"orig-node": "_aaa", "node": "aaa"}, {"orig-node": "_bbb", "node": "bbb"}]
-    )
+def test_finalize(git_repo_path, git):
+    git.path = str(git_repo_path)
+    git.branch = "master"
+    git_out("checkout", "-q", "-B", "master")
+    git_out("branch", "unrelated")
+    for name in ("A", "B"):
+        git_out("commit", "--allow-empty", "-m", name)
+        git_out("branch", "at-%s" % name)
+
+    git_out("checkout", "-q", "-b", "beyond")
+    git_out("commit", "--allow-empty", "-m", "C\n\nbody")
+    git_out("checkout", "-q", "master")
+    git.revset = ("HEAD~2", "HEAD")
+    commits = git.commit_stack()
+    unrelated = git_out("rev-parse", "unrelated").strip()
+
+    commits[0]["title"] = "A amended"
+    git.amend_commit(commits[0], commits)
+    with mock.patch("mozphab.git.Git._rebase") as m_rebase:
+        git.finalize(commits)
+    m_rebase.assert_not_called()
+
+    def log(ref):
+        return git_out("log", "--format=%H %s", ref).splitlines()
+
+    assert git_out("rev-parse", "master").strip() == commits[1]["node"]
+    assert git_out("rev-parse", "at-B").strip() == commits[1]["node"]
+    assert git_out("rev-parse", "at-A").strip() == commits[0]["node"]
+    assert log("beyond")[1:3] == [
+        "%s B" % commits[1]["node"],
+        "%s A amended" % commits[0]["node"],
+    ]
+    assert git_out("log", "-1", "--format=%B", "beyond") == "C\n\nbody\n\n"
+    assert git_out("rev-parse", "unrelated").strip() == unrelated
+    assert git_out("symbolic-ref", "--short", "HEAD").strip() == "master"
+
+
+def test_amend_commit_deferred(git_repo_path, git):
+    git.path = str(git_repo_path)
+    git.branch = "master"
+    git_out("checkout", "-q", "-B", "master")
+    for name in ("A", "B", "C", "D"):
+        git_out("commit", "--allow-empty", "-m", name)
+
+    git.revset = ("HEAD~4", "HEAD")
+    commits = git.commit_stack()
+    with mock.patch.object(git, "_commit_tree", wraps=git._commit_tree) as m_tree:
+        for commit in commits:
+            git.prepare_commit(commit, commits)
+            # The node and the parent describe an existing commit.
+            assert git_out("rev-parse", "%s^" % commit["node"]) == git_out(
+                "rev-parse", commit["parent"]
+            )
+            if commit["title"] != "C":
+                commit["title"] += " amended"
+                git.amend_commit(commit, commits)
+            # Submitting again doesn't re-create the commit.
+            node = commit["node"]
+            git.prepare_commit(commit, commits)
+            assert commit["node"] == node
+            # Descendants are not re-created yet.
+            if commit is not commits[-1]:
+                assert commits[-1]["node"] == commits[-1]["orig-node"]
+
+        git.finalize(commits)
+
+    # A is re-created when it's amended. B, C and D are re-created on the new
+    # parent when they're submitted, and B and D again when they're amended.
+    assert m_tree.call_count == 6
+    assert git_out("log", "--format=%s", "-4", "master").split("\n")[:4] == [
+        "D amended",
+        "C",
+        "B amended",
+        "A amended",
+    ]
+    assert git_out("rev-parse", "master").strip() == commits[-1]["node"]
+    assert commits[2]["parent"] == commits[1]["node"]
 
-    # * ... (master)
-    # | * ... (feature1)
-    # | | * ... (feature2)
-    # | |/
-    # |/|
-    # | | * ddd (feature1_1)
-    # | |/
-    # | * ccc
-    # |/
-    # * bbb
-    # * aaa
 
-    m_git_git_out.side_effect = (
-        ["master", "feature1", "feature1_1", "feature2"],  # aaa
-        ["master", "feature1", "feature1_1", "feature2"],  # bbb
-        ["feature1", "feature1_1"],  # ccc
-        ["feature1_1"],  # ddd
-    )
-    assert dict(
-        master=["bbb", "_bbb"],
-        feature1=["ccc", "_ccc"],
-        feature2=["bbb", "_bbb"],
-        feature1_1=["ddd", "_ddd"],
-    ) == git_find(
-        [
-            {"orig-node": "_aaa", "node": "aaa"},
-            {"orig-node": "_bbb", "node": "bbb"},
-            {"orig-node": "_ccc", "node": "ccc"},
-            {"orig-node": "_ddd", "node": "ddd"},
-        ]
+@mock.patch("mozphab.git.Git.git_out")
+def test_git_get_children(m_git_git_out, git):
+    m_git_git_out.return_value = ["ccc", "bbb ccc", "aaa bbb"]
+    assert git._git_get_children("start", "end") == {
+        "aaa": ["bbb"],
+        "bbb": ["ccc"],
+        "ccc": [],
+    }
+    m_git_git_out.assert_called_once_with(
+        ["rev-list", "--children", "--ancestry-path", "start..end"]
     )
 
 
-def test_get_direct_children(git):
-    get_children = git._get_direct_children
-    rev_list = ["aaa bbb ccc", "bbb", "ccc ddd"]
-    assert ["bbb", "ccc"] == get_children("aaa", rev_list)
-    assert [] == get_children("bbb", rev_list)
-    assert ["ddd"] == get_children("ccc", rev_list)
-    assert [] == get_children("xxx", rev_list)
-
-
-def test_is_child(git):
-    is_child = git._is_child
+def test_get_descendants(git):
+    get_descendants = git._get_descendants
     # * ccc
     # * bbb
     # * aaa
-    nodes = ["ccc", "bbb ccc", "aaa bbb"]
-    assert is_child("aaa", "bbb", nodes)
-    assert is_child("aaa", "ccc", nodes)
-    assert is_child("bbb", "ccc", nodes)
-    assert not is_child("bbb", "aaa", nodes)
-    assert not is_child("aaa", "aaa", nodes)
-    assert not is_child("bbb", "bbb", nodes)
-    assert not is_child("ccc", "ccc", nodes)
-
-    # * ddd
+    children = {"ccc": [], "bbb": ["ccc"], "aaa": ["bbb"]}
+    assert get_descendants("aaa", children) == {"bbb", "ccc"}
+    assert get_descendants("bbb", children) == {"ccc"}
+    assert get_descendants("ccc", children) == set()
+    assert get_descendants("xxx", children) == set()
+
+    # * fff
+    # |\
+    # * | ddd
     # | * ccc
     # | | * eee
     # | |/
     # | * bbb
     # |/
     # * aaa
-    nodes = ["ddd", "ccc", "eee", "bbb ccc eee", "aaa bbb ddd"]
-    assert is_child("aaa", "bbb", nodes)
-    assert is_child("aaa", "ccc", nodes)
-    assert is_child("aaa", "ddd", nodes)
-    assert is_child("aaa", "eee", nodes)
-    assert is_child("bbb", "ccc", nodes)
-    assert is_child("bbb", "eee", nodes)
-    assert not is_child("bbb", "ddd", nodes)
-    assert not is_child("ccc", "ddd", nodes)
+    children = {
+        "fff": [],
+        "ddd": ["fff"],
+        "ccc": ["fff"],
+        "eee": [],
+        "bbb": ["ccc", "eee"],
+        "aaa": ["bbb", "ddd"],
+    }
+    assert get_descendants("aaa", children) == {"bbb", "ccc", "ddd", "eee", "fff"}
+    assert get_descendants("bbb", children) == {"ccc", "eee", "fff"}
+    assert get_descendants("ddd", children) == {"fff"}
+
+
+def test_commit_stack_bounded(git_repo_path, git):
+    git.path = str(git_repo_path)
+    git_out("commit", "--allow-empty", "-m", "base")
+    for i in range(3):
+        git_out("branch", "other%s" % i)
+        git_out("commit", "--allow-empty", "-m", "commit %s" % i)
+
+    git_out("checkout", "-q", "other0")
+    git_out("commit", "--allow-empty", "-m", "elsewhere")
+    git_out("checkout", "-q", "-")
+    git.revset = ("HEAD~3", "HEAD")
+    commits = git.commit_stack()
+    assert [c["title"] for c in commits] == ["commit 0", "commit 1", "commit 2"]
+    # Commits of other branches are not read.
+    assert len(git._git_get_children(*git.revset)) == 3
+
+    # A commit which is not a descendant of the first one is rejected.
+    with mock.patch("mozphab.git.Git._git_get_children") as m_children:
+        m_children.return_value = {}
+        with pytest.raises(exceptions.Error):
+            git.commit_stack()
 
 
 @mock.patch("mozphab.git.Git.git_out")
@@ -399,15 +430,12 @@ def test_before_patch(m_logger, m_prompt, m_git, m_checkout, m_git_out, git):
         git.before_patch("abcdef", "name")
 
 
-@mock.patch("mozphab.git.temporary_binary_file")
 @mock.patch("mozphab.git.Git.git_call")
 @mock.patch("mozphab.git.Git.commit")
-def test_apply_patch(m_commit, m_git, m_temp_fn, git):
-    m_temp_fn.return_value = create_temp_fn("filename")
-    git.apply_patch("diff", "commit message", "user", 1)
+def test_apply_patch(m_commit, m_git, git):
+    git.apply_patch("filename", "commit message", "user", 1)
     m_git.assert_called_once_with(["apply", "--index", "filename"])
     m_commit.assert_called_with("commit message", "user", 1)
-    m_temp_fn.assert_called_once_with(b"diff")
 
 
 @mock.patch("mozphab.git.Git.git_out")
@@ -503,6 +531,21 @@ def test_unicode_in_windows_env(m_git_out, git, monkeypatch):
     )
 
 
+@mock.patch("mozphab.repository.arc_ping")
+def test_check_arc(m_arc_ping, git, tmp_path):
+    git.dot_path = str(tmp_path)
+    m_arc_ping.return_value = False
+    assert not git.check_arc()
+    m_arc_ping.assert_called_once_with(git.path)
+
+    # arc is spawned until it succeeds once.
+    m_arc_ping.reset_mock()
+    m_arc_ping.return_value = True
+    assert git.check_arc()
+    assert git.check_arc()
+    m_arc_ping.assert_called_once_with(git.path)
+
+
 def test_check_vcs(git):
     class Args:
         def __init__(self, force_vcs=False):
@@ -528,7 +571,7 @@ def test_check_vcs(git):
 
 @mock.patch("mozphab.git.Git._get_commits_info")
 @mock.patch("mozphab.git.Git._git_get_children")
-@mock.patch("mozphab.git.Git._is_child")
+@mock.patch("mozphab.git.Git._get_descendants")
 def test_commit_stack_single(_1, _2, _3, git):
     git._get_commits_info.return_value = [
         """\
@@ -546,4 +589,145 @@ description
     git.revset = ["HEAD^", "HEAD"]
     git.commit_stack(single=True)
     git._git_get_children.assert_not_called()
-    git._is_child.assert_not_called()
+    git._get_descendants.assert_not_called()
+
+
+def test_cat_file(git_repo_path):
+    (git_repo_path / "X").write_bytes(b"a\0b\n")
+    git_out("add", "X")
+    blob = git_out("rev-parse", ":X").strip()
+
+    cat_file = CatFile(GitCommand(), str(git_repo_path))
+    assert cat_file.read([blob, "0" * 40, blob]) == [b"a\0b\n", None, b"a\0b\n"]
+    assert cat_file.sizes[blob] == 4
+
+    process = cat_file._process
+    assert cat_file.read([blob]) == [b"a\0b\n"]
+    assert cat_file._process is process
+
+    cat_file.close()
+    assert process.returncode == 0
+    cat_file.close()
+
+    # The process is started again.
+    assert cat_file.read([blob]) == [b"a\0b\n"]
+
+    # A request left unfinished doesn't leave objects in the stream.
+    bodies = cat_file.iter_read([blob, blob])
+    assert next(bodies) == b"a\0b\n"
+    bodies.close()
+    assert cat_file._process is None
+    assert cat_file.read([blob]) == [b"a\0b\n"]
+    cat_file.close()
+
+
+def test_read_blobs(git_repo_path, git):
+    git.cat_file = CatFile(git.git, str(git_repo_path))
+    for name in "ABC":
+        (git_repo_path / name).write_bytes(name.encode() * 1000)
+    git_out("add", "A", "B", "C")
+    git_out("commit", "-m", "add")
+    raw = git_out("diff-tree", "-r", "--raw", "-z", "--no-abbrev", "HEAD")
+    raw_changes = raw[:-1].split("\0:")[1:]
+
+    read = []
+    read_object = git.cat_file._read_object
+    with mock.patch.object(
+        git.cat_file,
+        "_read_object",
+        lambda name: read.append(name) or read_object(name),
+    ):
+        blobs = git._read_blobs(raw_changes)
+        for index, name in enumerate("ABC"):
+            # Only the body of the parsed change is read.
+            assert list(next(blobs).values()) == [name.encode() * 1000]
+            assert len(read) == index + 1
+
+        assert list(blobs) == []
+
+    # The request is finished, the process is reused.
+    process = git.cat_file._process
+    assert process.poll() is None
+    git.cat_file.read(read[:1])
+    assert git.cat_file._process is process
+    git.cat_file.close()
+
+
+def test_diff_tree(git_repo_path):
+    (git_repo_path / "X").write_text("a\nb\n")
+    git_out("add", "X")
+    git_out("commit", "-m", "add X")
+    git_out("mv", "X", "Y")
+    (git_repo_path / "Y").write_text("a\nc\n")
+    git_out("add", "Y")
+    git_out("commit", "-m", "move X")
+    git_out("commit", "--allow-empty", "-m", "empty")
+    nodes = git_out("rev-list", "--reverse", "-3", "HEAD").split()
+
+    diff_tree = DiffTree(GitCommand(), str(git_repo_path))
+    diff_tree.start(nodes, 10)
+    # Commits are read up to the requested one.
+    moved = diff_tree.changes(nodes[1])
+    assert len(moved) == 1
+    raw, patch = moved[0]
+    assert raw.startswith("100644 100644 ")
+    assert raw.endswith(" R050\0X\0Y")
+    assert patch == [b"@@ -1,2 +1,2 @@\n", b" a\n", b"-b\n", b"+c\n"]
+    assert diff_tree.changes(nodes[2]) == []
+    assert diff_tree._process is None
+
+    (added,) = diff_tree.changes(nodes[0])
+    assert added[1] == [b"@@ -0,0 +1,2 @@\n", b"+a\n", b"+b\n"]
+    assert diff_tree.changes(nodes[0]) == []
+
+    # Contents of binary files are not printed.
+    (git_repo_path / "B").write_bytes(b"\0" * 10000)
+    git_out("add", "B")
+    git_out("commit", "-m", "add B")
+    (git_repo_path / "B").write_bytes(b"\0" * 10001)
+    (git_repo_path / "Y").write_text("a\nd\n")
+    git_out("commit", "-am", "change B and Y")
+    node = git_out("rev-parse", "HEAD").strip()
+    diff_tree.start([node], 10)
+    binary, text = diff_tree.changes(node)
+    assert binary[0].endswith("\0B") and binary[1] is None
+    assert text[1] == [b"@@ -1,2 +1,2 @@\n", b" a\n", b"-c\n", b"+d\n"]
+
+
+def test_prepare_diffs(git_repo_path, git):
+    class Args:
+        lesscontext = False
+
+    git.path = str(git_repo_path)
+    git.cat_file = CatFile(git.git, git.path)
+    git.diff_tree = DiffTree(git.git, git.path)
+    git.args = Args()
+    (git_repo_path / "X").write_text("a\nb\n")
+    (git_repo_path / "B").write_bytes(b"\0")
+    git_out("add", "X", "B")
+    git_out("commit", "-m", "add")
+    (git_repo_path / "X").write_text("a\nc")
+    (git_repo_path / "B").write_bytes(b"\0\1")
+    git_out("commit", "-am", "change")
+    git_out("rm", "X")
+    git_out("commit", "-m", "remove")
+    commits = [
+        {"node": node, "orig-node": node}
+        for node in git_out("rev-list", "--reverse", "-3", "HEAD").split()
+    ]
+
+    def summary(diff):
+        return {
+            path: (c.kind.name, c.file_type.name, c.hunks, c.uploads)
+            for path, c in diff.changes.items()
+        }
+
+    expected = [summary(git.get_diff(commit)) for commit in commits]
+    git.prepare_diffs(commits)
+    with mock.patch("mozphab.git.Git.git_out") as m_git_out:
+        assert [summary(git.get_diff(commit)) for commit in commits] == expected
+    m_git_out.assert_not_called()
+    assert expected[1]["X"][2][0].corpus == (
+        " a\n-b\n+c\n\\ No newline at end of file\n"
+    )
+    git.cat_file.close()
@@ -391,6 +391,7 @@ def test_get_users_with_user(m_conduit):
     m_conduit.assert_called_once()
 
     simplecache.cache.reset()
+    simplecache.persistent_cache.reset()
     m_conduit.reset_mock()
     m_conduit.return_value = []
     assert [] == conduit.get_users(["alice"])
@@ -413,6 +414,64 @@ def test_simple_cache():
     assert cache.get("something") is None
 
 
+@mock.patch("mozphab.simplecache.time")
+def test_persistent_cache(m_time, tmp_path):
+    m_time.time.return_value = 1000
+    cache = simplecache.PersistentCache(str(tmp_path), ttl=dict(users=10))
+    assert cache.get("https://phab.test/api/", "users", "nothing") is None
+
+    cache.set("https://phab.test/api/", "users", "SoMeThInG", 123)
+    assert cache.get("https://phab.test/api/", "users", "something") == 123
+    assert cache.get("https://other.test/api/", "users", "something") is None
+
+    cache.save()
+    assert (tmp_path / "https___phab.test_api_.json").exists()
+
+    # Entries are read from the disk.
+    cache = simplecache.PersistentCache(str(tmp_path), ttl=dict(users=10))
+    assert cache.get("https://phab.test/api/", "users", "something") == 123
+
+    cache.delete("https://phab.test/api/", "users", "something")
+    assert cache.get("https://phab.test/api/", "users", "something") is None
+
+    # Entries expire.
+    cache.set("https://phab.test/api/", "users", "something", 123)
+    m_time.time.return_value = 1010
+    assert cache.get("https://phab.test/api/", "users", "something") is None
+
+
+def test_persistent_cache_disabled(tmp_path):
+    cache = simplecache.PersistentCache(str(tmp_path))
+    cache.set("phab.test", "users", "something", 123)
+    cache.enabled = False
+    assert cache.get("phab.test", "users", "something") is None
+
+    cache.set("phab.test", "users", "other", 123)
+    cache.enabled = True
+    assert cache.get("phab.test", "users", "something") == 123
+    assert cache.get("phab.test", "users", "other") is None
+
+    # Outdated entries are still deleted.
+    cache.enabled = False
+    cache.delete("phab.test", "users", "something")
+    cache.save()
+    cache.reset()
+    assert cache.get("phab.test", "users", "something") is None
+
+
+def test_persistent_cache_corrupted_file(tmp_path):
+    (tmp_path / "phab.test.json").write_text("not a json")
+    cache = simplecache.PersistentCache(str(tmp_path))
+    assert cache.get("phab.test", "users", "something") is None
+
+    cache.set("phab.test", "users", "something", 123)
+    cache.save()
+    assert (
+        json.loads((tmp_path / "phab.test.json").read_text())["users"]["something"][1]
+        == 123
+    )
+
+
 @mock.patch("subprocess.check_output")
 @mock.patch("mozphab.subprocess_wrapper.logger")
 def test_check_output(m_logger, m_check_output):
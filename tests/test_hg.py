@@ -266,13 +266,18 @@ def test_before_patch(m_config, m_hg, m_hg_out, m_checkout, hg):
 
 @mock.patch("mozphab.mercurial.temporary_binary_file")
 @mock.patch("mozphab.mercurial.Mercurial.hg")
-def test_apply_patch(m_hg, m_temp_bin_fn, hg):
-    m_temp_bin_fn.return_value = create_temp_fn("diff_fn")
-    hg.apply_patch("diff", "body", "user", 1)
-    m_hg.assert_called_once_with(["import", "diff_fn", "--quiet"])
+def test_apply_patch(m_hg, m_temp_bin_fn, hg, tmp_path):
+    diff_file = tmp_path / "diff"
+    diff_file.write_bytes(b"diff")
+    changeset_file = tmp_path / "changeset"
+    changeset_file.write_bytes(b"header\n")
+    m_temp_bin_fn.return_value = create_temp_fn(str(changeset_file))
+    hg.apply_patch(str(diff_file), "body", "user", 1)
+    m_hg.assert_called_once_with(["import", str(changeset_file), "--quiet"])
     m_temp_bin_fn.assert_called_once_with(
-        b"# HG changeset patch\n# User user\n# Date 1 0\nbody\ndiff"
+        b"# HG changeset patch\n# User user\n# Date 1 0\nbody\n"
     )
+    assert changeset_file.read_bytes() == b"header\ndiff"
 
 
 @mock.patch("mozphab.mercurial.Mercurial.hg_out")
@@ -4,34 +4,35 @@
 import copy
 import os
 import mock
+import pytest
 import time
 
 from .conftest import hg_out, git_out
 
 from mozphab import mozphab
+from mozphab.stackgraph import StackGraph
 
 mozphab.SHOW_SPINNER = False
 
+pytestmark = pytest.mark.usefixtures("raw_diff_from_call")
+
 
 @mock.patch("mozphab.conduit.ConduitAPI.get_revisions")
 @mock.patch("mozphab.conduit.ConduitAPI.get_diffs")
 @mock.patch("mozphab.conduit.ConduitAPI.call")
-@mock.patch("mozphab.conduit.ConduitAPI.get_successor_phids")
-@mock.patch("mozphab.conduit.ConduitAPI.get_ancestor_phids")
+@mock.patch("mozphab.conduit.ConduitAPI.get_stack_graph")
 @mock.patch("mozphab.commands.patch.logger")
 def test_patch_raw(
     m_logger,
-    m_ancestor_phids,
-    m_get_successor_phids,
+    m_get_stack_graph,
     m_call_conduit,
     m_get_diffs,
     m_get_revs,
     in_process,
     hg_repo_path,
 ):
-    m_get_successor_phids.return_value = []
+    m_get_stack_graph.return_value = StackGraph()
     m_get_revs.return_value = [REV_1]
-    m_ancestor_phids.return_value = []
     m_get_diffs.return_value = {"PHID-DIFF-1": DIFF_1}
     m_call_conduit.return_value = PATCH_1
     mozphab.main(["patch", "D1", "--raw"], is_development=True)
@@ -44,7 +45,7 @@ def test_patch_raw(
 
     m_logger.reset_mock()
     m_get_revs.side_effect = ([REV_2], [REV_1])
-    m_ancestor_phids.side_effect = [["PHID-REV-1"], []]
+    m_get_stack_graph.return_value = StackGraph([REV_2_PARENT])
     m_get_diffs.return_value = {"PHID-DIFF-1": DIFF_1, "PHID-DIFF-2": DIFF_2}
     m_call_conduit.side_effect = [PATCH_1, PATCH_2]
     mozphab.main(["patch", "D2", "--raw"], is_development=True)
@@ -54,22 +55,19 @@ def test_patch_raw(
 @mock.patch("mozphab.conduit.ConduitAPI.get_revisions")
 @mock.patch("mozphab.conduit.ConduitAPI.get_diffs")
 @mock.patch("mozphab.conduit.ConduitAPI.call")
-@mock.patch("mozphab.conduit.ConduitAPI.get_successor_phids")
-@mock.patch("mozphab.conduit.ConduitAPI.get_ancestor_phids")
+@mock.patch("mozphab.conduit.ConduitAPI.get_stack_graph")
 @mock.patch("mozphab.commands.patch.logger")
 def test_patch_no_commit(
     m_logger,
-    m_ancestor_phids,
-    m_get_successor_phids,
+    m_get_stack_graph,
     m_call_conduit,
     m_get_diffs,
     m_get_revs,
     in_process,
     hg_repo_path,
 ):
-    m_get_successor_phids.return_value = []
+    m_get_stack_graph.return_value = StackGraph()
     m_get_revs.return_value = [REV_1]
-    m_ancestor_phids.return_value = []
     m_get_diffs.return_value = {"PHID-DIFF-1": DIFF_1}
     m_call_conduit.side_effect = [
         dict(),
@@ -92,7 +90,7 @@ def test_patch_no_commit(
     test_file.unlink()
 
     m_get_revs.side_effect = ([REV_2], [REV_1])
-    m_ancestor_phids.side_effect = [["PHID-REV-1"], []]
+    m_get_stack_graph.return_value = StackGraph([REV_2_PARENT])
     m_get_diffs.return_value = {"PHID-DIFF-1": DIFF_1, "PHID-DIFF-2": DIFF_2}
     m_call_conduit.side_effect = [PATCH_1, PATCH_2]
     mozphab.main(["patch", "D2", "--no-commit"], is_development=True)
@@ -105,25 +103,22 @@ def test_patch_no_commit(
 @mock.patch("mozphab.conduit.ConduitAPI.get_revisions")
 @mock.patch("mozphab.conduit.ConduitAPI.get_diffs")
 @mock.patch("mozphab.conduit.ConduitAPI.call")
-@mock.patch("mozphab.conduit.ConduitAPI.get_successor_phids")
-@mock.patch("mozphab.conduit.ConduitAPI.get_ancestor_phids")
+@mock.patch("mozphab.conduit.ConduitAPI.get_stack_graph")
 @mock.patch("mozphab.commands.patch.logger")
 def test_git_patch_with_commit(
     m_logger,
-    m_ancestor_phids,
-    m_get_successor_phids,
+    m_get_stack_graph,
     m_call_conduit,
     m_get_diffs,
     m_get_revs,
     in_process,
     git_repo_path,
 ):
-    m_get_successor_phids.return_value = []
+    m_get_stack_graph.return_value = StackGraph()
     sha = git_out("rev-parse", "HEAD").rstrip("\n")
     diff_1 = copy.deepcopy(DIFF_1)
     diff_1["fields"]["refs"][0]["identifier"] = sha
     m_get_revs.return_value = [REV_1]
-    m_ancestor_phids.return_value = []
     m_get_diffs.return_value = {"PHID-DIFF-1": diff_1}
     m_call_conduit.side_effect = [
         dict(),
@@ -177,7 +172,7 @@ def test_git_patch_with_commit(
 
     time.sleep(1)
     m_get_revs.side_effect = ([REV_2], [REV_1])
-    m_ancestor_phids.side_effect = [["PHID-REV-1"], []]
+    m_get_stack_graph.return_value = StackGraph([REV_2_PARENT])
     m_get_diffs.return_value = {"PHID-DIFF-1": diff_1, "PHID-DIFF-2": DIFF_2}
     m_call_conduit.side_effect = [PATCH_1, PATCH_2]
     mozphab.main(["patch", "D2"], is_development=True)
@@ -212,22 +207,19 @@ def test_git_patch_with_commit(
 @mock.patch("mozphab.conduit.ConduitAPI.get_revisions")
 @mock.patch("mozphab.conduit.ConduitAPI.get_diffs")
 @mock.patch("mozphab.conduit.ConduitAPI.call")
-@mock.patch("mozphab.conduit.ConduitAPI.get_successor_phids")
-@mock.patch("mozphab.conduit.ConduitAPI.get_ancestor_phids")
+@mock.patch("mozphab.conduit.ConduitAPI.get_stack_graph")
 @mock.patch("mozphab.commands.patch.logger")
 def test_hg_patch_with_commit(
     m_logger,
-    m_ancestor_phids,
-    m_get_successor_phids,
+    m_get_stack_graph,
     m_call_conduit,
     m_get_diffs,
     m_get_revs,
     in_process,
     hg_repo_path,
 ):
-    m_get_successor_phids.return_value = []
+    m_get_stack_graph.return_value = StackGraph()
     m_get_revs.return_value = [REV_1]
-    m_ancestor_phids.return_value = []
     m_get_diffs.return_value = {"PHID-DIFF-1": DIFF_1}
     m_call_conduit.side_effect = [
         dict(),
@@ -260,7 +252,7 @@ def test_hg_patch_with_commit(
     testfile = hg_repo_path / "unknown"
     testfile.write_text("not added to repository")
     m_get_revs.side_effect = ([REV_2], [REV_1])
-    m_ancestor_phids.side_effect = [["PHID-REV-1"], []]
+    m_get_stack_graph.return_value = StackGraph([REV_2_PARENT])
     m_get_diffs.return_value = {"PHID-DIFF-1": DIFF_1, "PHID-DIFF-2": DIFF_2}
     m_call_conduit.side_effect = [PATCH_1, PATCH_2]
     mozphab.main(["patch", "D2"], is_development=True)
@@ -284,7 +276,12 @@ def test_hg_patch_with_commit(
 REV_1 = dict(
     id=1,
     phid="PHID-REV-1",
-    fields=dict(title="title R1", summary="\u0105", diffPHID="PHID-DIFF-1"),
+    fields=dict(
+        title="title R1",
+        summary="\u0105",
+        diffPHID="PHID-DIFF-1",
+        status=dict(value="needs-review"),
+    ),
 )
 
 REV_2 = dict(
@@ -293,6 +290,10 @@ REV_2 = dict(
     fields=dict(title="title R2", summary="\u0105", diffPHID="PHID-DIFF-2"),
 )
 
+REV_2_PARENT = dict(
+    sourcePHID="PHID-REV-2", destinationPHID="PHID-REV-1", edgeType="revision.parent",
+)
+
 REV_BIN = dict(
     id=3,
     phid="PHID-REV-3",
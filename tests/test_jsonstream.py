@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import base64
+import io
+import json
+import mock
+import pytest
+
+from mozphab.jsonstream import (
+    Base64Data,
+    LazyList,
+    multipart_body,
+    stream_result,
+    write_json,
+)
+
+
+def stream(response, chunk_size=3):
+    f = io.BytesIO()
+    result = stream_result(
+        io.BytesIO(json.dumps(response).encode("utf-8")), f, chunk_size=chunk_size
+    )
+    return result, f.getvalue()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1024])
+def test_stream_result(chunk_size):
+    text = 'a\\b "c"\r\ną\U0001f600\tend'
+    result, written = stream(
+        dict(result=text, error_code=None, error_info=None), chunk_size
+    )
+    assert written == text.encode("utf-8")
+    assert result == dict(result=None, error_code=None, error_info=None)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1024])
+def test_stream_result_key_order(chunk_size):
+    f = io.BytesIO()
+    response = (
+        b'{ "error_code" : null, "error_info": {"a": [1, "}\\""]},'
+        b'"count":12345,"result":"abc", "x": 1}'
+    )
+    result = stream_result(io.BytesIO(response), f, chunk_size=chunk_size)
+    assert f.getvalue() == b"abc"
+    assert result == dict(
+        result=None, error_code=None, error_info={"a": [1, '}"']}, count=12345, x=1
+    )
+
+    result, written = stream(dict(error_code=None, result=None, error_info="error"))
+    assert result == dict(result=None, error_code=None, error_info="error")
+    assert written == b""
+
+
+def test_stream_result_not_ascii():
+    f = io.BytesIO()
+    response = '{"result": "ą\U0001f600", "error_code": null}'.encode("utf-8")
+    stream_result(io.BytesIO(response), f, chunk_size=1)
+    assert f.getvalue() == "ą\U0001f600".encode("utf-8")
+
+
+def test_stream_result_error():
+    response = dict(result=None, error_code="ERR", error_info="error")
+    assert stream(response) == (response, b"")
+
+
+def test_stream_result_unterminated():
+    with pytest.raises(ValueError):
+        stream_result(io.BytesIO(b'{"result": "abc'), io.BytesIO())
+
+
+def test_lazy_list():
+    calls = []
+
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    items = LazyList([1, 2, 3], double)
+    assert calls == []
+    assert len(items) == 3
+    assert items == [2, 4, 6]
+    assert items[1] == 4
+    assert items[1:] == [4, 6]
+    assert repr(items) == "<LazyList of 3 items>"
+
+
+def test_write_json():
+    f = io.BytesIO()
+    value = dict(changes=LazyList(["a", "ą"], lambda x: dict(path=x)), empty=[])
+    write_json(value, f)
+    assert json.loads(f.getvalue().decode("utf-8")) == dict(
+        changes=[dict(path="a"), dict(path="ą")], empty=[]
+    )
+
+
+@mock.patch("mozphab.jsonstream.BASE64_CHUNK_SIZE", 3)
+def test_base64_data():
+    data = memoryview(b"0123456789" * 10)
+    value = Base64Data(data[5:55])
+    assert len(value) == 50
+    assert value == base64.standard_b64encode(data[5:55]).decode()
+
+    f = io.BytesIO()
+    write_json(dict(data=value), f)
+    assert json.loads(f.getvalue().decode("utf-8")) == dict(data=str(value))
+    assert base64.standard_b64decode(str(value)) == data[5:55].tobytes()
+
+
+def test_multipart_body():
+    body, length, content_type = multipart_body(
+        dict(params=dict(changes=LazyList([1], str)), output="json")
+    )
+    data = body.read()
+    assert len(data) == length
+    boundary = content_type.split("boundary=")[1]
+    assert data == (
+        "--{0}\r\n"
+        'Content-Disposition: form-data; name="params"\r\n\r\n'
+        '{{"changes": ["1"]}}\r\n'
+        "--{0}\r\n"
+        'Content-Disposition: form-data; name="output"\r\n\r\n'
+        "json\r\n"
+        "--{0}--\r\n".format(boundary)
+    ).encode("utf-8")
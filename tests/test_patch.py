@@ -5,6 +5,9 @@ import pytest
 
 from mozphab.commands import patch
 from mozphab import exceptions, helpers, mozphab
+from mozphab.stackgraph import StackGraph
+
+pytestmark = pytest.mark.usefixtures("raw_diff_from_call")
 
 mozphab.SHOW_SPINNER = False
 
@@ -60,7 +63,7 @@ def test_prepare_body():
 @mock.patch("mozphab.gitcommand.check_call")
 def test_apply_patch(m_check_call, _):
     patch.config.git_command = ["git"]
-    patch.apply_patch("diff", "x")
+    patch.apply_patch("diff_file", "x")
     m_check_call.assert_called_once()
 
 
@@ -79,8 +82,7 @@ def test_base_ref():
 @mock.patch("mozphab.commands.patch.config")
 @mock.patch("mozphab.conduit.ConduitAPI.check")
 @mock.patch("mozphab.conduit.ConduitAPI.get_revisions")
-@mock.patch("mozphab.conduit.ConduitAPI.get_ancestor_phids")
-@mock.patch("mozphab.conduit.ConduitAPI.get_successor_phids")
+@mock.patch("mozphab.conduit.ConduitAPI.get_stack_graph")
 @mock.patch("mozphab.conduit.ConduitAPI.get_diffs")
 @mock.patch("mozphab.commands.patch.get_base_ref")
 @mock.patch("mozphab.git.Git.before_patch")
@@ -98,8 +100,7 @@ def test_patch(
     m_git_before_patch,
     m_get_base_ref,
     m_get_diffs,
-    m_get_successor_phids,
-    m_get_ancestor_phids,
+    m_get_stack_graph,
     m_get_revisions,
     m_git_check_conduit,
     m_config,
@@ -147,8 +148,7 @@ def test_patch(
         patch.patch(git, git.args)
 
     m_config.always_full_stack = False
-    m_get_successor_phids.return_value = []
-    m_get_ancestor_phids.return_value = []
+    m_get_stack_graph.return_value = StackGraph()
     m_get_base_ref.return_value = "sha111"
     m_call_conduit.return_value = "raw"  # differential.getrawdiff
     m_get_revisions.return_value = [
@@ -181,7 +181,7 @@ def test_patch(
     m_prepare_body.return_value = "commit message"
     patch.patch(git, git.args)
     m_git_apply_patch.assert_called_once_with(
-        "raw", "commit message", "user <author@example.com>", 1547806078,
+        mock.ANY, "commit message", "user <author@example.com>", 1547806078,
     )
     m_apply_patch.assert_not_called()
     m_get_base_ref.assert_called_once()
@@ -207,7 +207,7 @@ def test_patch(
     }
     patch.patch(git, git.args)
     m_git_apply_patch.assert_called_once_with(
-        "raw", "commit message", "user <author@example.com>", 1547806078,
+        mock.ANY, "commit message", "user <author@example.com>", 1547806078,
     )
 
     m_get_base_ref.return_value = None
@@ -227,9 +227,9 @@ def test_patch(
 
     # skip-dependencies
     git.args = Args(raw=True, skip_dependencies=True)
-    m_get_successor_phids.reset_mock()
+    m_get_stack_graph.reset_mock()
     patch.patch(git, git.args)
-    m_get_successor_phids.assert_not_called()
+    m_get_stack_graph.assert_not_called()
 
     m_git_before_patch.reset_mock()
     # --no_commit
@@ -237,7 +237,7 @@ def test_patch(
     patch.patch(git, git.args)
     m_git_before_patch.assert_called_once()
     m_git_apply_patch.assert_not_called()
-    m_apply_patch.assert_called_once_with("raw", "x")
+    m_apply_patch.assert_called_once_with(mock.ANY, "x")
     m_git_before_patch.assert_called_once_with("sha111", None)
 
     m_git_before_patch.reset_mock()
@@ -253,7 +253,7 @@ def test_patch(
     patch.patch(git, git.args)
     m_get_base_ref.assert_not_called()
     m_git_apply_patch.assert_called_once_with(
-        "raw", "commit message", "user <author@example.com>", 1547806078,
+        mock.ANY, "commit message", "user <author@example.com>", 1547806078,
     )
     m_apply_patch.assert_not_called()
 
@@ -297,7 +297,7 @@ def test_patch(
     m_logger.reset_mock()
     m_get_revisions.side_effect = ([REV_1], [REV_2])
     m_get_diffs.return_value = {"DIFFPHID-1": DIFF_1, "DIFFPHID-2": DIFF_2}
-    m_get_ancestor_phids.return_value = ["PHID-2"]
+    m_get_stack_graph.return_value = StackGraph([edge("PHID-1", "PHID-2", "parent")])
     m_call_conduit.side_effect = ("raw2", "raw1")
     # --raw 2 revisions in stack
     patch.patch(git, git.args)
@@ -314,8 +314,7 @@ def test_patch(
     # successors
     m_get_revisions.reset_mock()
     m_get_revisions.side_effect = ([REV_1], [REV_2])
-    m_get_successor_phids.side_effect = (["PHID-2"], ["PHID-2"], [])
-    m_get_ancestor_phids.return_value = []
+    m_get_stack_graph.return_value = StackGraph([edge("PHID-1", "PHID-2", "child")])
     m_call_conduit.side_effect = ("raw2", "raw1")
     m_get_diffs.return_value = {"DIFFPHID-1": DIFF_1, "DIFFPHID-2": DIFF_2}
     git.args = Args(revision_id=1, raw=True, yes=True)
@@ -328,12 +327,39 @@ def test_patch(
     # multiple successors
     m_get_revisions.reset_mock()
     m_get_revisions.side_effect = ([REV_1], [REV_2])
-    m_get_successor_phids.side_effect = (exceptions.NonLinearException,)
+    m_get_stack_graph.return_value = StackGraph(
+        [edge("PHID-1", "PHID-2", "child"), edge("PHID-1", "PHID-3", "child")]
+    )
     m_call_conduit.side_effect = ("raw",)
     m_get_diffs.return_value = {"DIFFPHID-1": DIFF_1}
     patch.patch(git, git.args)
     m_get_revisions.assert_called_once_with(ids=[1])
 
+    # abandoned ancestors are skipped
+    m_get_revisions.reset_mock()
+    m_get_revisions.side_effect = ([REV_1], [ABANDONED_REV_2])
+    m_get_stack_graph.return_value = StackGraph([edge("PHID-1", "PHID-2", "parent")])
+    m_call_conduit.side_effect = ("raw",)
+    m_logger.reset_mock()
+    patch.patch(git, git.args)
+    m_logger.info.assert_called_once_with("raw")
+
+    # multiple parents
+    m_get_revisions.side_effect = ([REV_1],)
+    m_get_stack_graph.return_value = StackGraph(
+        [edge("PHID-1", "PHID-2", "parent"), edge("PHID-1", "PHID-3", "parent")]
+    )
+    with pytest.raises(exceptions.Error, match="Non linear dependency"):
+        patch.patch(git, git.args)
+
+
+def edge(source, destination, relation):
+    return dict(
+        sourcePHID=source,
+        destinationPHID=destination,
+        edgeType="revision.%s" % relation,
+    )
+
 
 REV_1 = dict(
     phid="PHID-1",
@@ -344,7 +370,23 @@ REV_1 = dict(
 REV_2 = dict(
     phid="PHID-2",
     id=2,
-    fields=dict(diffPHID="DIFFPHID-2", title="title", summary="summary"),
+    fields=dict(
+        diffPHID="DIFFPHID-2",
+        title="title",
+        summary="summary",
+        status=dict(value="needs-review"),
+    ),
+)
+
+ABANDONED_REV_2 = dict(
+    phid="PHID-2",
+    id=2,
+    fields=dict(
+        diffPHID="DIFFPHID-2",
+        title="title",
+        summary="summary",
+        status=dict(value="abandoned"),
+    ),
 )
 
 DIFF_1 = dict(
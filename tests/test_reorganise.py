@@ -217,6 +217,51 @@ def test_reorg_calling_stack_transactions(
     m_trans.assert_called_once_with(*expected)
 
 
+@mock.patch("mozphab.conduit.ConduitAPI.check")
+@mock.patch("mozphab.commands.reorganise.augment_commits_from_body")
+@mock.patch("mozphab.conduit.ConduitAPI.get_stack")
+@mock.patch("mozphab.conduit.ConduitAPI.get_revisions")
+@mock.patch("mozphab.conduit.ConduitAPI.ids_to_phids")
+@mock.patch("mozphab.conduit.ConduitAPI.phid_to_id")
+@mock.patch("mozphab.conduit.ConduitAPI.edit_revision")
+def test_reorg_edit_order(
+    m_edit_revision,
+    _phid2id,
+    m_id2phid,
+    _get_revs,
+    m_remote_stack,
+    _augment_commits,
+    _check,
+    git,
+):
+    class Args:
+        yes = True
+
+    # ABCD -> BAC, D is abandoned.
+    m_remote_stack.return_value = {"A": "B", "B": "C", "C": "D", "D": None}
+    mozphab.conduit.set_repo(git)
+    mozphab.conduit.repo.commit_stack = mock.Mock()
+    mozphab.conduit.repo.commit_stack.return_value = [
+        {"rev-id": 2, "rev-phid": "B"},
+        {"rev-id": 1, "rev-phid": "A"},
+        {"rev-id": 3, "rev-phid": "C"},
+    ]
+    m_id2phid.return_value = ["B", "A", "C"]
+    with mock.patch.object(mozphab.conduit, "max_in_flight", 2):
+        reorganise.reorganise(git, Args())
+
+    # Only abandoning D, which doesn't change the edges, is sent concurrently.
+    # The edges are edited one after another, in order.
+    assert m_edit_revision.call_args_list == [
+        mock.call(rev_id="D", transactions=[{"type": "abandon", "value": True}]),
+        mock.call(rev_id="A", transactions=[{"type": "children.set", "value": ["C"]}]),
+        mock.call(rev_id="B", transactions=[{"type": "children.set", "value": ["A"]}]),
+        mock.call(
+            rev_id="C", transactions=[{"type": "children.remove", "value": ["D"]}]
+        ),
+    ]
+
+
 @mock.patch("mozphab.conduit.ConduitAPI.check")
 def test_conduit_broken(m_check):
     m_check.return_value = False
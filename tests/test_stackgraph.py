@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+
+from mozphab.exceptions import NonLinearException
+from mozphab.stackgraph import StackGraph
+
+
+def edges(*pairs):
+    """Parent and child edges for (parent, child) pairs."""
+    result = []
+    for parent, child in pairs:
+        result.append(
+            dict(sourcePHID=child, destinationPHID=parent, edgeType="revision.parent")
+        )
+        result.append(
+            dict(sourcePHID=parent, destinationPHID=child, edgeType="revision.child")
+        )
+    return result
+
+
+def test_linear_stack():
+    graph = StackGraph(edges(("A", "B"), ("B", "C"), ("B", "C")))
+    assert graph.is_linear
+    assert graph.phids == {"A", "B", "C"}
+    assert graph.ancestors("C") == ["B", "A"]
+    assert graph.successors("A") == ["B", "C"]
+    assert graph.successors("C") == []
+    assert graph.ordered("B") == ["A", "B", "C"]
+
+
+def test_non_linear_stack():
+    graph = StackGraph(edges(("A", "B"), ("A", "C"), ("C", "D")))
+    assert not graph.is_linear
+    assert graph.ancestors("D") == ["C", "A"]
+    with pytest.raises(NonLinearException):
+        graph.successors("A")
+
+    with pytest.raises(NonLinearException):
+        graph.ordered("C")
+
+
+def test_loop():
+    graph = StackGraph(edges(("A", "B"), ("B", "A")))
+    with pytest.raises(NonLinearException):
+        graph.successors("A")
@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import mock
+import pytest
+
+from mozphab import subprocess_wrapper
+from mozphab.timings import Timings, command_name, percentile
+
+
+@pytest.mark.parametrize(
+    "command,expected",
+    [
+        (["git", "log", "--format=%H"], "git log"),
+        (["/usr/bin/git", "-c", "user.name=x", "commit"], "git commit"),
+        (["hg", "--cwd", "/repo", "--config", "a=b", "log"], "hg log"),
+        (["git", "--version"], "git"),
+    ],
+)
+def test_command_name(command, expected):
+    assert command_name(command) == expected
+
+
+def test_percentile():
+    assert percentile([], 50) == 0
+    assert percentile([1], 95) == 1
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 100) == 100
+
+
+def test_summary():
+    timings = Timings()
+    timings.record("conduit", "conduit.ping", 0.5, sent=10, received=20)
+    timings.record("conduit", "conduit.ping", 0.1, sent=10, received=20)
+    timings.record("command", "git log", 2)
+
+    rows = timings.summary()
+    assert [row["name"] for row in rows] == ["git log", "conduit.ping"]
+    assert rows[1] == dict(
+        category="conduit",
+        name="conduit.ping",
+        count=2,
+        total=0.6,
+        p50=0.1,
+        p95=0.5,
+        max=0.5,
+        sent=20,
+        received=40,
+    )
+
+    timings.reset()
+    assert timings.summary() == []
+
+
+@mock.patch("mozphab.timings.logger")
+def test_report(m_logger):
+    timings = Timings()
+    timings.report()
+    m_logger.info.assert_called_once_with("No API calls or commands recorded.")
+
+    m_logger.reset_mock()
+    timings.record("bmo", "whoami", 0.25)
+    timings.report()
+    assert m_logger.info.call_count == 2
+    assert m_logger.info.call_args[0][1:4] == ("bmo", "whoami", 1)
+    assert m_logger.info.call_args[0][-2:] == (0, 0)
+
+    # Bytes sent to commands aren't known.
+    m_logger.reset_mock()
+    timings.reset()
+    timings.record("command", "git log", 0.25, received=10)
+    timings.report()
+    assert m_logger.info.call_args[0][-2:] == ("-", 10)
+
+
+@mock.patch("mozphab.subprocess_wrapper.timings")
+@mock.patch("mozphab.subprocess_wrapper.subprocess.check_output")
+def test_check_output_recorded(m_check_output, m_timings):
+    m_check_output.return_value = "abc\n"
+    subprocess_wrapper.check_output(["git", "status"])
+    m_timings.record.assert_called_once_with(
+        "command", "git status", mock.ANY, received=4
+    )
+
+
+@mock.patch("mozphab.subprocess_wrapper.timings")
+def test_start_process_recorded(m_timings):
+    process = subprocess_wrapper.start_process(["cat", "-"])
+    process.stdin.close()
+    m_timings.record.assert_not_called()
+
+    process.wait()
+    process.wait()
+    process.stdout.close()
+    m_timings.record.assert_called_once_with("command", "cat", mock.ANY)